@@ -1,8 +1,7 @@
 import os
-import sources
+import rcfiles
 import logging
 import yaml
-import subprocess
 import orm
 import model
 import time
@@ -23,13 +22,17 @@ logging.basicConfig(level=logging_level)
 orm.initialize(CONFIG['db uri'])
 model.setup_database()
 
+if not os.path.exists(SOURCES_DIR):
+    os.mkdir(SOURCES_DIR)
+registrations = rcfiles.Registrations(os.path.join(SOURCES_DIR, rcfiles.STATE_FILE))
 t_i = time.time()
-sources.download_rcfiles(CONFIG['sources file'], SOURCES_DIR)
-logging.info("Fetched rcfiles in {} seconds.".format(time.time() - t_i))
+rcfiles.scan(CONFIG['sources file'], registrations)
+logging.info("Scanned rcfiles in {} seconds.".format(time.time() - t_i))
 
 with orm.get_session() as s:
-	for p in sources.contestant_list(CONFIG['sources file'], SOURCES_DIR):
+	for p in registrations.new(s):
 		try:
 			model.add_contestant(s, p)
 		except BaseException as e:
 		    logging.warning("Bad player {}. Exception: {}.".format(p, repr(e)))
+registrations.save()
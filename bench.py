@@ -0,0 +1,805 @@
+"""Benchmarks for the scoreboard.
+
+Usage:
+    python bench.py parse [FILE ...]
+    python bench.py sqlite [--sources DIR]
+    python bench.py generate DEST [--players N] [--games M] [--milestones K]
+    python bench.py run [--sources DIR | --players N ...] [--report FILE]
+                        [--baseline FILE]
+    python bench.py fetch [--sources DIR | --players N ...]
+    python bench.py rules [--sources DIR | --players N ...]
+    python bench.py eligibility [--sources DIR | --players N ...]
+    python bench.py plans [--sources DIR | --players N ...]
+    python bench.py compile [--sources DIR | --players N ...]
+
+parse: check modelutils.logline_to_dict against the reference regex parser on
+    every line of the given logfiles/milestones (default: everything under
+    ./sources) and report lines/sec for both.
+sqlite: build a fresh db from the sources already downloaded to DIR once per
+    combination of sqlite profiles from config.yml, and report refresh and
+    page-build times for each.
+generate: write synthetic sources for N players, M games each with about K
+    milestones each, to DEST (see synthetic.py).
+run: refresh a fresh db from DIR, or from synthetic sources generated on the
+    fly, make every player a contestant, then time the scorecards, the
+    overview and every page, and count the queries of each page. The timings
+    and counts are written to a JSON report and, with --baseline, compared
+    against an earlier report; the exit status is 1 if a page makes more
+    queries than QUERY_LIMITS allows, or anything got slower than
+    --tolerance allows or a page makes more queries than in the baseline.
+fetch: serve DIR (or synthetic sources) from a local http.server stand-in
+    that supports Range, then time fetch.py downloading everything, again
+    after some lines were appended, and again with nothing new, checking
+    the copies match.
+rules: refresh a fresh db like run, then check that scoring from the
+    achievements ledger gives what the reference queries on the milestones
+    give for every game of every week, and that replaying every game from
+    its milestones rebuilds the same ledger. Reports the time of each.
+eligibility: refresh a fresh db like run, then time every way of finding the
+    eligible games of each week (see csdc.ELIGIBILITY), checking they all
+    find the same games.
+plans: refresh a fresh db like run, then print sqlite's query plan of each
+    scoring query of the first week and check that every week's use the
+    indexes meant for them (see migrations.py); the exit status is 1 if
+    one doesn't.
+compile: refresh a fresh db like run, then time building and compiling each
+    week's scorecard and score update statements, and running them built
+    afresh each time against running the ones csdc keeps, which sqlalchemy
+    compiles only once.
+
+The equivalence checks of parse, rules and eligibility also run on
+synthetic sources as tests: python -m pytest tests
+"""
+
+import argparse
+import glob
+import http.server
+import json
+import shutil
+import socket
+import threading
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+import yaml
+
+import constants as const
+import modelutils
+
+SOURCES_DIR = './sources'
+CONFIG_FILE = 'config.yml'
+# the most queries each page may make, however many players there are
+QUERY_LIMITS = {"scorepage": 1, "standingspage": 8}
+if not os.path.isfile(CONFIG_FILE):
+    CONFIG_FILE = 'config_default.yml'
+
+
+def _reference_logline_to_dict(logline: str) -> dict:
+    """The original regex based parser, kept to check the fast one against."""
+    data = {}
+    pairs = re.split('(?<!:):(?!:)', logline.strip().strip('\0'))
+    for p in pairs:
+        p = p.replace('::',':')
+        keyval = p.split('=')
+        try:
+            data[keyval[0]] = keyval[1]
+        except IndexError as e:
+            logging.error('error "{}" in keyval "{}", logline "{}"'.format(e,keyval,logline))
+    data["v"] = re.match(r"(0.\d+)", data["v"]).group()
+    if "god" not in data:
+        data["god"] = "GOD_NO_GOD"
+
+    if "status" not in data:
+        data["status"] = ""
+
+    data["god"] = const.GOD_NAME_FIXUPS.get(data["god"],data["god"])
+    if "end" in data:
+        data["time"] = data["end"]
+        data["ktyp"] = const.KTYP_FIXUPS.get(data["ktyp"], data["ktyp"])
+        data["type"] = "death.final"
+        data["milestone"] = data["tmsg"]
+
+    data["xl"] = data.get("xl", 0)
+
+    data["gems"] = data.get("fgem", 0)
+
+    data["runes"] = data.get("urune", 0)
+    # D:0 is D:$ in logfile so we came from D:1 in that case
+    data["oplace"] = data.get("oplace",
+            data["place"].translate(str.maketrans("$", "1")))
+
+    return data
+
+
+def _parse_or_error(parser, line):
+    try:
+        return parser(line)
+    except KeyError as e:
+        return ("KeyError", str(e))
+
+
+def _lines_per_sec(parser, lines, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t_i = time.perf_counter()
+        for line in lines:
+            _parse_or_error(parser, line)
+        elapsed = time.perf_counter() - t_i
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best if best else float("inf")
+
+
+def parse_mismatches(lines):
+    """The lines logline_to_dict parses differently from the reference."""
+    return [line for line in lines
+            if _parse_or_error(modelutils.logline_to_dict, line)
+            != _parse_or_error(_reference_logline_to_dict, line)]
+
+
+def bench_parse(files):
+    lines = []
+    for file in files:
+        with open(file, 'rb') as f:
+            lines.extend(line.decode() for line in f)
+    logging.info("Read {} lines from {} files".format(len(lines), len(files)))
+
+    # both parsers log malformed lines, don't time the logging
+    logging.disable(logging.ERROR)
+    mismatches = parse_mismatches(lines)
+    for line in mismatches[:10]:
+        print("MISMATCH: {!r}".format(line))
+    reference = _lines_per_sec(_reference_logline_to_dict, lines)
+    current = _lines_per_sec(modelutils.logline_to_dict, lines)
+    logging.disable(logging.NOTSET)
+
+    print("lines: {}  mismatches: {}".format(len(lines), len(mismatches)))
+    print("reference: {:.0f} lines/sec".format(reference))
+    print("logline_to_dict: {:.0f} lines/sec ({:.2f}x)".format(current,
+        current / reference))
+    return not mismatches
+
+
+def _build_pages():
+    import csdc
+    import web
+    for wk in csdc.weeks:
+        web.scorepage(wk)
+    web.standingspage()
+    web.overviewpage()
+
+
+def _sqlite_run(config, sources_dir, sqlite, ingest, render):
+    """Refresh into a new db with one profile, then build pages with another."""
+    import orm
+    with tempfile.TemporaryDirectory() as tmp:
+        timings = _fresh_db(config, sources_dir, None, tmp, sqlite=sqlite or {},
+                profile=ingest)
+        t_refresh = timings["refresh"] + timings["analyze"] + timings["scores"]
+        orm.use_profile(render)
+        t_i = time.perf_counter()
+        _build_pages()
+        t_render = time.perf_counter() - t_i
+        orm.engine.dispose()
+    return t_refresh, t_render
+
+
+def bench_sqlite(config, sources_dir):
+    sqlite = config.get('sqlite') or {}
+    runs = [("no pragmas", None, None, None)]
+    profiles = ["default"] + [k for k, v in sqlite.items() if isinstance(v, dict)]
+    runs.extend(("{} / {}".format(p, p), sqlite, p, p) for p in profiles)
+    if "ingest" in profiles and "render" in profiles:
+        runs.append(("ingest / render", sqlite, "ingest", "render"))
+
+    # the refresh logs every file, that's noise here
+    logging.disable(logging.INFO)
+    results = [(name,) + _sqlite_run(config, sources_dir, *args)
+            for name, *args in runs]
+    logging.disable(logging.NOTSET)
+
+    print("{:<20} {:>10} {:>10}".format("refresh / render", "refresh", "render"))
+    for name, t_refresh, t_render in results:
+        print("{:<20} {:>9.2f}s {:>9.2f}s".format(name, t_refresh, t_render))
+    return True
+
+
+def _week_windows():
+    """(char, start, end) of every week. Building the weeks needs a db, an
+    in-memory one will do when there is none yet."""
+    import orm
+    import model
+    import csdc
+    if not csdc.weeks:
+        logging.disable(logging.INFO)
+        orm.initialize("sqlite://")
+        model.setup_database()
+        csdc.initialize_weeks()
+        logging.disable(logging.NOTSET)
+    return [(wk.char, wk.start, wk.end) for wk in csdc.weeks]
+
+
+def _generate(config, dest, args):
+    import synthetic
+    return synthetic.generate(config['sources file'], dest, _week_windows(),
+            players=args.players, games=args.games,
+            milestones=args.milestones, seed=args.seed)
+
+
+def _timed(timings, name, fn, *args):
+    t_i = time.perf_counter()
+    result = fn(*args)
+    timings[name] = time.perf_counter() - t_i
+    return result
+
+
+def _counted(queries, name, fn, *args):
+    """Call fn, counting the statements it sends to the db in queries."""
+    import orm
+    import sqlalchemy.event
+    count = [0]
+
+    def one(*_):
+        count[0] += 1
+
+    sqlalchemy.event.listen(orm.engine, "before_cursor_execute", one)
+    try:
+        return fn(*args)
+    finally:
+        sqlalchemy.event.remove(orm.engine, "before_cursor_execute", one)
+        queries[name] = count[0]
+
+
+def bench_run(config, sources_dir, args):
+    import orm
+    import csdc
+    import web
+    from orm import Player, Game, Milestone, CsdcContestant
+
+    with tempfile.TemporaryDirectory() as tmp:
+        timings = _fresh_db(config, sources_dir, args, tmp)
+
+        with orm.get_session() as s:
+            s.bulk_insert_mappings(CsdcContestant, [{"player_id": pid,
+                "division": 1} for pid, in s.query(Player.id)])
+            s.commit()
+            counts = {"players": s.query(Player).count(),
+                    "games": s.query(Game).count(),
+                    "milestones": s.query(Milestone).count()}
+
+        orm.use_profile('render')
+        with orm.get_session() as s:
+            for wk in csdc.weeks:
+                _timed(timings, "sortedscorecard." + wk.number,
+                        wk.sortedscorecard().with_session(s).all)
+        # every week's results and the standings built from them
+        csdc.forget_results()
+        _timed(timings, "overview", csdc.overview)
+        csdc.forget_results()
+        for wk in csdc.weeks:
+            _timed(timings, "scorepage." + wk.number, web.scorepage, wk)
+        for page in ("standingspage", "overviewpage", "rulespage"):
+            _timed(timings, page, getattr(web, page))
+        # the queries of each page from scratch, none of them should grow
+        # with the number of players
+        queries = {}
+        for wk in csdc.weeks:
+            csdc.forget_results()
+            _counted(queries, "scorepage." + wk.number, web.scorepage, wk)
+        csdc.forget_results()
+        _counted(queries, "standingspage", web.standingspage)
+        orm.engine.dispose()
+
+    timings["pages"] = sum(v for k, v in timings.items()
+            if k.startswith("scorepage.") or k.endswith("page"))
+    return {"params": {"players": args.players, "games": args.games,
+                "milestones": args.milestones, "seed": args.seed,
+                "sources": args.sources},
+            "counts": counts, "timings": timings, "queries": queries}
+
+
+def _ledger(s):
+    from orm import Achievement
+    return set(s.query(Achievement.gid, Achievement.category,
+        Achievement.milestone_id, Achievement.time))
+
+
+def _fresh_db(config, sources_dir, args, tmp, sqlite=None, profile='ingest'):
+    """Refresh a new db in tmp from sources_dir, or from synthetic sources
+    if it's None, and set up and score the weeks. This is the fixture of
+    every benchmark that needs a db.
+
+    sqlite and profile are passed to orm.initialize, sqlite is the config's
+    by default. Returns the time each step took."""
+    import orm
+    import model
+    import refresh
+    import csdc
+    timings = {}
+    if sources_dir is None:
+        sources_dir = os.path.join(tmp, "sources")
+        _timed(timings, "generate", _generate, config, sources_dir, args)
+    # setup and refresh log every row/file they add, that's noise here
+    logging.disable(logging.INFO)
+    orm.initialize("sqlite:///" + os.path.join(tmp, "bench.db"),
+            config.get('sqlite') if sqlite is None else sqlite, profile)
+    model.setup_database()
+    del csdc.weeks[:]
+    csdc.initialize_weeks(config.get('eligibility', 'subquery'))
+    _timed(timings, "refresh", refresh.refresh, config['sources file'],
+            sources_dir, False, config.get('ingest workers', 1))
+    _timed(timings, "analyze", orm.analyze, "milestones")
+    _timed(timings, "scores", csdc.update_scores)
+    logging.disable(logging.NOTSET)
+    return timings
+
+
+def week_scores(s, wk, columns):
+    """{gid: scores} of a week's games, from the given score columns, eg
+    wk.score_columns or wk._reference_columns()."""
+    from sqlalchemy.orm import aliased
+    from orm import Game
+    q = s.query(*[Game.gid] + columns).filter(
+            Game.gid.in_(wk._week_games(aliased(Game))))
+    return {row[0]: row[1:] for row in q}
+
+
+def replayed_ledger(s):
+    """The achievements ledger as streamed at ingest, and as rebuilt by
+    replaying every game from its milestones. Doesn't commit the replay."""
+    import rules
+    from orm import RuleState
+    streamed = _ledger(s)
+    s.query(RuleState).delete()
+    rules.catch_up(s)
+    return streamed, _ledger(s)
+
+
+def _eligible(s, wk, method):
+    return sorted(gid for gid, in getattr(wk, method)().with_session(s))
+
+
+def eligible_gids(s, wk):
+    """{name: sorted gids} of a week's eligible games, found each way in
+    csdc.ELIGIBILITY."""
+    import csdc
+    return {name: _eligible(s, wk, method)
+            for name, method in csdc.ELIGIBILITY.items()}
+
+
+def bench_rules(config, sources_dir, args):
+    import orm
+    import csdc
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        _fresh_db(config, sources_dir, args, tmp)
+
+        columns = {wk.number: (wk._reference_columns(), wk.score_columns)
+                for wk in csdc.weeks}
+        timings = {"reference": 0, "ledger": 0}
+        with orm.get_session() as s:
+            for wk in csdc.weeks:
+                scores = {}
+                for name, cols in zip(("reference", "ledger"), columns[wk.number]):
+                    t_i = time.perf_counter()
+                    scores[name] = week_scores(s, wk, cols)
+                    timings[name] += time.perf_counter() - t_i
+                names = [c.name for c in columns[wk.number][0]]
+                for gid, ref in sorted(scores["reference"].items()):
+                    got = scores["ledger"].get(gid)
+                    if got != ref:
+                        ok = False
+                        print("week {} {}: {}".format(wk.number, gid, ", ".join(
+                            "{} {} != {}".format(n, a, b) for n, a, b in
+                            zip(names, got or [None] * len(ref), ref) if a != b)))
+                print("week {}: {} games".format(wk.number, len(scores["reference"])))
+            for name, t in timings.items():
+                print("{} scoring: {:.3f}s".format(name, t))
+
+            t_i = time.perf_counter()
+            streamed, replayed = replayed_ledger(s)
+            s.commit()
+            print("replay of {} achievements: {:.2f}s".format(len(replayed),
+                time.perf_counter() - t_i))
+            if replayed != streamed:
+                ok = False
+                print("replayed ledger differs: {} entries, {} streamed".format(
+                    len(replayed ^ streamed), len(streamed)))
+        orm.engine.dispose()
+    print("ok" if ok else "MISMATCH")
+    return ok
+
+
+def bench_eligibility(config, sources_dir, args, repeat=3):
+    import orm
+    import csdc
+
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        _fresh_db(config, sources_dir, args, tmp)
+        orm.use_profile('render')
+        timings = {name: 0 for name in csdc.ELIGIBILITY}
+        with orm.get_session() as s:
+            for wk in csdc.weeks:
+                gids = {}
+                for name, method in csdc.ELIGIBILITY.items():
+                    gids[name] = _eligible(s, wk, method)
+                    timings[name] += _best(repeat,
+                            lambda: _eligible(s, wk, method))
+                same = len(set(map(tuple, gids.values()))) == 1
+                ok = ok and same
+                print("week {}: {}{}".format(wk.number, ", ".join(
+                    "{} {}".format(name, len(g)) for name, g in gids.items()),
+                    "" if same else " MISMATCH"))
+        for name, t in timings.items():
+            print("{:<10} {:>8.3f}s".format(name, t))
+        orm.engine.dispose()
+    return ok
+
+
+def _best(repeat, fn):
+    """The shortest of repeat timings of fn()."""
+    best = None
+    for _ in range(repeat):
+        t_i = time.perf_counter()
+        fn()
+        t = time.perf_counter() - t_i
+        best = t if best is None else min(best, t)
+    return best
+
+
+def bench_compile(config, sources_dir, args, repeat=5):
+    import orm
+    import csdc
+    from orm import Player, CsdcContestant
+
+    def run(execute, statements):
+        for statement in statements:
+            result = execute(statement)
+            if result.returns_rows:
+                result.fetchall()
+
+    kinds = [
+        ("scorecard", lambda wk: [wk.sortedscorecard().statement]),
+        ("update", lambda wk: wk._update_statements(False)),
+        ("update dirty", lambda wk: wk._update_statements(True)),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        _fresh_db(config, sources_dir, args, tmp)
+        with orm.get_session() as s:
+            s.bulk_insert_mappings(CsdcContestant, [{"player_id": pid,
+                "division": 1} for pid, in s.query(Player.id)])
+            s.commit()
+        dialect = orm.engine.dialect
+        totals = {"uncached": 0, "cached": 0}
+        print("{:<19} {:>8} {:>8} {:>9} {:>8}   (ms, best of {})".format("",
+            "build", "compile", "uncached", "cached", repeat))
+        with orm.get_session() as s:
+            for wk in csdc.weeks:
+                for name, build in kinds:
+                    statements = build(wk)
+                    built = _best(repeat, lambda: build(wk))
+                    compiled = _best(repeat, lambda: [st.compile(dialect=dialect)
+                        for st in statements])
+                    # a new statement each time, as before they were kept
+                    uncached = _best(repeat, lambda: run(s.execute, build(wk)))
+                    cached = _best(repeat, lambda: run(
+                        lambda st: csdc._execute(s, st), statements))
+                    totals["uncached"] += uncached
+                    totals["cached"] += cached
+                    print("week {} {:<12} {:>8.2f} {:>8.2f} {:>9.2f} {:>8.2f}".format(
+                        wk.number, name, built * 1000, compiled * 1000,
+                        uncached * 1000, cached * 1000))
+            s.rollback()
+        print("total: uncached {:.3f}s, cached {:.3f}s".format(
+            totals["uncached"], totals["cached"]))
+        orm.engine.dispose()
+    return True
+
+
+def _query_plan(s, q):
+    """sqlite's EXPLAIN QUERY PLAN of a Query, a line per step."""
+    import sqlalchemy.event
+    conn = s.connection()
+
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        return "EXPLAIN QUERY PLAN " + statement, parameters
+
+    sqlalchemy.event.listen(conn, "before_cursor_execute", explain, retval=True)
+    try:
+        return [row[-1] for row in conn.execute(q.statement)]
+    finally:
+        sqlalchemy.event.remove(conn, "before_cursor_execute", explain)
+
+
+def bench_plans(config, sources_dir, args):
+    import orm
+    import csdc
+    from sqlalchemy.orm import aliased
+    from sqlalchemy.orm.query import Query
+    from orm import Game
+
+    def scores(wk, columns):
+        return Query([Game.gid] + columns).filter(
+                Game.gid.in_(wk._week_games(aliased(Game))))
+
+    # (name, query of a week, the indexes its plan must use)
+    checks = [
+        ("eligible (window)", lambda wk: wk._window_gids(),
+            ["ix_games_char_start"]),
+        ("eligible (subquery)", lambda wk: wk._subquery_gids(),
+            ["ix_games_char_start", "ix_milestones_gid_time"]),
+        ("scores (ledger)", lambda wk: scores(wk, wk.score_columns),
+            ["ix_games_char_start"]),
+        ("scores (reference)", lambda wk: scores(wk, wk._reference_columns()),
+            ["ix_games_char_start", "ix_milestones_gid_verb_place_turn",
+                "ix_milestones_gid_time"]),
+        ("scorecard", lambda wk: wk.sortedscorecard(), []),
+    ]
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        _fresh_db(config, sources_dir, args, tmp)
+        orm.use_profile('render')
+        queries = [(wk, name, make(wk), indexes) for wk in csdc.weeks
+                for name, make, indexes in checks]
+        with orm.get_session() as s:
+            for wk, name, q, indexes in queries:
+                plan = _query_plan(s, q)
+                missing = [i for i in indexes
+                        if not any(" {} ".format(i) in l for l in plan)]
+                ok = ok and not missing
+                if wk is csdc.weeks[0] or missing:
+                    print("week {} {}:".format(wk.number, name))
+                    for line in sorted(set(plan), key=plan.index):
+                        print("    " + line)
+                if missing:
+                    print("  doesn't use {}".format(", ".join(missing)))
+        orm.engine.dispose()
+    print("ok" if ok else "MISSING INDEXES")
+    return ok
+
+
+def check_query_limits(report):
+    """Print the pages that make more queries than QUERY_LIMITS allows.
+    False if there are any."""
+    ok = True
+    for name, n in report["queries"].items():
+        limit = QUERY_LIMITS[name.split(".")[0]]
+        if n > limit:
+            ok = False
+            print("{:<24} {:>10} queries, at most {} allowed".format(name, n, limit))
+    return ok
+
+
+def compare_reports(report, baseline, tolerance):
+    """Print timings next to a baseline's. False if any regressed.
+
+    Differences under 50ms are noise, whatever the ratio."""
+    ok = True
+    if report["params"] != baseline["params"]:
+        print("WARNING: baseline params differ: {}".format(baseline["params"]))
+    print("{:<24} {:>10} {:>10} {:>7}".format("", "baseline", "current", "ratio"))
+    for name, t in report["timings"].items():
+        base = baseline["timings"].get(name)
+        if base is None:
+            print("{:<24} {:>10} {:>9.3f}s".format(name, "-", t))
+            continue
+        ratio = t / base if base else float("inf")
+        slower = ratio > tolerance and t - base > 0.05
+        ok = ok and not slower
+        print("{:<24} {:>9.3f}s {:>9.3f}s {:>6.2f}x{}".format(name, base, t,
+            ratio, "  SLOWER" if slower else ""))
+    for name, n in report.get("queries", {}).items():
+        base = baseline.get("queries", {}).get(name)
+        more = base is not None and n > base
+        ok = ok and not more
+        print("{:<24} {:>10} {:>10}{}".format("queries " + name,
+            "-" if base is None else base, n, "  MORE" if more else ""))
+    return ok
+
+
+class _RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """A keep-alive static file server that understands "Range: bytes=N-",
+    If-Range and ETags, standing in for a crawl server's logfile directory."""
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    not_modified = 0
+
+    def setup(self):
+        super().setup()
+        # headers and body are separate writes, don't let Nagle delay them
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        type(self).connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        st = os.stat(path)
+        size = st.st_size
+        etag = '"{:x}-{:x}"'.format(st.st_mtime_ns, size)
+        if self.headers.get("If-None-Match") == etag:
+            type(self).not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        start = 0
+        rng = self.headers.get("Range", "")
+        if self.headers.get("If-Range", etag) != etag:
+            rng = ""  # the file changed, send all of it
+        if rng.startswith("bytes=") and rng.endswith("-"):
+            start = int(rng[6:-1])
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start,
+                size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            shutil.copyfileobj(f, self.wfile)
+
+
+def _same_files(jobs, root):
+    for url, dest in jobs:
+        with open(os.path.join(root, url.split("/", 3)[3]), 'rb') as a, \
+                open(dest, 'rb') as b:
+            if a.read() != b.read():
+                return False
+    return True
+
+
+def bench_fetch(config, sources_dir, args):
+    import fetch
+    with tempfile.TemporaryDirectory() as tmp:
+        if sources_dir is None:
+            sources_dir = os.path.join(tmp, "remote")
+            _generate(config, sources_dir, args)
+        remote = os.path.join(tmp, "served")
+        shutil.copytree(sources_dir, remote)
+        handler = lambda *a, **kw: _RangeHandler(*a, directory=remote, **kw)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:{}/".format(server.server_address[1])
+
+        jobs = []
+        for path in sorted(glob.glob(os.path.join(remote, "*", "*"))):
+            rel = os.path.relpath(path, remote)
+            dest = os.path.join(tmp, "local", rel)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            jobs.append((base + rel.replace(os.sep, "/"), dest))
+        missing = (base + "nosuchserver/logfile", os.path.join(tmp, "local", "missing"))
+
+        cache_file = os.path.join(tmp, "local", "fetch-cache.json")
+
+        def run(name, replaced=None):
+            _RangeHandler.connections = _RangeHandler.not_modified = 0
+            t_i = time.perf_counter()
+            results = fetch.download(jobs + [missing], cache_file=cache_file,
+                    replaced=replaced)
+            elapsed = time.perf_counter() - t_i
+            print("{:<10} {:>7.3f}s {:>12} bytes {:>4} connections {:>4} "
+                    "not modified {}".format(
+                name, elapsed, sum(r or 0 for r in results.values()),
+                _RangeHandler.connections, _RangeHandler.not_modified,
+                "ok" if _same_files(jobs, remote) else "MISMATCH"))
+            return _same_files(jobs, remote)
+
+        ok = run("full")
+        for _, dest in jobs:
+            # a few more games happened on every server
+            path = os.path.join(remote, os.path.relpath(dest, os.path.join(tmp, "local")))
+            with open(path, 'rb') as f:
+                tail = f.readlines()[-10:]
+            with open(path, 'ab') as f:
+                f.writelines(tail)
+        ok = run("appended") and ok
+        ok = run("unchanged") and ok
+        # one server rotated a file: what's there now is longer than ours
+        # but starts differently, resuming it would splice two files
+        url, dest = jobs[0]
+        path = os.path.join(remote, os.path.relpath(dest, os.path.join(tmp, "local")))
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(b"rotated\n" + data)
+        replaced = set()
+        ok = run("rotated", replaced) and ok
+        ok = ok and replaced == {dest}
+        ok = ok and os.path.getsize(missing[1]) == 0
+        server.shutdown()
+    return ok
+
+
+if __name__=='__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command")
+    # the options of the synthetic sources, and of running on existing ones
+    synthetic_args = argparse.ArgumentParser(add_help=False)
+    synthetic_args.add_argument("--players", type=int, default=200)
+    synthetic_args.add_argument("--games", type=int, default=3)
+    synthetic_args.add_argument("--milestones", type=int, default=20)
+    synthetic_args.add_argument("--seed", type=int, default=0)
+    sources_args = argparse.ArgumentParser(add_help=False,
+            parents=[synthetic_args])
+    sources_args.add_argument("--sources", help="existing sources instead of "
+            "generating them")
+
+    p = sub.add_parser("parse", help="logline parser equivalence and speed")
+    p.add_argument("files", nargs="*")
+    p = sub.add_parser("sqlite", help="refresh/render time per sqlite profile")
+    p.add_argument("--sources", default=SOURCES_DIR)
+    p = sub.add_parser("generate", help="write synthetic sources",
+            parents=[synthetic_args])
+    p.add_argument("dest")
+    p = sub.add_parser("run", help="end to end timings on synthetic sources",
+            parents=[sources_args])
+    p.add_argument("--report", default="bench-report.json")
+    p.add_argument("--baseline")
+    p.add_argument("--tolerance", type=float, default=1.25)
+    for name, help in (("fetch", "download timings against a local server"),
+            ("rules", "ledger scoring against the reference queries"),
+            ("eligibility", "eligible game queries against each other"),
+            ("plans", "check the scoring queries use their indexes"),
+            ("compile", "build and compile time of the scoring statements")):
+        sub.add_parser(name, help=help, parents=[sources_args])
+    args = parser.parse_args()
+
+    if args.command == "parse":
+        files = args.files or [f for f in glob.glob(os.path.join(SOURCES_DIR, "*", "*"))
+                if os.path.isfile(f)]
+        sys.exit(0 if bench_parse(files) else 1)
+    config = yaml.safe_load(open(CONFIG_FILE, encoding='utf8'))
+    if args.command == "sqlite":
+        sys.exit(0 if bench_sqlite(config, args.sources) else 1)
+    if args.command == "generate":
+        _generate(config, args.dest, args)
+        sys.exit(0)
+    if args.command == "fetch":
+        sys.exit(0 if bench_fetch(config, args.sources, args) else 1)
+    if args.command == "compile":
+        sys.exit(0 if bench_compile(config, args.sources, args) else 1)
+    if args.command == "plans":
+        sys.exit(0 if bench_plans(config, args.sources, args) else 1)
+    if args.command == "eligibility":
+        sys.exit(0 if bench_eligibility(config, args.sources, args) else 1)
+    if args.command == "rules":
+        sys.exit(0 if bench_rules(config, args.sources, args) else 1)
+    if args.command == "run":
+        report = bench_run(config, args.sources, args)
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+        print("counts: {}".format(report["counts"]))
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            ok = compare_reports(report, baseline, args.tolerance)
+        else:
+            for name, t in report["timings"].items():
+                print("{:<24} {:>9.3f}s".format(name, t))
+            for name, n in report["queries"].items():
+                print("{:<24} {:>10}".format("queries " + name, n))
+            ok = True
+        ok = check_query_limits(report) and ok
+        sys.exit(0 if ok else 1)
+    parser.print_help()
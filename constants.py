@@ -117,12 +117,12 @@ NONPLAYABLE_COMBOS = [
     "GhSh",
     "MuSh",
 ]
-PLAYABLE_COMBOS = (
+PLAYABLE_COMBOS = [
     "%s%s" % (rc.short, bg.short)
     for rc in SPECIES
     for bg in BACKGROUNDS
     if "%s%s" % (rc, bg) not in NONPLAYABLE_COMBOS
-)
+]
 GOD_NAME_FIXUPS = {
     # Actually, the ingame name is 'the Shining One', but that looks
     # ugly since the capitalisation is wrong.
@@ -23,12 +23,12 @@ logging.basicConfig(level=logging.DEBUG)
 
 orm.initialize(CONFIG['db uri'])
 model.setup_database()
-csdc.initialize_weeks()
+csdc.initialize_weeks(CONFIG.get('eligibility', 'subquery'))
 
 GREP_COMMAND = ("grep -i -C4 --ignore-case '|.*cool[[:space:]]*play'")
 
+download_morgues(csdc.weeks, CONFIG['morgue dir'])
 for wk in csdc.weeks:
-    download_morgues(wk, CONFIG['morgue dir'])
     morgueglob = os.path.join(CONFIG['morgue dir'],wk.number, "*.txt")
     cmdline = shlex.split(GREP_COMMAND)
     logging.debug("Executing subprocess: {}".format(cmdline + [morgueglob]))
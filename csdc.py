@@ -1,8 +1,11 @@
 import datetime
+import hashlib
 import constants
+import rules
 from collections import namedtuple
 from model import (
     latestmilestones,
+    mark_dirty,
     get_species,
     get_background,
     get_place,
@@ -13,7 +16,7 @@ from model import (
     get_ktyp,
     get_verb
 )
-from modelutils import morgue_url
+from modelutils import morgue_url, LineFilter
 from orm import (
     Logfile,
     Server,
@@ -32,10 +35,14 @@ from orm import (
     Verb,
     Skill,
     CsdcContestant,
+    GameScore,
+    DirtyGame,
+    WeekSignature,
+    Achievement,
     get_session,
 )
 
-from sqlalchemy import asc, desc, func, type_coerce, Integer, literal, case, literal_column
+from sqlalchemy import asc, desc, func, type_coerce, Integer, literal, case, literal_column, insert
 from sqlalchemy.sql import and_, or_
 from sqlalchemy.orm.query import (
     aliased,
@@ -47,11 +54,51 @@ CsdcBonus = namedtuple("CsdcBonus", ["name", "description", "query", "pts"])
 
 NoBonus = CsdcBonus("NoBonus","No bonus",[literal(False)], "0")
 
+# eligibility: the CsdcWeek method that builds the query of its eligible gids
+ELIGIBILITY = {
+    "subquery": "_subquery_gids",
+    "window": "_window_gids",
+}
+
+# bump to recompute every game_scores row when the scoring queries change
+SCORES_VERSION = 3
+
+ONETIMES = ("fifteenrune", "zig", "lowxlzot", "nolairwin", "asceticrune")
+
+# a contestant's line of the standings, see overview
+Standing = namedtuple("Standing", ["player_id", "name", "account_id", "weeks"]
+        + list(ONETIMES) + ["grandtotal", "tiebreak", "hiscore", "played"])
+# a contestant's result in one week of the standings
+WeekResult = namedtuple("WeekResult", ["total", "gid"])
+
+# scorecards and standings computed this run, see results
+_results = {}
+
+# statements built once per process, and what sqlalchemy compiled them to
+_statements = {}
+_compiled = {}
+
+
+def _statement(key, build):
+    """The statement for key, from build() the first time.
+
+    Executed with _execute, the same statement object is only compiled
+    once. Whatever it depends on must be in key or fixed for the process,
+    like a week's char and dates and the ids its columns looked up."""
+    if key not in _statements:
+        _statements[key] = build()
+    return _statements[key]
+
+
+def _execute(s, statement):
+    """Execute statement in s's transaction, reusing its compiled form."""
+    return s.connection().execution_options(
+            compiled_cache=_compiled).execute(statement)
+
 def _champion_god(milestones, god):
     """Query if the supplied god get championed in the provided milestone set"""
-    with get_session() as s:
-        worship_id = get_verb(s, "god.worship").id
-        champ_id = get_verb(s, "god.maxpiety").id
+    worship_id = get_verb(None, "god.worship").id
+    champ_id = get_verb(None, "god.maxpiety").id
     maxpiety = milestones.filter(
                 Milestone.god_id == god.id,
                 Milestone.verb_id == champ_id
@@ -73,8 +120,7 @@ def _champion_god(milestones, god):
     return champion_conditions.get(god.name, maxpiety)
 
 def _worship_god(milestones, god):
-    with get_session() as s:
-        worship_id = get_verb(s, "god.worship").id
+    worship_id = get_verb(None, "god.worship").id
     worship = milestones.filter(
                             Milestone.god_id == god.id,
                             Milestone.verb_id == worship_id
@@ -95,38 +141,67 @@ class CsdcWeek:
 
     This object generates the queries needed to score a csdc week"""
 
-    def _valid_games(self, alias):
-        """Query the gids in an alias for the Games table for the valid ones
-
-        There are a lot of games but not that many in a given time window,
-        there is a good index for this filter, so even if it is implied one
-        should endavour to use it.
- 
-        add_columns can specify further columns, but as-is this is hit by a
-        covering index"""
-        return Query(alias.gid).join(Account,
-            alias.account_id == Account.id).filter(
-                ~Account.blacklisted,
+    def _week_games(self, alias):
+        """Query the gids in an alias for the Games table of the week's char
+        started in the week, blacklisted or not. These are the games that
+        get a game_scores row."""
+        return Query(alias.gid).filter(
                 alias.species_id == self.species.id,
                 alias.background_id == self.background.id,
                 alias.start >= self.start,
                 alias.start < self.end
             )
 
+    def _valid_games(self, alias):
+        """Query the gids in an alias for the Games table for the valid ones
+
+        There are a lot of games but not that many of a char in a given time
+        window. ix_games_char_start finds them, so even if it is implied one
+        should endeavour to use this filter. The index doesn't cover the
+        gid or the account, those are read from the rows it finds.
+
+        add_columns can specify further columns, player_id comes from the
+        index too."""
+        return self._week_games(alias).join(Account,
+            alias.account_id == Account.id).filter(~Account.blacklisted)
+
 
     def __init__(self, **kwargs):
-        with get_session() as s:
-            self.number = kwargs["number"]
-            self.species = get_species(s, kwargs["species"])
-            self.background = get_background(s, kwargs["background"])
-            self.char = self.species.short + self.background.short
-            self.uniques = kwargs["unique"]
-            self.gods = [ get_god(s, g) for g in kwargs["gods"] ]
-            self.start = kwargs["start"]
-            self.end = kwargs["end"]
-            self.tier1 = kwargs.get("bonus1", NoBonus)
-            self.tier2 = kwargs.get("bonus2", NoBonus)
+        self.number = kwargs["number"]
+        self.species = get_species(None, kwargs["species"])
+        self.background = get_background(None, kwargs["background"])
+        self.char = self.species.short + self.background.short
+        self.uniques = kwargs["unique"]
+        self.gods = [ get_god(None, g) for g in kwargs["gods"] ]
+        self.start = kwargs["start"]
+        self.end = kwargs["end"]
+        self.tier1 = kwargs.get("bonus1", NoBonus)
+        self.tier2 = kwargs.get("bonus2", NoBonus)
+
+        eligibility = kwargs.get("eligibility", "subquery")
+        if eligibility not in ELIGIBILITY:
+            raise ValueError("Unknown eligibility '{}'".format(eligibility))
+        self.gids = getattr(self, ELIGIBILITY[eligibility])()
+        # built up front, they look up verbs and places which may write
+        self.score_columns = self._score_columns()
+
+
+    def _eligible(self, possiblegames):
+        """Query the gids of the possible games that score: a player's first
+        game, and their second if the first ended below XL5 before it began.
+
+        possiblegames must have gid, player_id, start, end and xl columns."""
+        pg2 = possiblegames.alias()
+        return Query(possiblegames.c.gid.label("gid")).outerjoin(pg2,
+                and_(pg2.c.player_id == possiblegames.c.player_id,
+                    possiblegames.c.start > pg2.c.start)
+                ).filter(or_(pg2.c.gid == None,
+                    and_(pg2.c.end != None, pg2.c.xl < 5, 
+                    possiblegames.c.start > pg2.c.end)))
 
+    def _subquery_gids(self):
+        """The eligible gids, picking each player's first two games with a
+        LIMIT 2 subquery per game and their xl from latestmilestones"""
         g1 = aliased(Game)
         g2 = aliased(Game)
         possiblegames = self._valid_games(g1).add_columns(
@@ -139,23 +214,34 @@ class CsdcWeek:
                 ).order_by(g2.start).limit(2))
             ).join(latestmilestones, g1.gid == latestmilestones.c.gid
             ).add_column(latestmilestones.c.xl).cte()
-        pg2 = possiblegames.alias()
-        self.gids = Query(possiblegames.c.gid.label("gid")).outerjoin(pg2,
-                and_(pg2.c.player_id == possiblegames.c.player_id,
-                    possiblegames.c.start > pg2.c.start)
-                ).filter(or_(pg2.c.gid == None,
-                    and_(pg2.c.end != None, pg2.c.xl < 5, 
-                    possiblegames.c.start > pg2.c.end)))
-
+        return self._eligible(possiblegames)
+
+    def _window_gids(self):
+        """The eligible gids, numbering each player's games in one pass with
+        ROW_NUMBER() and using the xl kept on the game"""
+        g = aliased(Game)
+        ranked = self._valid_games(g).add_columns(
+                g.player_id,
+                g.start,
+                g.end,
+                g.xl,
+                func.row_number().over(partition_by=g.player_id,
+                    order_by=(g.start, g.gid)).label("n")
+            ).subquery()
+        possiblegames = Query([ranked.c.gid, ranked.c.player_id,
+            ranked.c.start, ranked.c.end, ranked.c.xl]).filter(
+                ranked.c.n <= 2,
+                ranked.c.xl != None  # no milestones, as with latestmilestones
+            ).cte()
+        return self._eligible(possiblegames)
 
     def _valid_milestone(self):
         return Query(Milestone).filter(Milestone.gid == Game.gid,
                 Milestone.time <= self.end);
 
     def _uniq(self):
-        with get_session() as s:
-            verb_ids = [ get_verb(s, u).id for u in ["uniq", "uniq.ban",
-            "uniq.pac", "uniq.slime"]]
+        verb_ids = [ get_verb(None, u).id for u in ["uniq", "uniq.ban",
+        "uniq.pac", "uniq.slime"]]
 
         return self._valid_milestone().filter(Milestone.verb_id.in_(verb_ids)).exists()
 
@@ -165,9 +251,8 @@ class CsdcWeek:
         ).exists()
 
     def _worship(self):
-        with get_session() as s:
-            worship_id = get_verb(s, "god.worship").id
-            abandon_id = get_verb(s, "god.renounce").id
+        worship_id = get_verb(None, "god.worship").id
+        abandon_id = get_verb(None, "god.renounce").id
         god_ids = [g.id for g in self.gods]
         return and_(
             or_(*[_worship_god(self._valid_milestone(), g) for g in
@@ -177,11 +262,10 @@ class CsdcWeek:
             ).exists())
 
     def _brenter(self):
-        with get_session() as s:
-            verb_id = get_verb(s, "br.enter").id
-            d_id = get_branch(s, "D").id
-            multilevel_places = Query(Place.id).join(Branch).filter(
-                    Branch.id != d_id, Branch.multilevel)
+        verb_id = get_verb(None, "br.enter").id
+        d_id = get_branch(None, "D").id
+        multilevel_places = Query(Place.id).join(Branch).filter(
+                Branch.id != d_id, Branch.multilevel)
 
         return self._valid_milestone().filter(
             Milestone.place_id.in_(multilevel_places),
@@ -189,9 +273,8 @@ class CsdcWeek:
         ).exists()
 
     def _brend(self):
-        with get_session() as s:
-            verb_id = get_verb(s, "br.end").id
-            multilevel_places = Query(Place.id).join(Branch).filter(Branch.multilevel)
+        verb_id = get_verb(None, "br.end").id
+        multilevel_places = Query(Place.id).join(Branch).filter(Branch.multilevel)
 
         return self._valid_milestone().filter(
             Milestone.place_id.in_(multilevel_places),
@@ -199,10 +282,9 @@ class CsdcWeek:
         ).exists()
 
     def _god(self):
-        with get_session() as s:
-            worship_id = get_verb(s, "god.worship").id
-            champ_id = get_verb(s, "god.maxpiety").id
-            abandon_id = get_verb(s, "god.renounce").id
+        worship_id = get_verb(None, "god.worship").id
+        champ_id = get_verb(None, "god.maxpiety").id
+        abandon_id = get_verb(None, "god.renounce").id
         god_ids = [g.id for g in self.gods]
         return and_(
             or_(*[_champion_god(self._valid_milestone(), g) for g in
@@ -222,24 +304,21 @@ class CsdcWeek:
         ).exists()
 
     def _orb(self):
-        with get_session() as s:
-            verb_id = get_verb(s, "orb").id
+        verb_id = get_verb(None, "orb").id
 
         return self._valid_milestone().filter(
             Milestone.verb_id == verb_id
         ).exists()
 
     def _win(self):
-        with get_session() as s:
-            ktyp_id = get_ktyp(s, "winning").id
+        ktyp_id = get_ktyp(None, "winning").id
 
         return type_coerce(and_(Game.ktyp_id != None, 
             Game.ktyp_id == ktyp_id,
             Game.end <= self.end), Integer)
 
     def _fifteenrune(self):
-        with get_session() as s:
-            ktyp_id = get_ktyp(s, "winning").id
+        ktyp_id = get_ktyp(None, "winning").id
 
         return type_coerce(and_(
             Game.ktyp_id != None,
@@ -248,8 +327,7 @@ class CsdcWeek:
             self._rune(15)), Integer)
 
     def _sub40k(self):
-        with get_session() as s:
-            ktyp_id = get_ktyp(s, "winning").id
+        ktyp_id = get_ktyp(None, "winning").id
 
         return type_coerce(func.ifnull(and_(
             Game.ktyp_id == ktyp_id,
@@ -259,18 +337,16 @@ class CsdcWeek:
         ), 0), Integer)
      
     def _zig(self):
-        with get_session() as s: 
-            zexit = get_verb(s, "zig.exit").id
-            zplace = get_place_from_string(s, "Zig:27").id
+        zexit = get_verb(None, "zig.exit").id
+        zplace = get_place_from_string(None, "Zig:27").id
 
         return self._valid_milestone().filter(
                 Milestone.verb_id == zexit,
                 Milestone.oplace_id == zplace).exists()
 
     def _lowxlzot(self):
-        with get_session() as s:
-            verb_id = get_verb(s, "br.enter").id
-            place = get_place_from_string(s, "Zot:1").id
+        verb_id = get_verb(None, "br.enter").id
+        place = get_place_from_string(None, "Zot:1").id
 
         return self._valid_milestone().filter(
             Milestone.xl <= 20,
@@ -278,10 +354,9 @@ class CsdcWeek:
             Milestone.place_id == place).exists()
     
     def _nolairwin(self):
-        with get_session() as s:
-            ktyp_id = get_ktyp(s, "winning").id
-            brenter = get_verb(s, "br.enter").id
-            lair = get_place_from_string(s, "Lair:1").id
+        ktyp_id = get_ktyp(None, "winning").id
+        brenter = get_verb(None, "br.enter").id
+        lair = get_place_from_string(None, "Lair:1").id
 
         return type_coerce(and_(Game.ktyp_id != None, 
             Game.ktyp_id == ktyp_id,
@@ -291,8 +366,7 @@ class CsdcWeek:
                 Milestone.place_id == lair).exists()), Integer)
 
     def _asceticrune(self):
-        with get_session() as s:
-            verb_id = get_verb(s, "rune").id
+        verb_id = get_verb(None, "rune").id
 
         return self._valid_milestone().filter(
             Milestone.verb_id == verb_id,
@@ -305,9 +379,10 @@ class CsdcWeek:
                 *bonus.query
             ).exists(), Integer).__mul__(bonus.pts)
 
-    def scorecard(self):
-        sc = Query([Game.gid,
-            Game.player_id,
+    def _reference_columns(self):
+        """What a Game scores in the week, as labeled columns, straight from
+        its milestones. _score_columns must give the same."""
+        return [
             type_coerce(self._xl(5), Integer).label("xl5"),
             type_coerce(self._uniq(), Integer).label("uniq"),
             type_coerce(self._worship(), Integer).label("worship"),
@@ -323,14 +398,131 @@ class CsdcWeek:
             self._win().label("win"),
             self._bonus(self.tier1).label("bonusone"),
             self._bonus(self.tier2).label("bonustwo"),
-        ]).filter(Game.gid.in_(self.gids)).subquery()
+#            type_coerce(self._sub40k(), Integer).label("sub40k"),
+            type_coerce(self._fifteenrune(), Integer).label("fifteenrune"),
+            type_coerce(self._zig(), Integer).label("zig"),
+            type_coerce(self._lowxlzot(), Integer).label("lowxlzot"),
+            type_coerce(self._nolairwin(), Integer).label("nolairwin"),
+            type_coerce(self._asceticrune(), Integer).label("asceticrune"),
+        ]
+
+    def _got(self, category):
+        """Query if a Game met a rules category before the week's end"""
+        return Query(Achievement).filter(Achievement.gid == Game.gid,
+                Achievement.category == category,
+                Achievement.time <= self.end).exists()
+
+    def _reached(self, category, column, n):
+        """_got for a category met when column reaches n. A game whose
+        milestones all fall in the week met it if its progress column says
+        so, without looking at the ledger."""
+        return case([(Game.last_milestone_time <= self.end, column >= n)],
+                else_=self._got(category))
+
+    def _ledger_god(self, god, champion):
+        if god.name == "GOD_NO_GOD":
+            return ~self._got("worship")
+        if champion and god.name not in ("Xom", "Gozag"):
+            return self._got("champion:" + god.name)
+        return self._got("worship:" + god.name)
+
+    def _ledger_bonus(self, bonus):
+        if "bonus:" + bonus.name not in rules.BONUS_CATEGORIES:
+            return self._bonus(bonus)
+        return type_coerce(self._got("bonus:" + bonus.name), Integer
+                ).__mul__(bonus.pts)
+
+    def _score_columns(self):
+        """What a Game scores in the week, as labeled columns, from the
+        achievements ledger and, where they tell, the game's progress
+        columns."""
+        got = lambda category: type_coerce(self._got(category), Integer)
+        reached = lambda category, column, n: type_coerce(
+                self._reached(category, column, n), Integer)
+        win = self._got("win")
+        renounced = self._got("renounce")
+        return [
+            reached("xl5", Game.max_xl, 5).label("xl5"),
+            got("uniq").label("uniq"),
+            type_coerce(and_(or_(*[self._ledger_god(g, False)
+                for g in self.gods]), ~renounced), Integer).label("worship"),
+            reached("xl10", Game.max_xl, 10).label("xl10"),
+            got("brenter").label("brenter"),
+            got("brend").label("brend"),
+            type_coerce(and_(or_(*[self._ledger_god(g, True)
+                for g in self.gods]), ~renounced), Integer).label("god"),
+            reached("gem", Game.max_gems, 1).label("gem"),
+            reached("rune", Game.max_runes, 1).label("rune"),
+            reached("tworune", Game.max_runes, 2).label("tworune"),
+            reached("threerune", Game.max_runes, 3).label("threerune"),
+            got("orb").label("orb"),
+            got("win").label("win"),
+            self._ledger_bonus(self.tier1).label("bonusone"),
+            self._ledger_bonus(self.tier2).label("bonustwo"),
+            type_coerce(and_(win, self._reached("rune15", Game.max_runes, 15)),
+                Integer).label("fifteenrune"),
+            got("zig").label("zig"),
+            got("lowxlzot").label("lowxlzot"),
+            type_coerce(and_(win, ~self._got("lair")), Integer
+                ).label("nolairwin"),
+            got("asceticrune").label("asceticrune"),
+        ]
+
+    def signature(self):
+        """A hash of everything the week's game scores depend on."""
+        parts = [SCORES_VERSION, rules.RULES_VERSION, self.number, self.char, self.start, self.end,
+                [g.name for g in self.gods],
+                [(b.name, b.pts) for b in (self.tier1, self.tier2)]]
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    def _update_statements(self, dirty):
+        """The delete and insert of update_scores."""
+        g = aliased(Game)
+        stale = GameScore.__table__.delete().where(
+                GameScore.week == self.number)
+        scores = Query([Game.gid, literal(self.number)] +
+                self.score_columns).filter(Game.gid.in_(self._week_games(g)))
+        if dirty:
+            stale = stale.where(GameScore.gid.in_(Query(DirtyGame.gid)))
+            scores = scores.filter(Game.gid.in_(Query(DirtyGame.gid)))
+        names = ["gid", "week"] + [c.name for c in self.score_columns]
+        return stale, insert(GameScore).from_select(names, scores.statement)
+
+    def update_scores(self, s, dirty=False):
+        """Recompute the game_scores rows of the week's games, only of those
+        in dirty_games if dirty. Doesn't commit."""
+        for statement in _statement((self.number, "update", dirty),
+                lambda: self._update_statements(dirty)):
+            _execute(s, statement)
+
+    def _scores(self):
+        return Query([Game.player_id] + [c for c in GameScore.__table__.c
+                if c.name != "week"]).join(GameScore, Game.gid == GameScore.gid
+                ).filter(GameScore.week == self.number,
+                    GameScore.gid.in_(self.gids))
+
+    def scorecard(self):
+        """A row per contestant and game, with what the pages show of the
+        game, all None for a contestant without one."""
+        sc = self._scores().subquery()
 
-        return Query( [Player, Game]).select_from(CsdcContestant).join(Player
+        return Query([CsdcContestant.player_id.label("player_id"),
+                Player.name.label("name")]).select_from(CsdcContestant).join(Player
                 ).outerjoin(sc, CsdcContestant.player_id ==
                         sc.c.player_id).outerjoin(Game,
-                Game.gid == sc.c.gid).add_columns(
+                Game.gid == sc.c.gid).outerjoin(Account,
+                Account.id == Game.account_id).outerjoin(Server,
+                Server.id == Account.server_id).outerjoin(Version,
+                Version.id == Game.version_id).outerjoin(Ktyp,
+                Ktyp.id == Game.ktyp_id).add_columns(
                     Game.gid,
-                    sc.c.player_id.label("player_id"),
+                    Account.name.label("account"),
+                    Server.name.label("server"),
+                    Version.v.label("version"),
+                    Ktyp.name.label("ktyp"),
+                    Game.start,
+                    Game.end,
+                    Game.score,
                     sc.c.xl5,
                     sc.c.uniq,
                     sc.c.worship,
@@ -370,22 +562,39 @@ class CsdcWeek:
             Game.account_id.label("account_id"), 
             Game.player_id.label("player_id"),
             Game.score.label("score"),
-#            type_coerce(self._sub40k(), Integer).label("sub40k"),
-            type_coerce(self._fifteenrune(), Integer).label("fifteenrune"),
-            type_coerce(self._zig(), Integer).label("zig"),
-            type_coerce(self._lowxlzot(), Integer).label("lowxlzot"),
-            type_coerce(self._nolairwin(), Integer).label("nolairwin"),
-            type_coerce(self._asceticrune(), Integer).label("asceticrune"),
-        ]).filter(Game.gid.in_(self.gids))
+            GameScore.fifteenrune.label("fifteenrune"),
+            GameScore.zig.label("zig"),
+            GameScore.lowxlzot.label("lowxlzot"),
+            GameScore.nolairwin.label("nolairwin"),
+            GameScore.asceticrune.label("asceticrune"),
+        ]).join(GameScore, GameScore.gid == Game.gid).filter(
+            GameScore.week == self.number, Game.gid.in_(self.gids))
 
 
     def sortedscorecard(self):
         return self.scorecard().group_by(CsdcContestant.player_id).order_by(desc("total"), desc("bonus"),
         desc(Game.score), Game.start)
 
+    def results(self):
+        """The rows of sortedscorecard, queried once per run."""
+        key = ("scorecard", self.number)
+        if key not in _results:
+            statement = _statement((self.number, "scorecard"),
+                    lambda: self.sortedscorecard().statement)
+            with get_session() as s:
+                _results[key] = _execute(s, statement).fetchall()
+        return _results[key]
+
 weeks = []
 
-def initialize_weeks():
+def initialize_weeks(eligibility="subquery"):
+    """Build the weeks. eligibility picks how their eligible games are
+    queried, see ELIGIBILITY.
+
+    This doesn't score anything, update_scores does that after an ingest."""
+    forget_results()
+    _statements.clear()
+    _compiled.clear()
     with get_session() as s:
         m2 = aliased(Milestone)
         runebranchlowskill = CsdcBonus("RuneBranchLowSkill",
@@ -687,7 +896,8 @@ def initialize_weeks():
                 start = datetime.datetime(2026,5,15, tzinfo=datetime.timezone.utc),
                 end = datetime.datetime(2026,5,22, tzinfo=datetime.timezone.utc),
                 bonus1 = orcendbeforexl11,
-                bonus2 = killhelllord))
+                bonus2 = killhelllord,
+                eligibility = eligibility))
 
         weeks.append(CsdcWeek(
                 number = "2",
@@ -698,7 +908,8 @@ def initialize_weeks():
                 start = datetime.datetime(2026,5,22, tzinfo=datetime.timezone.utc),
                 end = datetime.datetime(2026,5,29, tzinfo=datetime.timezone.utc),
                 bonus1 = lairendxl12,
-                bonus2 = goldenrune))
+                bonus2 = goldenrune,
+                eligibility = eligibility))
 
         weeks.append(CsdcWeek(
                 number = "3",
@@ -709,7 +920,8 @@ def initialize_weeks():
                 start = datetime.datetime(2026,5,29, tzinfo=datetime.timezone.utc),
                 end = datetime.datetime(2026,6,5, tzinfo=datetime.timezone.utc),
                 bonus1 = temple4k,
-                bonus2 = rune15k))
+                bonus2 = rune15k,
+                eligibility = eligibility))
 
         weeks.append(CsdcWeek(
                 number = "4",
@@ -720,7 +932,8 @@ def initialize_weeks():
                 start = datetime.datetime(2026,6,5, tzinfo=datetime.timezone.utc),
                 end = datetime.datetime(2026,6,12, tzinfo=datetime.timezone.utc),
                 bonus1 = floor10ofzig,
-                bonus2 = slimerune))
+                bonus2 = slimerune,
+                eligibility = eligibility))
         
         weeks.append(CsdcWeek(
                 number = "5",
@@ -731,7 +944,31 @@ def initialize_weeks():
                 start = datetime.datetime(2026,6,12, tzinfo=datetime.timezone.utc),
                 end = datetime.datetime(2026,6,19, tzinfo=datetime.timezone.utc),
                 bonus1 = treeformuniq,
-                bonus2 = vaultendxl18))                
+                bonus2 = vaultendxl18,
+                eligibility = eligibility))                
+
+
+def update_scores():
+    """Bring game_scores up to date with the games and weeks.
+
+    Weeks whose definition changed are scored again from scratch, the
+    others only for the games ingest marked dirty since the last update.
+    Games the rules haven't seen yet are replayed into the ledger first."""
+    forget_results()
+    with get_session() as s:
+        mark_dirty(s, rules.catch_up(s))
+        signatures = {w.week: w.signature for w in s.query(WeekSignature)}
+        s.query(GameScore).filter(~GameScore.week.in_(
+            [wk.number for wk in weeks])).delete(synchronize_session=False)
+        for wk in weeks:
+            signature = wk.signature()
+            if signatures.get(wk.number) != signature:
+                wk.update_scores(s)
+                s.merge(WeekSignature(week=wk.number, signature=signature))
+            else:
+                wk.update_scores(s, dirty=True)
+        s.query(DirtyGame).delete(synchronize_session=False)
+        s.commit()
 
 
 def all_games():
@@ -751,31 +988,52 @@ def onetimescorecard():
         type_coerce((func.sum(sc.c.asceticrune) > 0) * 7, Integer).label("asceticrune"),
         func.max(sc.c.score).label("hiscore")]).group_by(sc.c.player_id)
 
+def forget_results():
+    """Drop the scorecards and standings computed so far, for when the
+    scores or the weeks change."""
+    _results.clear()
+
+
 def overview():
-    q = Query(CsdcContestant)
-    sc = onetimescorecard().subquery()
-    q = q.outerjoin(sc, CsdcContestant.player_id == sc.c.player_id)
-    totalcols = []
-    wktotal = []
-    wkbonuses = []
-    for col in ("fifteenrune", "zig", "lowxlzot", "nolairwin", "asceticrune"):
-        totalcols.append(func.ifnull(getattr(sc.c, col), 0))
-        q = q.add_column(getattr(sc.c, col).label(col))
-    for wk in weeks:
-        a = wk.sortedscorecard().subquery()
-        totalcols.append(func.ifnull(a.c.total, 0))
-        wktotal.append(a.c.total)
-        wkbonuses.append(func.ifnull(a.c.bonusone, 0) + func.ifnull(a.c.bonustwo, 0))
-        q = q.outerjoin(a, CsdcContestant.player_id == a.c.player_id
-                ).add_columns( a.c.total.label("wk" + wk.number), a.c.gid.label("wk" + wk.number + "gid"))
-
-    return q.add_columns(
-            sc.c.account_id.label("account_id"),
-            sum(totalcols).label("grandtotal"),
-            sum(wkbonuses).label("tiebreak"),
-            sc.c.hiscore.label("hiscore"),
-            (func.coalesce(*wktotal) != None).label("played")
-        ).order_by(desc("grandtotal"),desc("tiebreak"),desc("hiscore"),desc("played"))
+    """The standings, a Standing per contestant, best first.
+
+    They're put together from each week's results and one query of the
+    one-time points, all computed once per run. weeks holds a WeekResult
+    per week, with None for the total and gid of a week not played."""
+    if "overview" in _results:
+        return _results["overview"]
+    with get_session() as s:
+        contestants = s.query(CsdcContestant.player_id, Player.name).join(
+                Player).order_by(CsdcContestant.player_id).all()
+        onetimes = {r.player_id: r for r in _execute(s, _statement(
+            "onetimes", lambda: onetimescorecard().statement))}
+    bests = [{r.player_id: r for r in wk.results()} for wk in weeks]
+
+    standings = []
+    for player_id, name in contestants:
+        ot = onetimes.get(player_id)
+        points = [getattr(ot, c) if ot else None for c in ONETIMES]
+        results = []
+        tiebreak = 0
+        for best in bests:
+            r = best.get(player_id)
+            results.append(WeekResult(r.total, r.gid) if r else
+                    WeekResult(None, None))
+            if r:
+                tiebreak += (r.bonusone or 0) + (r.bonustwo or 0)
+        standings.append(Standing(player_id, name,
+                ot.account_id if ot else None, results, *points,
+                grandtotal=sum(x or 0 for x in points) +
+                    sum(w.total or 0 for w in results),
+                tiebreak=tiebreak,
+                hiscore=ot.hiscore if ot else None,
+                played=any(w.total is not None for w in results)))
+
+    # as sql would: nulls are the least, sorting descending puts them last
+    standings.sort(key=lambda p: (p.grandtotal, p.tiebreak,
+        (p.hiscore is not None, p.hiscore or 0), p.played), reverse=True)
+    _results["overview"] = standings
+    return standings
 
 def current_week():
     now = datetime.datetime.now(datetime.timezone.utc)
@@ -784,4 +1042,10 @@ def current_week():
             return wk
     return None
 
+def ingest_filter(versions=()):
+    """A LineFilter keeping only lines of games that can score in some week.
+
+    initialize_weeks must have been called."""
+    return LineFilter([(wk.char, wk.start, wk.end) for wk in weeks], versions)
+
 divisions = [1]
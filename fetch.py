@@ -0,0 +1,433 @@
+"""Fetch logfiles and milestones over HTTP without leaving the process.
+
+A small asyncio HTTP/1.1 client: connections are kept alive and reused per
+host, at most a few requests run against a host at once, and a file we
+already have is continued with a Range request so only the new bytes cross
+the network. The Range carries an If-Range, so a remote file that was
+replaced comes back whole instead of as a tail of the wrong file. It speaks just enough HTTP for static files: Content-Length,
+chunked and read-until-close bodies, redirects, 206 and 416.
+
+Like the wget based downloader it replaces, a 404 or 403 leaves a zero-byte
+file behind and zero-byte files are never fetched again.
+
+With a FetchCache the ETag and Last-Modified of each URL are remembered and
+sent back, so a file that hasn't changed costs a 304 with no body.
+"""
+
+import asyncio
+import collections
+import logging
+import os
+import ssl
+import time
+import json
+import urllib.parse
+from typing import Callable, Optional, Sequence, Tuple
+
+PER_HOST = 2  # concurrent requests per host
+TIMEOUT = 10  # seconds to wait on any single network operation
+TRIES = 5
+MAX_REDIRECTS = 5
+BUFFER_SIZE = 1 << 16
+USER_AGENT = "csdc-scoreboard"
+
+
+class HTTPError(Exception):
+    pass
+
+
+class FetchCache:
+    """What we last heard about each URL, kept in a JSON file.
+
+    Entries are {"etag", "last_modified", "length", "checked"}: the
+    validators of the last response, the remote file's length then, and when
+    that was (unix time)."""
+
+    def __init__(self, path: Optional[str]=None):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logging.warning("Ignoring corrupt fetch cache {}".format(path))
+
+    def get(self, url: str) -> dict:
+        return self.entries.get(url, {})
+
+    def update(self, url: str, headers: dict, length: Optional[int]) -> None:
+        entry = self.entries.setdefault(url, {})
+        if "etag" in headers or "last-modified" in headers:
+            entry["etag"] = headers.get("etag")
+            entry["last_modified"] = headers.get("last-modified")
+        if length is not None:
+            entry["length"] = length
+        entry["checked"] = time.time()
+
+    def save(self) -> None:
+        if not self.path:
+            return
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def _remote_length(resp) -> Optional[int]:
+    """The full length of the remote file, as far as a response tells."""
+    total = resp.headers.get("content-range", "").rpartition("/")[2]
+    if total.isdigit():
+        return int(total)
+    if resp.status == 200 and resp.headers.get("content-length", "").isdigit():
+        return int(resp.headers["content-length"])
+    return None
+
+
+class _Response:
+    """A response whose body hasn't been read yet."""
+
+    def __init__(self, version, status, headers, conn, method):
+        self.status = status
+        self.headers = headers
+        self._conn = conn
+        self._method = method
+        connection = headers.get("connection", "").lower()
+        self.will_close = connection == "close" or (version == b"HTTP/1.0"
+                and connection != "keep-alive")
+
+    def _has_body(self):
+        return not (self._method == "HEAD" or self.status in (204, 304)
+                or 100 <= self.status < 200)
+
+    async def chunks(self):
+        """Yield the body, then hand the connection back for reuse."""
+        conn = self._conn
+        read = conn.read
+        if not self._has_body():
+            pass
+        elif "chunked" in self.headers.get("transfer-encoding", "").lower():
+            while True:
+                size = int((await read(conn.reader.readline())).split(b";")[0], 16)
+                if size == 0:
+                    while (await read(conn.reader.readline())) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                while size:
+                    data = await read(conn.reader.read(min(size, BUFFER_SIZE)))
+                    if not data:
+                        raise HTTPError("connection closed mid-chunk")
+                    size -= len(data)
+                    yield data
+                await read(conn.reader.readline())
+        elif "content-length" in self.headers:
+            left = int(self.headers["content-length"])
+            while left:
+                data = await read(conn.reader.read(min(left, BUFFER_SIZE)))
+                if not data:
+                    raise HTTPError("connection closed with {} bytes left".format(left))
+                left -= len(data)
+                yield data
+        else:
+            self.will_close = True
+            while True:
+                data = await read(conn.reader.read(BUFFER_SIZE))
+                if not data:
+                    break
+                yield data
+        self._conn = None
+        conn.release(reuse=not self.will_close)
+
+    async def discard(self):
+        async for _ in self.chunks():
+            pass
+
+    def close(self):
+        """Drop the connection if the body wasn't read to the end."""
+        if self._conn is not None:
+            self._conn.release(reuse=False)
+            self._conn = None
+
+
+class _Connection:
+    def __init__(self, host, reader, writer):
+        self.host = host
+        self.reader = reader
+        self.writer = writer
+
+    async def read(self, coro):
+        return await asyncio.wait_for(coro, self.host.timeout)
+
+    def release(self, reuse):
+        self.host.release(self, reuse)
+
+
+class _Host:
+    """The idle connections to one scheme://host:port and its request limit."""
+
+    def __init__(self, scheme, hostname, port, limit, timeout):
+        self.scheme = scheme
+        self.hostname = hostname
+        self.port = port
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(limit)
+        self.idle = []
+        self.deadline = None  # loop time its budget runs out
+
+    async def connect(self) -> Tuple[_Connection, bool]:
+        """An idle connection if there is one, else a new one. The bool says
+        if it was reused, and so might have been closed by the server."""
+        if self.idle:
+            return self.idle.pop(), True
+        ctx = ssl.create_default_context() if self.scheme == "https" else None
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            self.hostname, self.port, ssl=ctx, limit=BUFFER_SIZE), self.timeout)
+        return _Connection(self, reader, writer), False
+
+    def release(self, conn, reuse):
+        if reuse:
+            self.idle.append(conn)
+        else:
+            conn.writer.close()
+
+    def close(self):
+        for conn in self.idle:
+            conn.writer.close()
+        self.idle = []
+
+
+class Fetcher:
+    """Fetches files, reusing one connection pool per host.
+
+    With a budget, each host gets that many seconds from its first request
+    for all its files, retries included; whatever isn't done by then fails.
+
+    Files we had part of that had to be fetched whole again, because the
+    remote one was replaced, are added to replaced.
+
+    Use as an async context manager so the idle connections get closed."""
+
+    def __init__(self, per_host: int=PER_HOST, timeout: float=TIMEOUT,
+            tries: int=TRIES, cache: Optional[FetchCache]=None,
+            budget: Optional[float]=None, replaced: Optional[set]=None):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.tries = tries
+        self.budget = budget
+        self.cache = cache if cache is not None else FetchCache()
+        self.replaced = replaced if replaced is not None else set()
+        self._hosts = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        for host in self._hosts.values():
+            host.close()
+
+    def _host(self, url):
+        u = urllib.parse.urlsplit(url)
+        port = u.port or (443 if u.scheme == "https" else 80)
+        key = (u.scheme, u.hostname, port)
+        if key not in self._hosts:
+            self._hosts[key] = _Host(u.scheme, u.hostname, port,
+                    self.per_host, self.timeout)
+        return self._hosts[key]
+
+    async def request(self, method: str, url: str,
+            headers: Optional[dict]=None) -> _Response:
+        """Send a request and read the response head.
+
+        The caller must read the body with chunks() or discard(), or
+        close() the response. The host's request slot is not held here."""
+        host = self._host(url)
+        u = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(("", "", u.path or "/", u.query, ""))
+        head = {"Host": u.netloc, "User-Agent": USER_AGENT,
+                "Accept-Encoding": "identity"}
+        head.update(headers or {})
+        data = "{} {} HTTP/1.1\r\n{}\r\n".format(method, path, "".join(
+            "{}: {}\r\n".format(k, v) for k, v in head.items())).encode("latin-1")
+        while True:
+            conn, reused = await host.connect()
+            try:
+                conn.writer.write(data)
+                await conn.read(conn.writer.drain())
+                status_line = await conn.read(conn.reader.readline())
+                if not status_line:
+                    raise ConnectionResetError("connection closed")
+                version, status = status_line.split()[:2]
+                headers = {}
+                while True:
+                    line = await conn.read(conn.reader.readline())
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    k, _, v = line.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                return _Response(version, int(status), headers, conn, method)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.release(reuse=False)
+                if not reused:
+                    raise
+                # the server dropped an idle connection, try a fresh one
+            except BaseException:
+                conn.release(reuse=False)
+                raise
+
+    async def follow(self, url: str, headers: Optional[dict]=None) -> _Response:
+        """A GET request, following redirects."""
+        for _ in range(MAX_REDIRECTS + 1):
+            resp = await self.request("GET", url, headers)
+            if resp.status in (301, 302, 303, 307, 308) and "location" in resp.headers:
+                await resp.discard()
+                url = urllib.parse.urljoin(url, resp.headers["location"])
+                continue
+            return resp
+        resp.close()
+        raise HTTPError("too many redirects")
+
+    async def get(self, url: str, headers: Optional[dict]=None) -> Tuple[int, dict, bytes]:
+        """GET a small file into memory: (status, headers, body)."""
+        resp = await self.follow(url, headers)
+        try:
+            body = b"".join([data async for data in resp.chunks()])
+        finally:
+            resp.close()
+        return resp.status, resp.headers, body
+
+    async def fetch(self, url: str, dest: str) -> Optional[int]:
+        """Bring dest up to date with url, appending only new bytes.
+
+        Returns the number of bytes written, or None if the file couldn't be
+        fetched."""
+        if os.path.exists(dest) and os.stat(dest).st_size == 0:
+            return 0  # the source is assumed bad
+        host = self._host(url)
+        if self.budget is None:
+            return await self._tries(host, url, dest)
+        loop = asyncio.get_running_loop()
+        if host.deadline is None:
+            host.deadline = loop.time() + self.budget
+        try:
+            return await asyncio.wait_for(self._tries(host, url, dest),
+                    max(0, host.deadline - loop.time()))
+        except asyncio.TimeoutError:
+            logging.warning("Couldn't download {}: {} is over its {}s budget"
+                    .format(url, host.hostname, self.budget))
+            return None
+
+    async def _tries(self, host, url, dest):
+        async with host.slots:
+            for attempt in range(1, self.tries + 1):
+                try:
+                    return await self._fetch(url, dest)
+                except (OSError, asyncio.TimeoutError, HTTPError, ValueError) as e:
+                    logging.warning("Couldn't download {} (try {}/{}): {!r}".format(
+                        url, attempt, self.tries, e))
+        return None
+
+    async def _fetch(self, url, dest, resume=True):
+        size = os.path.getsize(dest) if resume and os.path.exists(dest) else 0
+        headers = {}
+        if size:
+            headers["Range"] = "bytes={}-".format(size)
+            cached = self.cache.get(url)
+            # only send the range if the remote file is still the one we have
+            # the start of, a weak ETag can't be used for that
+            etag = cached.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["If-Range"] = etag
+            elif cached.get("last_modified"):
+                headers["If-Range"] = cached["last_modified"]
+            # the validators are only good if we have all the file they're for
+            if cached.get("length") == size:
+                if cached.get("etag"):
+                    headers["If-None-Match"] = cached["etag"]
+                if cached.get("last_modified"):
+                    headers["If-Modified-Since"] = cached["last_modified"]
+        resp = await self.follow(url, headers)
+        try:
+            if resp.status == 304:
+                await resp.discard()
+                self.cache.update(url, resp.headers, size)
+                return 0
+            length = _remote_length(resp)
+            if resp.status == 206:
+                start = int(resp.headers.get("content-range", "bytes 0-")
+                        .split()[1].split("-")[0])
+                if start != size:
+                    raise HTTPError("asked for bytes {}-, got {}-".format(size, start))
+                written = await self._write(resp, dest, "ab")
+            elif resp.status == 416:
+                # nothing past our end. A remote file shorter than ours was
+                # rotated, get all of it
+                await resp.discard()
+                if length is not None and length < size:
+                    self.replaced.add(dest)
+                    return await self._fetch(url, dest, resume=False)
+                written = 0
+            elif resp.status == 200:
+                # the whole file again: the remote one changed under the
+                # If-Range, or the server ignores ranges. What we had of it
+                # is no good
+                if size:
+                    logging.info("{} was replaced, fetching all of it".format(url))
+                    self.replaced.add(dest)
+                written = await self._write(resp, dest, "wb")
+            elif resp.status in (403, 404):
+                await resp.discard()
+                logging.warning("Couldn't download {}: {}".format(url, resp.status))
+                # Write a zero-byte file so we don't try it again in future
+                open(dest, 'wb').close()
+                return None
+            else:
+                await resp.discard()
+                raise HTTPError("HTTP {}".format(resp.status))
+            self.cache.update(url, resp.headers, length)
+            return written
+        finally:
+            resp.close()
+
+    async def _write(self, resp, dest, mode):
+        """Stream a body to dest. A whole new file is written next to it and
+        moved into place at the end, so a failure leaves the old one."""
+        target = dest if mode == "ab" else dest + ".part"
+        written = 0
+        with open(target, mode) as f:
+            async for data in resp.chunks():
+                f.write(data)
+                written += len(data)
+        if target != dest:
+            os.replace(target, dest)
+        return written
+
+
+async def fetch_all(jobs: Sequence[Tuple[str, str]], per_host: int=PER_HOST,
+        timeout: float=TIMEOUT, tries: int=TRIES,
+        cache_file: Optional[str]=None,
+        done: Optional[Callable[[str, Optional[int]], None]]=None,
+        budget: Optional[float]=None, replaced: Optional[set]=None) -> dict:
+    """Fetch every (url, dest) in jobs concurrently. Returns {dest: bytes
+    written or None}; 0 means the file didn't change.
+
+    done, if given, is called with each dest and its result as soon as that
+    file is finished. budget is the seconds each host gets and replaced the
+    set that gets the files fetched whole again, see Fetcher."""
+    cache = FetchCache(cache_file)
+
+    async def one(fetcher, url, dest):
+        result = await fetcher.fetch(url, dest)
+        if done is not None:
+            done(dest, result)
+        return result
+
+    async with Fetcher(per_host, timeout, tries, cache, budget,
+            replaced) as fetcher:
+        results = await asyncio.gather(*[one(fetcher, url, dest)
+            for url, dest in jobs])
+    cache.save()
+    return collections.OrderedDict(zip((dest for _, dest in jobs), results))
+
+
+def download(jobs: Sequence[Tuple[str, str]], **kwargs) -> dict:
+    """Blocking fetch_all, for callers outside an event loop."""
+    return asyncio.run(fetch_all(jobs, **kwargs))
@@ -9,6 +9,7 @@ import web
 import time
 import datetime
 import postquell
+import metrics
 
 SOURCES_DIR = './sources'
 CONFIG_FILE = 'config.yml'
@@ -25,10 +26,23 @@ logging.basicConfig(level=logging_level)
 #logging.getLogger('sqlalchemy.engine').setLevel(logging_level)
 
 if __name__=='__main__':
-    orm.initialize(CONFIG['db uri'])
+    orm.initialize(CONFIG['db uri'], CONFIG.get('sqlite'), 'ingest')
     model.setup_database()
-    refresh.refresh(CONFIG['sources file'], SOURCES_DIR)
-    csdc.initialize_weeks()
+    csdc.initialize_weeks(CONFIG.get('eligibility', 'subquery'))
+    metrics.configure(CONFIG.get('ingest metrics', False),
+            CONFIG.get('ingest metrics file'))
+    line_filter = None
+    if CONFIG.get('ingest filter'):
+        line_filter = csdc.ingest_filter(CONFIG.get('ingest filter versions', ()))
+    refresh.refresh(CONFIG['sources file'], SOURCES_DIR,
+            workers=CONFIG.get('ingest workers', 1), line_filter=line_filter,
+            pipeline=CONFIG.get('ingest pipeline', False),
+            budget=CONFIG.get('fetch budget'),
+            backoff=CONFIG.get('fetch backoff', refresh.BACKOFF),
+            max_backoff=CONFIG.get('fetch max backoff', refresh.MAX_BACKOFF))
+    orm.analyze("milestones")
+    csdc.update_scores()
+    orm.use_profile('render')
     t_i = time.time()
     now = datetime.datetime.now(datetime.timezone.utc)
     oldmask = os.umask(18)
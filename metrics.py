@@ -0,0 +1,107 @@
+"""Counters and timers for the stages of a refresh.
+
+refresh keeps a Metrics per source file and emits them all at the end, as
+one structured log record per file on the "metrics" logger and optionally as
+JSON lines appended to a file.
+
+Collection is off unless configure() turns it on. While off, for_file()
+hands out a shared object whose methods do nothing, and nothing is called
+per line, so the cost is a few no-op calls per batch.
+"""
+
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import time
+from typing import Optional
+
+logger = logging.getLogger("metrics")
+
+enabled = False
+metrics_file = None  # type: Optional[str]
+_files = collections.OrderedDict()  # type: collections.OrderedDict
+
+
+class Metrics:
+    """Counts and seconds spent per stage for one source file.
+
+    Counts are things like lines, bytes and rows; times are per stage:
+    parse, resolve, add, insert, commit and, with parse workers, wait."""
+
+    def __init__(self, name: str=""):
+        self.name = name
+        self.counts = collections.Counter()
+        self.times = collections.defaultdict(float)
+
+    def count(self, key: str, n: int=1) -> None:
+        self.counts[key] += n
+
+    @contextlib.contextmanager
+    def timer(self, key: str):
+        t_i = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[key] += time.perf_counter() - t_i
+
+    def merge(self, other: "Metrics") -> None:
+        """Add in the metrics of a chunk, eg from a parse worker."""
+        self.counts.update(other.counts)
+        for k, v in other.times.items():
+            self.times[k] += v
+
+    def as_dict(self) -> dict:
+        d = {"file": self.name}
+        d.update(self.counts)
+        d.update(("{}_s".format(k), round(v, 6)) for k, v in self.times.items())
+        return d
+
+
+class _NullMetrics(Metrics):
+    """What for_file hands out while collection is off."""
+
+    def count(self, key, n=1):
+        pass
+
+    def timer(self, key):
+        return contextlib.nullcontext()
+
+    def merge(self, other):
+        pass
+
+
+_NULL = _NullMetrics()
+
+
+def configure(enable: bool, path: Optional[str]=None) -> None:
+    """Turn collection on or off, with an optional JSON lines file."""
+    global enabled, metrics_file
+    enabled = bool(enable)
+    metrics_file = path
+    _files.clear()
+
+
+def for_file(name: str) -> Metrics:
+    if not enabled:
+        return _NULL
+    if name not in _files:
+        _files[name] = Metrics(name)
+    return _files[name]
+
+
+def emit() -> None:
+    """Log, and write out, the metrics of every file since the last emit."""
+    if not _files:
+        return
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    records = [m.as_dict() for m in _files.values()]
+    _files.clear()
+    for r in records:
+        logger.info(" ".join("{}={}".format(k, v) for k, v in r.items()),
+                extra={"metrics": r})
+    if metrics_file:
+        with open(metrics_file, 'a') as f:
+            for r in records:
+                f.write(json.dumps(dict(r, time=now)) + "\n")
@@ -0,0 +1,103 @@
+"""Bring databases made by older versions up to date.
+
+Base.metadata.create_all creates missing tables with their indexes, and
+orm._add_missing_columns adds new nullable columns, but nothing changes what
+an existing table has beyond that. Each migration below does it for one
+change to orm.py. They run once each, in order, and the schema_version
+table records the ones applied. A database created from scratch already has
+everything and starts at the latest version.
+
+To add one, append (version, description, function) to MIGRATIONS. function
+gets a connection inside the migration's transaction and the metadata.
+"""
+
+import datetime
+import logging
+
+import sqlalchemy
+
+
+def _create_indexes(*names):
+    """A migration creating the indexes called names, as orm.py declares
+    them, unless they exist already."""
+    def migrate(conn, metadata):
+        inspector = sqlalchemy.inspect(conn)
+        for table in metadata.sorted_tables:
+            have = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in names and index.name not in have:
+                    logging.info("Creating index {}".format(index.name))
+                    index.create(conn)
+    return migrate
+
+
+def _backfill_progress(conn, metadata):
+    """Set the progress columns of the games from their milestones."""
+    games = metadata.tables["games"]
+    milestones = metadata.tables["milestones"]
+
+    def most(column):
+        return sqlalchemy.select([sqlalchemy.func.max(column)]).where(
+                milestones.c.gid == games.c.gid).as_scalar()
+
+    latest_place = sqlalchemy.select([milestones.c.place_id]).where(
+            milestones.c.gid == games.c.gid).order_by(
+            milestones.c.time.desc(), milestones.c.id.desc()).limit(1).as_scalar()
+    n = conn.execute(games.update().values(
+        max_xl=most(milestones.c.xl),
+        max_runes=most(milestones.c.runes),
+        max_gems=most(milestones.c.gems),
+        max_turn=most(milestones.c.turn),
+        last_milestone_time=most(milestones.c.time),
+        last_place_id=latest_place)).rowcount
+    logging.info("Set the progress of {} games".format(n))
+
+
+def _backfill_xl(conn, metadata):
+    """Set the xl of the games stored before it was kept."""
+    games = metadata.tables["games"]
+    milestones = metadata.tables["milestones"]
+    latest = sqlalchemy.select([milestones.c.xl]).where(
+            milestones.c.gid == games.c.gid).order_by(
+            milestones.c.time.desc(), milestones.c.id.desc()).limit(1).as_scalar()
+    n = conn.execute(games.update().where(games.c.xl == None).values(
+        xl=latest)).rowcount
+    logging.info("Set the xl of {} games".format(n))
+
+
+MIGRATIONS = [
+    (1, "indexes for the scoring queries", _create_indexes(
+        "ix_games_char_start",
+        "ix_milestones_gid_verb_place_turn")),
+    (2, "progress columns of the games", _backfill_progress),
+    (3, "xl of the games", _backfill_xl),
+]
+
+LATEST = MIGRATIONS[-1][0]
+
+
+def current_version(conn, table) -> int:
+    return conn.execute(sqlalchemy.select(
+        [sqlalchemy.func.max(table.c.version)])).scalar() or 0
+
+
+def upgrade(engine, model, fresh: bool=False) -> None:
+    """Apply the migrations the database hasn't had, each in its own
+    transaction.
+
+    model is the SchemaVersion class, fresh means the tables were all just
+    created."""
+    table = model.__table__
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with engine.begin() as conn:
+        version = current_version(conn, table)
+        if fresh and not version:
+            conn.execute(table.insert(), {"version": LATEST, "applied": now})
+            return
+    for number, description, migrate in MIGRATIONS:
+        if number <= version:
+            continue
+        logging.info("Applying migration {}: {}".format(number, description))
+        with engine.begin() as conn:
+            migrate(conn, model.metadata)
+            conn.execute(table.insert(), {"version": number, "applied": now})
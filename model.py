@@ -1,6 +1,6 @@
 """Defines the database models for this module."""
 
-import functools
+import collections
 import datetime
 from typing import Optional, Tuple, Callable, Sequence
 
@@ -12,10 +12,18 @@ from sqlalchemy import func, asc, desc
 
 import logging
 import modelutils
+from contextlib import contextmanager
 
 import constants as const
+import rules
 from orm import (
     Logfile,
+    SkippedRange,
+    ServerHealth,
+    GameScore,
+    DirtyGame,
+    Achievement,
+    RuleState,
     Server,
     Player,
     Species,
@@ -48,6 +56,13 @@ class DBIntegrityError(BaseException):
     pass
 
 
+class UnmatchedEnd(Exception):
+    """A game ended that hasn't begun, usually because the milestones file
+    with its begin is behind the logfile. Nothing of the event was queued."""
+
+    pass
+
+
 def _reraise_dberror(function: Callable) -> Callable:
     """Re-raise errors from decorated function as DBError or DBIntegrityError.
 
@@ -71,334 +86,314 @@ def _reraise_dberror(function: Callable) -> Callable:
     return f
 
 
-@functools.lru_cache(maxsize=16)
-def get_server(s: sqlalchemy.orm.session.Session, name: str) -> Server:
+class _Dimension:
+    """How to find rows of one lookup table by their natural key.
+
+    Attributes:
+        field: column holding the (first part of the) key, used to read back
+            rows after inserting them.
+        row_key: key of a row read from the table.
+        key: key of a value as passed to the get_* functions.
+        new: row to insert for a value that isn't in the table yet.
+    """
+
+    def __init__(self, field, row_key, new, key=lambda v: v):
+        self.field = field
+        self.row_key = row_key
+        self.key = key
+        self.new = new
+
+
+def _warn_new(kind: str, name: str) -> None:
+    logging.warning(
+        "Found new %s %s, please add me to constants.py"
+        " and update the database." % (kind, name)
+    )
+
+
+def _new_named(kind: Optional[str] = None) -> Callable:
+    def new(name):
+        if kind:
+            _warn_new(kind, name)
+        return {"name": name}
+    return new
+
+
+def _new_short(kind: str) -> Callable:
+    def new(short):
+        _warn_new(kind, short)
+        return {"short": short, "name": short}
+    return new
+
+
+def _new_branch(br: str) -> dict:
+    _warn_new("branch", br)
+    return {"short": br, "name": br, "multilevel": True}
+
+
+def _new_version(v: str) -> dict:
+    logging.info("Adding version '%s'" % v)
+    return {"v": v}
+
+
+_DIMENSIONS = {
+    Server: _Dimension("name", lambda r: r.name, _new_named()),
+    Player: _Dimension("name", lambda r: r.name.lower(),
+        _new_named(), key=lambda name: name.lower()),
+    Account: _Dimension("name",
+        lambda r: (r.name.lower(), r.server_id),
+        lambda v: {"name": v[0], "server_id": v[1], "player_id": v[2]},
+        key=lambda v: (v[0].lower(), v[1])),
+    Species: _Dimension("short", lambda r: r.short, _new_short("species")),
+    Background: _Dimension("short", lambda r: r.short,
+        _new_short("background")),
+    Unique: _Dimension("name", lambda r: r.name, _new_named("unique")),
+    God: _Dimension("name", lambda r: r.name, _new_named("god")),
+    Version: _Dimension("v", lambda r: r.v, _new_version),
+    Branch: _Dimension("short", lambda r: r.short, _new_branch),
+    Place: _Dimension("branch_id", lambda r: (r.branch_id, r.level),
+        lambda v: {"branch_id": v[0], "level": v[1]}),
+    Ktyp: _Dimension("name", lambda r: r.name, _new_named("ktyp")),
+    Verb: _Dimension("name", lambda r: r.name, _new_named("verb")),
+    Skill: _Dimension("name", lambda r: r.name, _new_named("skill")),
+}
+
+
+class DimensionRegistry:
+    """Process-wide in-memory copies of the lookup tables.
+
+    Each table is read once, the first time it is needed, into a map from its
+    natural key (eg a verb's name) to a plain row tuple. Lookups don't depend
+    on, or keep alive, the session that asked. Missing entries are inserted in
+    bulk and written through to the map.
+
+    A session is optional everywhere: without one, a session is only opened
+    when a table has to be read or written.
+    """
+
+    def __init__(self):
+        self._rows = {}  # type: dict
+        self._tuples = {}  # type: dict
+
+    def clear(self) -> None:
+        """Forget everything, eg after switching databases."""
+        self._rows = {}
+
+    @contextmanager
+    def _session(self, s: Optional[sqlalchemy.orm.session.Session]):
+        if s is not None:
+            yield s
+        else:
+            with get_session() as s:
+                yield s
+
+    def _row_tuple(self, cls):
+        if cls not in self._tuples:
+            self._tuples[cls] = collections.namedtuple(cls.__name__ + "Row",
+                    [c.key for c in cls.__table__.columns])
+        return self._tuples[cls]
+
+    def _read(self, s, cls, q) -> None:
+        rows = self._rows.setdefault(cls, {})
+        row_key = _DIMENSIONS[cls].row_key
+        Row = self._row_tuple(cls)
+        for r in q.with_session(s):
+            r = Row(*r)
+            rows[row_key(r)] = r
+
+    def table(self, s: Optional[sqlalchemy.orm.session.Session], cls) -> dict:
+        """The key -> row map of a lookup table."""
+        if cls not in self._rows:
+            with self._session(s) as s:
+                self._read(s, cls, sqlalchemy.orm.Query(list(cls.__table__.columns)))
+        return self._rows[cls]
+
+    def get(self, s: Optional[sqlalchemy.orm.session.Session], cls, value,
+            create: bool = True):
+        """Get the row for a value, creating it if needed (and allowed)."""
+        dim = _DIMENSIONS[cls]
+        row = self.table(s, cls).get(dim.key(value))
+        if row is None and create:
+            self.add(s, cls, [dim.new(value)])
+            row = self._rows[cls][dim.key(value)]
+        return row
+
+    def ensure(self, s: Optional[sqlalchemy.orm.session.Session], cls,
+            values) -> None:
+        """Create every value that is missing with a single insert."""
+        dim = _DIMENSIONS[cls]
+        rows = self.table(s, cls)
+        missing = {}
+        for v in values:
+            k = dim.key(v)
+            if k not in rows and k not in missing:
+                missing[k] = dim.new(v)
+        if missing:
+            self.add(s, cls, list(missing.values()))
+
+    def add(self, s: Optional[sqlalchemy.orm.session.Session], cls,
+            new: Sequence[dict]) -> None:
+        """Insert new rows and read them back (for their ids)."""
+        if not new:
+            return
+        field = cls.__table__.c[_DIMENSIONS[cls].field]
+        with self._session(s) as s:
+            s.bulk_insert_mappings(cls, new)
+            s.commit()
+            self._read(s, cls, sqlalchemy.orm.Query(list(cls.__table__.columns)
+                ).filter(field.in_({r[field.key] for r in new})))
+
+
+dimensions = DimensionRegistry()
+
+
+def get_server(s: Optional[sqlalchemy.orm.session.Session], name: str):
     """Get a server, creating it if needed."""
-    server = s.query(Server).filter(Server.name == name).first()
-    if server:
-        return server
-    else:
-        server = Server(name=name)
-        s.add(server)
-        s.commit()
-        return server
+    return dimensions.get(s, Server, name)
 
 
-@functools.lru_cache(maxsize=128)
-def get_account_id(s: sqlalchemy.orm.session.Session, name: str, server: Server) -> int:
+def get_account_id(s: Optional[sqlalchemy.orm.session.Session], name: str, server) -> int:
     """Get an account id, creating the account if needed.
 
     Note that player names are not case sensitive, so names are stored with
     their canonical capitalisation but we always compare the lowercase version.
     """
-    player_id = get_player_id(s, name)
-    acc = (
-        s.query(Account.id)
-        .filter(func.lower(Account.name) == name.lower(), Account.server == server)
-        .one_or_none()
-    )
-    if acc:
-        return acc[0]
-    else:
-        acc = Account(name=name, server=server, player_id=player_id)
-        s.add(acc)
-        s.commit()
-        return acc.id
+    return dimensions.get(s, Account, (name, server.id, get_player_id(s, name))).id
 
 
-@functools.lru_cache(maxsize=128)
 def get_player(s: sqlalchemy.orm.session.Session, name: str) -> Player:
     """Get a player's object, creating them if needed.
 
     Note that player names are not case sensitive, so names are stored with
     their canonical capitalisation but we always compare the lowercase version.
     """
-    player = (
-        s.query(Player).filter(func.lower(Player.name) == name.lower()).one_or_none()
-    )
-    if player:
-        return player
-    else:
-        return _add_player(s, name)
+    return s.query(Player).get(get_player_id(s, name))
 
 
-@functools.lru_cache(maxsize=128)
-def get_player_id(s: sqlalchemy.orm.session.Session, name: str, create=True) -> Player:
+def get_player_id(s: Optional[sqlalchemy.orm.session.Session], name: str, create=True) -> Optional[int]:
     """Get a player's id, creating them if needed.
 
     Note that player names are not case sensitive, so names are stored with
     their canonical capitalisation but we always compare the lowercase version.
     """
-    player = (
-        s.query(Player.id).filter(func.lower(Player.name) == name.lower()).one_or_none()
-    )
-    if player:
-        return player[0]
-    elif create:
-        return _add_player(s, name).id
-    else:
-        return None
+    player = dimensions.get(s, Player, name, create)
+    return player.id if player else None
 
 
-def _add_player(s, name: str) -> Player:
-    player = Player(name=name) 
-    s.add(player)
-    s.commit()
-    return player
+def _setup_dimension(s: sqlalchemy.orm.session.Session, cls, kind: str,
+        rows: Sequence[dict]) -> None:
+    """Insert the rows of a lookup table that aren't in the database yet."""
+    field = _DIMENSIONS[cls].field
+    known = dimensions.table(s, cls)
+    new = []
+    for row in rows:
+        if _DIMENSIONS[cls].key(row[field]) not in known:
+            logging.info("Adding %s '%s'" % (kind, row["name"]))
+            new.append(row)
+    dimensions.add(s, cls, new)
 
 
 def setup_species(s: sqlalchemy.orm.session.Session) -> None:
     """Load species data into the database."""
-    new = []
-    for sp in const.SPECIES:
-        if not s.query(Species).filter(Species.short == sp.short).first():
-            logging.info("Adding species '%s'" % sp.full)
-            new.append({"short": sp.short, "name": sp.full})
-    s.bulk_insert_mappings(Species, new)
-    s.commit()
+    _setup_dimension(s, Species, "species",
+            [{"short": sp.short, "name": sp.full} for sp in const.SPECIES])
 
 
 def setup_backgrounds(s: sqlalchemy.orm.session.Session) -> None:
     """Load background data into the database."""
-    new = []
-    for bg in const.BACKGROUNDS:
-        if not s.query(Background).filter(Background.short == bg.short).first():
-            logging.info("Adding background '%s'" % bg.full)
-            new.append({"short": bg.short, "name": bg.full})
-    s.bulk_insert_mappings(Background, new)
-    s.commit()
+    _setup_dimension(s, Background, "background",
+            [{"short": bg.short, "name": bg.full} for bg in const.BACKGROUNDS])
 
 
 def setup_uniques(s: sqlalchemy.orm.session.Session) -> None:
     """Load unique data into the database."""
-    new = []
-    for unique in const.UNIQUES:
-        if not s.query(Unique).filter(Unique.name == Unique.name).first():
-            logging.info("Adding Unique '%s'" % unique.name)
-            new.append({"name": unique.name})
-    s.bulk_insert_mappings(Unique, new)
-    s.commit()
+    _setup_dimension(s, Unique, "Unique",
+            [{"name": unique.name} for unique in const.UNIQUES])
 
 def setup_gods(s: sqlalchemy.orm.session.Session) -> None:
     """Load god data into the database."""
-    new = []
-    for god in const.GODS:
-        if not s.query(God).filter(God.name == god.name).first():
-            logging.info("Adding god '%s'" % god.name)
-            new.append({"name": god.name})
-    s.bulk_insert_mappings(God, new)
-    s.commit()
+    _setup_dimension(s, God, "god", [{"name": god.name} for god in const.GODS])
 
 
 def setup_ktyps(s: sqlalchemy.orm.session.Session) -> None:
     """Load ktyp data into the database."""
-    new = []
-    for ktyp in const.KTYPS:
-        if not s.query(Ktyp).filter(Ktyp.name == ktyp).first():
-            logging.info("Adding ktyp '%s'" % ktyp)
-            new.append({"name": ktyp})
-    s.bulk_insert_mappings(Ktyp, new)
-    s.commit()
+    _setup_dimension(s, Ktyp, "ktyp", [{"name": ktyp} for ktyp in const.KTYPS])
 
 
 def setup_verbs(s: sqlalchemy.orm.session.Session) -> None:
     """Load verb data into the database."""
-    new = []
-    for verb in const.VERBS:
-        if not s.query(Verb).filter(Verb.name == verb).first():
-            logging.info("Adding verb '%s'" % verb)
-            new.append({"name": verb})
-    s.bulk_insert_mappings(Verb, new)
-    s.commit()
+    _setup_dimension(s, Verb, "verb", [{"name": verb} for verb in const.VERBS])
 
 
 def setup_skills(s: sqlalchemy.orm.session.Session) -> None:
     """Load skill data into the database."""
-    new = []
-    for sk in const.SKILLS:
-        if not s.query(Skill).filter(Skill.name == sk).first():
-            logging.info("Adding skill '%s'" % sk)
-            new.append({"name": sk})
-    s.bulk_insert_mappings(Skill, new)
-    s.commit()
+    _setup_dimension(s, Skill, "skill", [{"name": sk} for sk in const.SKILLS])
 
 
-@functools.lru_cache(maxsize=32)
-def get_version(s: sqlalchemy.orm.session.Session, v: str) -> Version:
+def get_version(s: Optional[sqlalchemy.orm.session.Session], v: str):
     """Get a version, creating it if needed."""
-    version = s.query(Version).filter(Version.v == v).first()
-    if version:
-        return version
-    else:
-        logging.info("Adding version '%s'" % v)
-        version = Version(v=v)
-        s.add(version)
-        s.commit()
-        return version
+    return dimensions.get(s, Version, v)
 
 
 def setup_branches(s: sqlalchemy.orm.session.Session) -> None:
     """Load branch data into the database."""
-    new = []
-    for br in const.BRANCHES:
-        if not s.query(Branch).filter(Branch.short == br.short).first():
-            logging.info("Adding branch '%s'" % br.full)
-            new.append(
-                {
-                    "short": br.short,
-                    "name": br.full,
-                    "multilevel": br.multilevel,
-                }
-            )
-    s.bulk_insert_mappings(Branch, new)
-    s.commit()
+    _setup_dimension(s, Branch, "branch",
+            [{
+                "short": br.short,
+                "name": br.full,
+                "multilevel": br.multilevel,
+            } for br in const.BRANCHES])
 
 
-@functools.lru_cache(maxsize=256)
-def get_place(s: sqlalchemy.orm.session.Session, branch: Branch, lvl: int) -> Place:
+def get_place(s: Optional[sqlalchemy.orm.session.Session], branch, lvl: int):
     """Get a place, creating it if needed."""
-    place = s.query(Place).filter(Place.branch == branch, Place.level == lvl).first()
-    if place:
-        return place
-    else:
-        place = Place(branch=branch, level=lvl)
-        s.add(place)
-        s.commit()
-        return place
+    return dimensions.get(s, Place, (branch.id, int(lvl)))
 
 
-@functools.lru_cache(maxsize=256)
-def get_place_from_string(s: sqlalchemy.orm.session.Session, spot: str) -> Place:
+def get_place_from_string(s: Optional[sqlalchemy.orm.session.Session], spot: str):
     """Get a place in crawl Place:Lev string format"""
     code = spot.split(":") + [1]; # default to lvl 1 if missing 
     return get_place(s, get_branch(s, code[0]), int(code[1]));
 
 
-@functools.lru_cache(maxsize=64)
-def get_species(s: sqlalchemy.orm.session.Session, sp: str) -> Species:
+def get_species(s: Optional[sqlalchemy.orm.session.Session], sp: str):
     """Get a species by short code, creating it if needed."""
-    species = s.query(Species).filter(Species.short == sp).first()
-    if species:
-        return species
-    else:
-        species = Species(short=sp, name=sp)
-        s.add(species)
-        s.commit()
-        logging.warning(
-            "Found new species %s, please add me to constants.py"
-            " and update the database." % sp
-        )
-        return species
+    return dimensions.get(s, Species, sp)
 
 
-@functools.lru_cache(maxsize=64)
-def get_background(s: sqlalchemy.orm.session.Session, bg: str) -> Background:
+def get_background(s: Optional[sqlalchemy.orm.session.Session], bg: str):
     """Get a background by short code, creating it if needed."""
-    background = s.query(Background).filter(Background.short == bg).first()
-    if background:
-        return background
-    else:
-        background = Background(short=bg, name=bg)
-        s.add(background)
-        s.commit()
-        logging.warning(
-            "Found new background %s, please add me to constants.py"
-            " and update the database." % bg
-        )
-        return background
+    return dimensions.get(s, Background, bg)
 
 
-@functools.lru_cache(maxsize=32)
-def get_unique(s: sqlalchemy.orm.session.Session, name: str) -> Unique:
+def get_unique(s: Optional[sqlalchemy.orm.session.Session], name: str):
     """Get a unique by name, creating it if needed."""
-    god = s.query(Unique).filter(Unique.name == name).first()
-    if unique:
-        return unique
-    else:
-        unique = Unique(name=name)
-        s.add(unique)
-        s.commit()
-        logging.warning(
-            "Found new unique %s, please add me to constants.py"
-            " and update the database." % name
-        )
-        return unique
+    return dimensions.get(s, Unique, name)
 
 
-@functools.lru_cache(maxsize=32)
-def get_god(s: sqlalchemy.orm.session.Session, name: str) -> God:
+def get_god(s: Optional[sqlalchemy.orm.session.Session], name: str):
     """Get a god by name, creating it if needed."""
-    god = s.query(God).filter(God.name == name).first()
-    if god:
-        return god
-    else:
-        god = God(name=name)
-        s.add(god)
-        s.commit()
-        logging.warning(
-            "Found new god %s, please add me to constants.py"
-            " and update the database." % name
-        )
-        return god
+    return dimensions.get(s, God, name)
 
 
-@functools.lru_cache(maxsize=64)
-def get_ktyp(s: sqlalchemy.orm.session.Session, name: str) -> Ktyp:
+def get_ktyp(s: Optional[sqlalchemy.orm.session.Session], name: str):
     """Get a ktyp by name, creating it if needed."""
-    ktyp = s.query(Ktyp).filter(Ktyp.name == name).first()
-    if ktyp:
-        return ktyp
-    else:
-        ktyp = Ktyp(name=name)
-        s.add(ktyp)
-        s.commit()
-        logging.warning("Found new ktyp %s, please add me to constants.py" % name)
-        return ktyp
+    return dimensions.get(s, Ktyp, name)
 
 
-@functools.lru_cache(maxsize=64)
-def get_verb(s: sqlalchemy.orm.session.Session, name: str) -> Ktyp:
+def get_verb(s: Optional[sqlalchemy.orm.session.Session], name: str):
     """Get a verb/type by name, creating it if needed."""
-    verb = s.query(Verb).filter(Verb.name == name).first()
-    if verb:
-        return verb
-    else:
-        verb = Verb(name=name)
-        s.add(verb)
-        s.commit()
-        logging.warning("Found new verb %s, please add me to constants.py" % name)
-        return verb
+    return dimensions.get(s, Verb, name)
 
 
-@functools.lru_cache(maxsize=64)
-def get_branch(s: sqlalchemy.orm.session.Session, br: str) -> Branch:
+def get_branch(s: Optional[sqlalchemy.orm.session.Session], br: str):
     """Get a branch by short name, creating it if needed."""
-    branch = s.query(Branch).filter(Branch.short == br).first()
-    if branch:
-        return branch
-    else:
-        branch = Branch(short=br, name=br, multilevel=True)
-        s.add(branch)
-        s.commit()
-        logging.warning(
-            "Found new branch %s, please add me to constants.py"
-            " and update the database." % br
-        )
-        return branch
+    return dimensions.get(s, Branch, br)
 
 
-@functools.lru_cache(maxsize=64)
-def get_skill(s: sqlalchemy.orm.session.Session, name: str) -> Ktyp:
-    """Get a verb/type by name, creating it if needed."""
-    skill = s.query(Skill).filter(Skill.name == name).first()
-    if skill:
-        return skill
-    else:
-        skill = Skill(name=name)
-        s.add(skill)
-        s.commit()
-        logging.warning("Found new skill %s, please add me to constants.py" % name)
-        return skill
+def get_skill(s: Optional[sqlalchemy.orm.session.Session], name: str):
+    """Get a skill by name, creating it if needed."""
+    return dimensions.get(s, Skill, name)
 
 
 @_reraise_dberror
@@ -406,20 +401,274 @@ def add_games(s: sqlalchemy.orm.session.Session, games: Sequence[dict]) -> None:
     """Normalise and add multiple games to the database."""
     s.bulk_insert_mappings(Game, games)
 
+
+@_reraise_dberror
+def add_milestones(s: sqlalchemy.orm.session.Session, milestones: Sequence[dict]) -> None:
+    """Add multiple normalised milestones to the database.
+
+    Each mapping gets the "id" it was inserted with. Where the driver tells
+    the id of each insert (sqlite does) they go one by one through the
+    DBAPI cursor, which is faster than an executemany through SQLAlchemy."""
+    conn = s.connection()
+    if not conn.dialect.postfetch_lastrowid or not conn.dialect.positional:
+        s.bulk_insert_mappings(Milestone, milestones, return_defaults=True)
+        return
+    compiled = Milestone.__table__.insert().compile(dialect=conn.dialect,
+            column_keys=list(milestones[0]))
+    # the values go in as SQLAlchemy would bind them, eg times as sqlite's
+    # DATETIME stores them
+    params = [(key, compiled.binds[key].type.dialect_impl(conn.dialect)
+            .bind_processor(conn.dialect)) for key in compiled.positiontup]
+    cursor = conn.connection.cursor()
+    try:
+        for m in milestones:
+            cursor.execute(compiled.string, [m[key] if process is None
+                else process(m[key]) for key, process in params])
+            m["id"] = cursor.lastrowid
+    finally:
+        cursor.close()
+
+
+class OpenGameIndex:
+    """The gids of every game that hasn't ended yet.
+
+    Read once per process with one query on the indexed end column, then
+    kept up to date as games begin and end. Ending a game therefore needs no
+    lookup of its row: ends are written by primary key in bulk."""
+
+    def __init__(self):
+        self._gids = None  # type: Optional[set]
+
+    def clear(self) -> None:
+        self._gids = None
+
+    def gids(self, s: sqlalchemy.orm.session.Session) -> set:
+        if self._gids is None:
+            self._gids = {gid for gid, in s.query(Game.gid).filter(Game.end == None)}
+        return self._gids
+
+    def add(self, s: sqlalchemy.orm.session.Session, gid: str) -> None:
+        self.gids(s).add(gid)
+
+    def discard(self, s: sqlalchemy.orm.session.Session, gid: str) -> bool:
+        """Close a game. Returns False if it wasn't open."""
+        gids = self.gids(s)
+        if gid not in gids:
+            return False
+        gids.remove(gid)
+        return True
+
+
+open_games = OpenGameIndex()
+
+
+class EventBatch:
+    """A batch of normalised milestone events waiting to be written.
+
+    Foreign keys are resolved as events are added, then flush() writes all the
+    new games and all the milestones with a single executemany each, skipping
+    the ORM unit of work entirely. Events also go through the rules as they
+    are added, and what they met goes to the achievements ledger on flush.
+
+    XXX: DOES NOT COMMIT YOU MUST COMMIT (For speedy reasons)"""
+
+    def __init__(self):
+        self.games = []  # type: list
+        self.ends = []  # type: list
+        self.milestones = []  # type: list
+        self.ledger = rules.Ledger()
+
+    def __len__(self) -> int:
+        return len(self.milestones)
+
+    def resolve(self, s: sqlalchemy.orm.session.Session, events: Sequence[dict]) -> None:
+        """Create the lookup rows a run of events needs, one insert per table.
+
+        add() creates anything missing as it goes, this just saves a cold
+        ingest from inserting each new player, account and place on its own.
+        Events with missing fields are left for add() to complain about."""
+        values = collections.defaultdict(set)
+        gids = set()
+        for data in events:
+            try:
+                gids.add(_gid(data))
+                values[Branch].add(data["br"])
+                values[Branch].add(data["oplace"].split(":")[0])
+                values[God].add(data["god"])
+                values[Skill].add(data["sk"])
+                values[Verb].add(data["type"])
+                if "ktyp" in data:
+                    values[Ktyp].add(data["ktyp"])
+                if data["type"] == "begin":
+                    values[Server].add(data["src_abbr"])
+                    values[Player].add(data["name"])
+                    values[Species].add(data["char"][:2])
+                    values[Background].add(data["char"][2:])
+                    values[Version].add(data["v"])
+            except (KeyError, AttributeError, TypeError):
+                continue
+        for cls in (Branch, God, Skill, Verb, Ktyp, Server, Player, Species,
+                Background, Version):
+            dimensions.ensure(s, cls, values[cls])
+
+        places = set()
+        accounts = set()
+        branches = dimensions.table(s, Branch)
+        for data in events:
+            try:
+                places.add((branches[data["br"]].id, int(data["lvl"])))
+                code = data["oplace"].split(":") + [1]
+                places.add((branches[code[0]].id, int(code[1])))
+                if data["type"] == "begin":
+                    accounts.add((data["name"],
+                        get_server(s, data["src_abbr"]).id,
+                        get_player_id(s, data["name"])))
+            except (KeyError, AttributeError, TypeError, ValueError):
+                continue
+        dimensions.ensure(s, Place, places)
+        dimensions.ensure(s, Account, accounts)
+        self.ledger.load(s, gids)
+
+    def add(self, s: sqlalchemy.orm.session.Session, data: dict) -> None:
+        """Normalise an event and queue its rows.
+
+        Everything that can fail on a bad event is done before the open
+        games change, so a line that's rejected leaves them as they were."""
+        data["gid"] = _gid(data)
+        m = _milestone_mapping(s, data)
+        event = rules.event(data, m["time"])
+
+        if data["type"] == "begin":
+            self.games.append(_game_mapping(s, data))
+            open_games.add(s, data["gid"])
+        elif data["type"] == "death.final":
+            end = _end_mapping(s, data)
+            if not open_games.discard(s, data["gid"]):
+                raise UnmatchedEnd("No open game {}".format(data["gid"]))
+            self.ends.append(end)
+        self.ledger.add(s, data["gid"], event, len(self.milestones))
+        self.milestones.append(m)
+
+    def flush(self, s: sqlalchemy.orm.session.Session) -> None:
+        """Write the queued rows. Games go first so ends can find them."""
+        if self.games:
+            add_games(s, self.games)
+        if self.ends:
+            end_games(s, self.ends)
+        if self.milestones:
+            add_milestones(s, self.milestones)
+            mark_dirty(s, {m["gid"] for m in self.milestones})
+            self.ledger.write(s, [m["id"] for m in self.milestones])
+            update_progress(s, self.milestones)
+        self.games = []
+        self.ends = []
+        self.milestones = []
+
+
 @_reraise_dberror
 def add_event(s: sqlalchemy.orm.session.Session, data: dict) -> None:
     """Normalise and add a milestone event.
+
+    The game's rule state is dropped, rules.catch_up replays it later.
     
     XXX: DOES NOT COMMIT YOU MUST COMMIT (For speedy reasons)"""
-    data["gid"] = "%s:%s:%s" % (data["name"], data["src_abbr"], data["start"])
+    data["gid"] = _gid(data)
 
     if data["type"] == "begin":
         _new_game(s, data)
     elif data["type"] == "death.final":
         _end_game(s, data)
-    
+
+    m = _milestone_mapping(s, data)
+    s.add(Milestone(**m))
+    s.merge(DirtyGame(gid=data["gid"]))
+    s.flush()
+    update_progress(s, [m])
+    s.query(RuleState).filter(RuleState.gid == data["gid"]).delete(
+            synchronize_session=False)
+
+
+def _int(v) -> int:
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return 0
+
+
+_game_table = Game.__table__
+
+
+def _most(column, name: str):
+    """The larger of column and the parameter name, the parameter if column
+    is null."""
+    param = sqlalchemy.bindparam(name, type_=column.type)
+    return sqlalchemy.case([(column >= param, column)], else_=param)
+
+
+def _latest(column, name: str):
+    """The parameter name, unless the game already has a milestone later
+    than the one it's from. Then column stays as it is."""
+    return sqlalchemy.case([(_game_table.c.last_milestone_time >
+            sqlalchemy.bindparam("p_time", type_=_game_table.c.last_milestone_time.type),
+            column)], else_=sqlalchemy.bindparam(name, type_=column.type))
+
+
+# the parameters can't be named after the columns they set. Every CASE sees
+# the row as it was, so the latest ones compare against the old time
+_progress = _game_table.update().where(
+        _game_table.c.gid == sqlalchemy.bindparam("p_gid")).values(
+    xl=_latest(_game_table.c.xl, "p_xl"),
+    max_xl=_most(_game_table.c.max_xl, "p_max_xl"),
+    max_runes=_most(_game_table.c.max_runes, "p_max_runes"),
+    max_gems=_most(_game_table.c.max_gems, "p_max_gems"),
+    max_turn=_most(_game_table.c.max_turn, "p_max_turn"),
+    last_milestone_time=_most(_game_table.c.last_milestone_time, "p_time"),
+    last_place_id=_latest(_game_table.c.last_place_id, "p_place_id"))
+
+
+def update_progress(s: sqlalchemy.orm.session.Session, milestones: Sequence[dict]) -> None:
+    """Bring the progress columns of the games of some new milestone
+    mappings up to date, with one executemany. Doesn't commit.
+
+    Like the backfill in migrations, the xl and place are those of a game's
+    latest milestone by time, whatever order the milestones come in; of
+    milestones at the same time the last one wins."""
+    progress = {}
+    for m in milestones:
+        # the mappings hold the logfile's strings, the columns convert them
+        most = {"p_max_" + k: _int(m[k])
+                for k in ("xl", "runes", "gems", "turn")}
+        p = progress.setdefault(m["gid"], dict(most, p_gid=m["gid"],
+            p_time=m["time"]))
+        for k, v in most.items():
+            p[k] = max(p[k], v)
+        if m["time"] >= p["p_time"]:
+            p["p_xl"] = m["xl"]
+            p["p_time"] = m["time"]
+            p["p_place_id"] = m["place_id"]
+    if progress:
+        s.execute(_progress, list(progress.values()))
+
+
+def _gid(data: dict) -> str:
+    return "%s:%s:%s" % (data["name"], data["src_abbr"], data["start"])
+
+
+def mark_dirty(s: sqlalchemy.orm.session.Session, gids: set) -> None:
+    """Mark games as needing their scores recomputed. Doesn't commit."""
+    gids = set(gids)
+    ordered = sorted(gids)
+    for i in range(0, len(ordered), rules.CHUNK_SIZE):
+        gids.difference_update(gid for gid, in s.query(DirtyGame.gid).filter(
+            DirtyGame.gid.in_(ordered[i:i + rules.CHUNK_SIZE])))
+    if gids:
+        s.bulk_insert_mappings(DirtyGame, [{"gid": gid} for gid in gids])
+
+
+def _milestone_mapping(s: sqlalchemy.orm.session.Session, data: dict) -> dict:
+    """Resolve the foreign keys of a milestone event into a row mapping."""
     branch = get_branch(s, data["br"])
-    m = {
+    return {
         "gid"      : data["gid"],
         "xl"       : data["xl"],
         "place_id" : get_place(s, branch, data["lvl"]).id,
@@ -439,16 +688,18 @@ def add_event(s: sqlalchemy.orm.session.Session, data: dict) -> None:
         "status"   : data["status"],
     }
 
-    s.add(Milestone(**m))
-
 
 @_reraise_dberror
 def _new_game(s: sqlalchemy.orm.session.Session, data:dict) -> None:
     """Create a game row on game begin."""
+    s.add(Game(**_game_mapping(s, data)))
+    open_games.add(s, data["gid"])
 
-    branch = get_branch(s, data["br"])
+
+def _game_mapping(s: sqlalchemy.orm.session.Session, data: dict) -> dict:
+    """Resolve the foreign keys of a game begin event into a row mapping."""
     server = get_server(s, data["src_abbr"])
-    g = {
+    return {
         "gid": data["gid"],
         "account_id": get_account_id(s, data["name"], server),
         "player_id": get_player_id(s, data["name"]),
@@ -458,24 +709,34 @@ def _new_game(s: sqlalchemy.orm.session.Session, data:dict) -> None:
         "start": modelutils.crawl_date_to_datetime(data["start"])
     }
 
-    s.add(Game(**g))
+
+@_reraise_dberror
+def end_games(s: sqlalchemy.orm.session.Session, ends: Sequence[dict]) -> None:
+    """Write the end of multiple games, by gid, in one executemany."""
+    s.bulk_update_mappings(Game, ends)
+
+
+def _end_mapping(s: sqlalchemy.orm.session.Session, data: dict) -> dict:
+    """The columns set on a game when it ends."""
+    dam = data.get("dam", 0)
+    return {
+        "gid": data["gid"],
+        "end": modelutils.crawl_date_to_datetime(data["end"]),
+        "ktyp_id": get_ktyp(s, data["ktyp"]).id,
+        "score": data["sc"],
+        "dam": dam,
+        "tdam": data.get("tdam", dam),
+        "sdam": data.get("sdam", dam),
+    }
 
 
 @_reraise_dberror
 def _end_game(s: sqlalchemy.orm.session.Session, data:dict) -> None:
-    g = _games(s, gid=data["gid"]).first()
-#    print(data)
-#    print(data["gid"])
-#    print(_games(s, gid=data["gid"]))
-#    print(_games(s, gid=data["gid"]).first())
-#    print(g)
-    g.end = modelutils.crawl_date_to_datetime(data["end"])
-    g.ktyp = get_ktyp(s, data["ktyp"])
-    g.score = data["sc"]
-    g.dam = data.get("dam", 0)
-    g.tdam = data.get("tdam", g.dam)
-    g.sdam = data.get("sdam", g.dam)
-    
+    g = s.query(Game).get(data["gid"])
+    for column, value in _end_mapping(s, data).items():
+        setattr(g, column, value)
+    open_games.discard(s, data["gid"])
+
 
 def get_logfile_progress(
     s: sqlalchemy.orm.session.Session, url: str
@@ -502,6 +763,79 @@ def save_logfile_progress(
     s.add(log)
 
 
+def get_server_health(
+    s: sqlalchemy.orm.session.Session, names: Sequence[str]
+) -> dict:
+    """Get {name: ServerHealth} for the servers, creating records as needed."""
+    health = {h.name: h for h in
+            s.query(ServerHealth).filter(ServerHealth.name.in_(names))}
+    for name in names:
+        if name not in health:
+            health[name] = ServerHealth(name=name, failures=0)
+            s.add(health[name])
+    s.commit()
+    return health
+
+
+def get_milestones_read_until(
+    s: sqlalchemy.orm.session.Session, server_name: str
+) -> Optional[datetime.datetime]:
+    """Get the time of the latest milestone read from a server's milestones
+    file. Game ends are left out, they come from its logfile."""
+    server = get_server(s, server_name)
+    return s.query(func.max(Milestone.time)).join(
+            Game, Milestone.gid == Game.gid).join(
+            Account, Game.account_id == Account.id).filter(
+            Account.server_id == server.id,
+            Milestone.verb_id != get_verb(s, "death.final").id).scalar()
+
+
+def get_stale_skipped_ranges(
+    s: sqlalchemy.orm.session.Session, url: str, filter_key: Optional[str]
+) -> Sequence[SkippedRange]:
+    """Get the skipped ranges of a logfile that filter_key might keep.
+
+    That's every range skipped by a different filter, or all of them when
+    there is no filter. They are returned in file order."""
+    q = s.query(SkippedRange).filter(SkippedRange.source_url == url)
+    if filter_key is not None:
+        q = q.filter(SkippedRange.filter_key != filter_key)
+    return q.order_by(SkippedRange.start).all()
+
+
+def discard_source(
+    s: sqlalchemy.orm.session.Session, src: str, logfiles: Sequence[Logfile]
+) -> None:
+    """Forget everything read from a source so its files are read again.
+
+    Deletes the source's games, their milestones, achievements and scores
+    and rewinds logfiles, which should be all the source's files, to the
+    start. Commits."""
+    server = get_server(s, src)
+    gids = s.query(Game.gid).join(Account, Game.account_id == Account.id
+            ).filter(Account.server_id == server.id).subquery()
+    for cls in (Achievement, RuleState, Milestone, GameScore, DirtyGame):
+        s.query(cls).filter(cls.gid.in_(gids)).delete(
+                synchronize_session=False)
+    s.query(Game).filter(Game.gid.in_(gids)).delete(synchronize_session=False)
+    for log in logfiles:
+        s.query(SkippedRange).filter(
+                SkippedRange.source_url == log.source_url).delete(
+                synchronize_session=False)
+        log.current_key = 0
+        log.size = log.inode = log.mtime = log.checksum = None
+    s.commit()
+    open_games.clear()
+
+
+def add_skipped_ranges(
+    s: sqlalchemy.orm.session.Session, ranges: Sequence[dict]
+) -> None:
+    """Record byte ranges the ingest filter skipped. Doesn't commit."""
+    if ranges:
+        s.bulk_insert_mappings(SkippedRange, ranges)
+
+
 def list_accounts(
     s: sqlalchemy.orm.session.Session, *, blacklisted: Optional[bool] = None
 ) -> Sequence[Account]:
@@ -526,19 +860,23 @@ def list_players(s: sqlalchemy.orm.session.Session) -> Sequence[Player]:
     return q.all()
 
 @_reraise_dberror
-def add_contestant(s: sqlalchemy.orm.session.Session, name: str) -> None:
-    """Add a Csdc Contestant"""
+def add_contestant(s: sqlalchemy.orm.session.Session, name: str) -> bool:
+    """Add a Csdc Contestant.
+
+    Returns False if there's no such player yet, True if they're a
+    contestant now."""
     pid = get_player_id(s, name, False)
     if pid is None:
-        return;
+        return False
 
     c = s.query(CsdcContestant).filter(CsdcContestant.player_id == pid).one_or_none()
 
     if c:
-        return;
+        return True
     else:
         s.add(CsdcContestant(player_id = get_player_id(s, name),division = 1))
         s.commit()
+        return True
 
 
 def _generic_char_type_lister(
@@ -697,6 +1035,8 @@ def count_games(
     ).count()
 
 def setup_database():
+    dimensions.clear()
+    open_games.clear()
     with get_session() as sess:
         if os.environ.get('SCOREBOARD_SKIP_DB_SETUP') == None:
             setup_species(sess)
@@ -708,6 +1048,7 @@ def setup_database():
             setup_verbs(sess)
             setup_skills(sess)
 
+
 def get_game(s: sqlalchemy.orm.session.Session, **kwargs: dict) -> Game:
     """Get a single game. See get_games docstring/type signature."""
     kwargs.setdefault("limit", 1)  # type: ignore
@@ -1,25 +1,55 @@
 """Utility functions for the model."""
 
 import re
+import hashlib
 import logging
+import itertools
+import operator
 import datetime
 from typing import Optional
 
 import orm
 import constants as const
 
-def logline_to_dict(logline: str) -> dict:
-    """Convert a logline into a sanitized dict"""
+# Crawl escapes ':' inside values as '::'. Lines with a run of three or more
+# colons are ambiguous to split by hand, those take the slow regex path.
+_ESCAPED_COLON = "\x01"
+_FIELD_SPLIT = re.compile('(?<!:):(?!:)')
+_VERSION = re.compile(r"(0.\d+)")
+_VERSION_BYTES = re.compile(rb"(0.\d+)")
+# D:0 is D:$ in logfile so we came from D:1 in that case
+_OPLACE_FIXUP = str.maketrans("$", "1")
+
+
+def _logline_fields(logline: str) -> dict:
+    """Build the raw key: value dict for a logline.
+
+    The common case, where every field is exactly one key=value, is a handful
+    of C-level string operations over the whole line: split on the single
+    colons, unescape, then split every key from its value at once. Anything
+    unusual falls back to splitting field by field."""
+    line = logline.strip().strip('\0')
+    if not (":::" in line or _ESCAPED_COLON in line or "\n" in line):
+        pairs = line.replace('::', _ESCAPED_COLON).split(':')
+        if (line.count('=') == len(pairs)
+                and all(map(operator.contains, pairs, itertools.repeat('=')))):
+            parts = "\n".join(pairs).replace(_ESCAPED_COLON, ':').replace('=', '\n').split('\n')
+            return dict(zip(parts[::2], parts[1::2]))
+
     data = {}
-    pairs = re.split('(?<!:):(?!:)', logline.strip().strip('\0'))
-    for p in pairs:
-        p = p.replace('::',':')
-        keyval = p.split('=')
+    for p in _FIELD_SPLIT.split(line):
+        keyval = p.replace('::', ':').split('=')
         try:
             data[keyval[0]] = keyval[1]
         except IndexError as e:
             logging.error('error "{}" in keyval "{}", logline "{}"'.format(e,keyval,logline))
-    data["v"] = re.match(r"(0.\d+)", data["v"]).group()
+    return data
+
+
+def logline_to_dict(logline: str) -> dict:
+    """Convert a logline into a sanitized dict"""
+    data = _logline_fields(logline)
+    data["v"] = _VERSION.match(data["v"]).group()
     if "god" not in data:
         data["god"] = "GOD_NO_GOD"
 
@@ -38,9 +68,9 @@ def logline_to_dict(logline: str) -> dict:
     data["gems"] = data.get("fgem", 0)
 
     data["runes"] = data.get("urune", 0)
-    # D:0 is D:$ in logfile so we came from D:1 in that case
-    data["oplace"] = data.get("oplace",
-            data["place"].translate(str.maketrans("$", "1")))
+    place = data["place"]
+    if "oplace" not in data:
+        data["oplace"] = place.translate(_OPLACE_FIXUP)
 
     return data
 
@@ -62,6 +92,77 @@ def crawl_date_to_datetime(d: str) -> datetime.datetime:
     )
 
 
+def datetime_to_crawl_date(dt: datetime.datetime) -> str:
+    """The inverse of crawl_date_to_datetime, without the S/D suffix."""
+    return "%04d%02d%02d%02d%02d%02d" % (dt.year, dt.month - 1, dt.day,
+            dt.hour, dt.minute, dt.second)
+
+
+def _field_values(line: bytes, key: bytes):
+    """Every value that might belong to the field key in a raw logline.
+
+    This doesn't unescape anything, so an escaped "::key=" inside another
+    value is a candidate too; callers must only use it to keep lines."""
+    i = line.find(key)
+    while i >= 0:
+        if i == 0 or line[i - 1] == 58:  # ':'
+            start = i + len(key)
+            end = line.find(b':', start)
+            yield line[start:end if end >= 0 else len(line)].rstrip(b'\r\n\0')
+        i = line.find(key, i + 1)
+
+
+class LineFilter:
+    """A cheap test for whether a raw logline can matter to the tournament.
+
+    Lines are checked with byte searches for their v=, char= and start=
+    fields before any parsing. A line is only rejected when its fields are
+    present and none of them match, so anything odd is left to the parser.
+
+    Parameters:
+        windows: (char, start, end) tuples, eg ("DECj", week.start,
+            week.end). A game is kept if start <= game start < end for one of
+            the windows of its char.
+        versions: major versions to keep, eg ["0.34"]. Empty keeps all.
+    """
+
+    def __init__(self, windows, versions=()):
+        self.windows = {}
+        for char, start, end in windows:
+            self.windows.setdefault(char.encode(), []).append(
+                (datetime_to_crawl_date(start).encode(),
+                 datetime_to_crawl_date(end).encode()))
+        self.versions = frozenset(v.encode() for v in versions)
+        # identifies the filter in the skipped ranges it leaves behind
+        self.key = hashlib.sha1(repr((sorted(self.windows.items()),
+            sorted(self.versions))).encode()).hexdigest()
+
+    def _version_ok(self, line: bytes) -> bool:
+        found = False
+        for v in _field_values(line, b'v='):
+            m = _VERSION_BYTES.match(v)
+            if m is None or m.group() in self.versions:
+                return True
+            found = True
+        return not found
+
+    def __call__(self, line: bytes) -> bool:
+        if self.versions and not self._version_ok(line):
+            return False
+        chars = list(_field_values(line, b'char='))
+        if not chars:
+            return True
+        starts = [s[:14] for s in _field_values(line, b'start=')]
+        if not starts:
+            return True
+        for c in chars:
+            for lo, hi in self.windows.get(c, ()):
+                for s in starts:
+                    if lo <= s < hi:
+                        return True
+        return False
+
+
 def _morgue_prefix(src: str, version: str) -> Optional[str]:
     src = src.lower()
     if src == "cao":
@@ -102,14 +203,20 @@ def _morgue_prefix(src: str, version: str) -> Optional[str]:
 
 def morgue_url(game: orm.Game) -> Optional[str]:
     """Generates a morgue URL from a game."""
-    src = game.account.server.name
-    prefix = _morgue_prefix(src, game.version.v)
-    if not prefix or game.alive:
+    return game_morgue_url(game.account.server.name, game.version.v,
+            game.account.name, game.end)
+
+
+def game_morgue_url(server: str, version: str, account: str,
+        end: Optional[datetime.datetime]) -> Optional[str]:
+    """Generates a morgue URL from the fields of a game, without loading it.
+    end is None for an ongoing game, which has no morgue yet."""
+    prefix = _morgue_prefix(server, version)
+    if not prefix or end is None:
         return None
 
-    name = game.account.name
-    timestamp = game.end.strftime("%Y%m%d-%H%M%S")
-    return "%s/%s/morgue-%s-%s.txt" % (prefix, name, name, timestamp)
+    timestamp = end.strftime("%Y%m%d-%H%M%S")
+    return "%s/%s/morgue-%s-%s.txt" % (prefix, account, account, timestamp)
 
 
 def version_url(version: str) -> str:
@@ -1,45 +1,130 @@
-import multiprocessing
+"""Download the morgues of the scored games of each week.
+
+A game's morgue can't change once it has ended, so each one is fetched once.
+What was fetched is kept in a manifest in the morgue dir, keyed by morgue
+URL, and a morgue already in another week's directory is linked rather than
+downloaded again. Morgues the server didn't have are tried again after
+RETRY_MISSING.
+"""
+
+import asyncio
+import json
 import os
-import sys
-import subprocess
+import shutil
+import time
 import logging
-import shlex
+from typing import Optional, Sequence
+
+import fetch
+from modelutils import game_morgue_url
+
+SIMULTANEOUS_DOWNLOADS = 10  # across all servers
+PER_HOST = 4
+MANIFEST = 'manifest.json'
+RETRY_MISSING = 24 * 60 * 60  # seconds
+
+
+class MorgueStore:
+    """The manifest of a morgue dir: {url: {"file": path relative to the
+    dir}} for morgues we have, {url: {"missing": unix time}} for those the
+    server didn't have when we last asked."""
+
+    def __init__(self, morguedir: str):
+        self.morguedir = morguedir
+        self.path = os.path.join(morguedir, MANIFEST)
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
 
-import csdc
-import orm
-from modelutils import morgue_url
+    def _file(self, url):
+        entry = self.entries.get(url, {})
+        if "file" in entry:
+            path = os.path.join(self.morguedir, entry["file"])
+            if os.path.exists(path):
+                return path
+        return None
 
-SIMULTANEOUS_DOWNLOADS = 10
-WGET_NAME = 'wget'
-WGET_MORGUE_CMDLINE = ("%s --no-verbose --timestamping -P '{prefix}' '{url}'" % WGET_NAME)
+    def wanted(self, url: str, dest: str) -> bool:
+        """Check if url has to be downloaded to dest, linking it there if
+        it's already in another week."""
+        if os.path.exists(dest) and os.path.getsize(dest):
+            # eg downloaded before there was a manifest
+            self.have(url, dest)
+            return False
+        have = self._file(url)
+        if have is not None:
+            try:
+                os.link(have, dest)
+            except OSError:
+                shutil.copyfile(have, dest)
+            return False
+        missing = self.entries.get(url, {}).get("missing")
+        return missing is None or time.time() - missing > RETRY_MISSING
 
-def download_morgue_file(url: str, dest: str) -> None:
-   logging.debug("Downloading morgues")
-   cmdline = shlex.split(WGET_MORGUE_CMDLINE.format(prefix=dest, url=url))
-   logging.debug("Executing subprocess: {}".format(cmdline))
-   p = subprocess.run(cmdline,
-                      stdout=subprocess.PIPE,
-                      stderr=subprocess.PIPE)
-   if p.returncode:
-       logging.warning("Couldon't download {}. Error: {}".format(url, p.stderr))
+    def have(self, url: str, dest: str) -> None:
+        self.entries[url] = {"file": os.path.relpath(dest, self.morguedir)}
 
-def download_morgues(week, morguedir) -> None:
-    dest = os.path.join(morguedir, week.number)
+    def record(self, url: str, dest: str, result: Optional[int]) -> None:
+        if result:
+            self.have(url, dest)
+        elif os.path.exists(dest) and os.path.getsize(dest) == 0:
+            # the fetcher leaves an empty file for a 404/403
+            os.remove(dest)
+            self.entries[url] = {"missing": time.time()}
 
-    if not os.path.exists(dest):
-        os.mkdir(dest)
+    def save(self) -> None:
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
 
+
+def week_morgue_urls(week) -> list:
+    """The morgue URLs of the week's scored games that have ended, leaving
+    out servers without morgues."""
     urls = []
-    with orm.get_session() as s:
-        for g in week.sortedscorecard().with_session(s).all():
-            if g.Game is not None and g.Game.ktyp is not None:
-                urls.append(morgue_url(g.Game))
-	
-    p = multiprocessing.Pool(SIMULTANEOUS_DOWNLOADS)
-    jobs = []
-    for url in urls:
-        jobs.append(p.apply_async(download_morgue_file, (url, dest)))
-    for job in jobs:
-        job.get()
-    p.close()
-    p.join()
+    for g in week.results():
+        if g.gid is not None and g.ktyp is not None:
+            url = game_morgue_url(g.server, g.version, g.account, g.end)
+            if url is not None:
+                urls.append(url)
+    return urls
+
+
+async def _download_all(jobs, store):
+    limit = asyncio.Semaphore(SIMULTANEOUS_DOWNLOADS)
+
+    async def one(fetcher, url, dest):
+        async with limit:
+            result = await fetcher.fetch(url, dest)
+        store.record(url, dest, result)
+
+    async with fetch.Fetcher(per_host=PER_HOST) as fetcher:
+        await asyncio.gather(*[one(fetcher, url, dest) for url, dest in jobs])
+
+
+def download_morgues(weeks: Sequence, morguedir: str) -> None:
+    """Download the morgues of the weeks' games that we don't have yet,
+    each into its week's directory."""
+    if not os.path.exists(morguedir):
+        os.mkdir(morguedir)
+    store = MorgueStore(morguedir)
+    jobs = {}
+    later = []  # morgues of more than one week, linked once downloaded
+    for week in weeks:
+        dest = os.path.join(morguedir, week.number)
+        if not os.path.exists(dest):
+            os.mkdir(dest)
+        for url in week_morgue_urls(week):
+            path = os.path.join(dest, url.rsplit('/', 1)[1])
+            if url in jobs:
+                if jobs[url] != path:
+                    later.append((url, path))
+            elif store.wanted(url, path):
+                jobs[url] = path
+    logging.info("Downloading {} new morgues".format(len(jobs)))
+    if jobs:
+        asyncio.run(_download_all(list(jobs.items()), store))
+    for url, path in later:
+        store.wanted(url, path)
+    store.save()
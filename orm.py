@@ -3,6 +3,8 @@ from calendar import timegm
 import characteristic
 
 import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.pool
 from sqlalchemy import (
     Table,
     Column,
@@ -23,6 +25,8 @@ from contextlib import contextmanager
 import enum
 import json
 
+import migrations
+
 Base = declarative_base()
 
 @characteristic.with_repr(["name"])  # pylint: disable=too-few-public-methods
@@ -265,6 +269,12 @@ class Game(Base):
             reverse chronological order, so that milestones[0] is the latest.
 
         start: start time for the game (in UTC)
+        xl: denormalised, the xl of the latest milestone so far
+        max_xl, max_runes, max_gems, max_turn: denormalised, the most of
+            each over the game's milestones so far
+        last_milestone_time: denormalised, the time of the latest milestone
+        last_place_id
+        last_place: denormalised, where the latest milestone happened
         end: end time for the game (in UTC). Null for an ongoing game. The
             following fields are also null for ongoing games
 
@@ -297,6 +307,16 @@ class Game(Base):
 
     start = Column(DateTime, nullable=False, index=True)  # type: DateTime
     end = Column(DateTime, nullable=True, index=True)  # type: DateTime
+    xl = Column(Integer, nullable=True)  # type: int
+
+    # Progress so far, kept up to date as milestones are added
+    max_xl = Column(Integer, nullable=True)  # type: int
+    max_runes = Column(Integer, nullable=True)  # type: int
+    max_gems = Column(Integer, nullable=True)  # type: int
+    max_turn = Column(Integer, nullable=True)  # type: int
+    last_milestone_time = Column(DateTime, nullable=True)  # type: DateTime
+    last_place_id = Column(Integer, ForeignKey("places.id"), nullable=True)  # type: int
+    last_place = relationship("Place")
 
     dam = Column(Integer, nullable=True)  # type: int
     sdam = Column(Integer, nullable=True)  # type: int
@@ -311,6 +331,9 @@ class Game(Base):
 
     __table_args__ = (
             Index("ix_games_player_start", player_id, start),
+            # the games of a week's char, see CsdcWeek._week_games
+            Index("ix_games_char_start", species_id, background_id, start,
+                player_id),
         )
 
     @property
@@ -437,6 +460,9 @@ class Milestone(Base):
     __table_args__ = (
             # Used to get milestones in order (and find the latest ones)
             Index("ix_milestones_gid_time", gid, time),
+            # a game's milestones of a kind, as scoring looks them up
+            Index("ix_milestones_gid_verb_place_turn", gid, verb_id, place_id,
+                turn),
         )
 
     def as_dict(self) -> dict:
@@ -466,15 +492,151 @@ class Logfile(Base):
     Columns:
         source_url: logfile source url
         current_key: the key of the next logfile event to import.
+        size, inode, mtime: the file's stat when current_key was saved.
+        checksum: crc32 of the bytes just before current_key, to tell if
+            the file was rewritten since.
+        stalls: refreshes in a row the file stopped at current_key, on the
+            end of a game that hasn't begun.
     """
     __tablename__ = 'logfile'
     source_url = Column(String(1000), primary_key=True)
     current_key = Column(Integer, default=0, nullable=False)
+    size = Column(Integer)
+    inode = Column(Integer)
+    mtime = Column(Integer)  # ns
+    checksum = Column(Integer)
+    stalls = Column(Integer, default=0)
 
     def __repr__(self):
         return "<Logfile(source_url={logfile.source_url}, offset={logfile.current_key})>".format(logfile=self)
 
 
+class SkippedRange(Base):
+    """A byte range of a logfile the ingest filter left out.
+
+    Columns:
+        source_url: logfile source url
+        start: offset of the first skipped line
+        end: offset just past the last skipped line
+        filter_key: key of the filter that skipped it. Ranges skipped by
+            another filter are parsed again on the next refresh.
+    """
+    __tablename__ = 'skipped_ranges'
+    id = Column(Integer, primary_key=True)
+    source_url = Column(String(1000), ForeignKey("logfile.source_url"),
+            nullable=False, index=True)
+    start = Column(Integer, nullable=False)
+    end = Column(Integer, nullable=False)
+    filter_key = Column(String(40), nullable=False)
+
+
+class ServerHealth(Base):
+    """How downloads from a server have been going.
+
+    Columns:
+        name: the server's name in the sources file
+        failures: downloads that failed in a row
+        next_attempt: (UTC) the server is skipped until then
+        last_success: (UTC) when it last downloaded fine
+    """
+    __tablename__ = 'server_health'
+    name = Column(String(50), primary_key=True)
+    failures = Column(Integer, default=0, nullable=False)
+    next_attempt = Column(DateTime)
+    last_success = Column(DateTime)
+
+
+class GameScore(Base):
+    """What a game scores in a week, kept up to date by csdc.update_scores.
+
+    There's a row for every game of the week's char started in the week,
+    eligible or not. The columns are those of CsdcWeek.scorecard and
+    CsdcWeek.onetimes, 0 or the points scored.
+    """
+    __tablename__ = 'game_scores'
+    gid = Column(String(50), ForeignKey("games.gid"), primary_key=True)
+    week = Column(String(10), primary_key=True, index=True)
+    xl5 = Column(Integer, nullable=False)
+    uniq = Column(Integer, nullable=False)
+    worship = Column(Integer, nullable=False)
+    xl10 = Column(Integer, nullable=False)
+    brenter = Column(Integer, nullable=False)
+    brend = Column(Integer, nullable=False)
+    god = Column(Integer, nullable=False)
+    gem = Column(Integer, nullable=False)
+    rune = Column(Integer, nullable=False)
+    tworune = Column(Integer, nullable=False)
+    threerune = Column(Integer, nullable=False)
+    orb = Column(Integer, nullable=False)
+    win = Column(Integer, nullable=False)
+    bonusone = Column(Integer, nullable=False)
+    bonustwo = Column(Integer, nullable=False)
+    fifteenrune = Column(Integer, nullable=False)
+    zig = Column(Integer, nullable=False)
+    lowxlzot = Column(Integer, nullable=False)
+    nolairwin = Column(Integer, nullable=False)
+    asceticrune = Column(Integer, nullable=False)
+
+
+class DirtyGame(Base):
+    """A game with new milestones or a new end since game_scores was last
+    brought up to date."""
+    __tablename__ = 'dirty_games'
+    gid = Column(String(50), primary_key=True)
+
+
+class WeekSignature(Base):
+    """The definition of a week its game_scores rows were computed with.
+
+    Columns:
+        week: week number
+        signature: sha1 of the week's char, dates, gods and bonuses
+    """
+    __tablename__ = 'week_signatures'
+    week = Column(String(10), primary_key=True)
+    signature = Column(String(40), nullable=False)
+
+
+class Achievement(Base):
+    """The first time a game met one of the criteria of rules.RULES.
+
+    Written as the game is ingested, scoring a week then only has to look up
+    which of these happened before its end.
+
+    Columns:
+        gid
+        category: eg "xl5", "worship:Trog" or "bonus:GoldenRune"
+        milestone_id: the milestone that met it
+        time: that milestone's time
+    """
+    __tablename__ = 'achievements'
+    gid = Column(String(50), ForeignKey("games.gid"), primary_key=True)
+    category = Column(String(50), primary_key=True)
+    milestone_id = Column(Integer, ForeignKey("milestones.id"), nullable=True)
+    time = Column(DateTime, nullable=False)
+
+
+class RuleState(Base):
+    """What the rule engine remembers of a game between milestones.
+
+    Columns:
+        gid
+        version: rules.RULES_VERSION it was built with
+        state: JSON, see rules.GameState
+    """
+    __tablename__ = 'rule_states'
+    gid = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False)
+    state = Column(String, nullable=False)
+
+
+class SchemaVersion(Base):
+    """The migrations applied to the database, see migrations.py."""
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+    applied = Column(DateTime, nullable=False)
+
+
 class CsdcContestant(Base):
     """CSDC Contestant"""
 
@@ -487,12 +649,103 @@ class CsdcContestant(Base):
 # End Object defs
 
 session_factory = None
+engine = None
+
+# pragmas that may be set from the sqlite section of the config
+SQLITE_PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size",
+        "temp_store", "busy_timeout")
+sqlite_profiles = {}
+sqlite_pragmas = {}
 
-def initialize(uri):
-    engine = create_engine(uri)
-    global session_factory 
+
+def _sqlite_profiles(config: dict) -> dict:
+    """Split the sqlite config section into named sets of pragmas.
+
+    Pragmas at the top level of the section apply to every profile, a
+    nested section (eg "ingest:") overrides them for that profile."""
+    common = {k: v for k, v in config.items() if not isinstance(v, dict)}
+    profiles = {"default": common}
+    for name, pragmas in config.items():
+        if isinstance(pragmas, dict):
+            profiles[name] = dict(common, **pragmas)
+    for pragmas in profiles.values():
+        for k in pragmas:
+            if k not in SQLITE_PRAGMAS:
+                raise ValueError("Unknown sqlite pragma {}".format(k))
+    return profiles
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for k, v in sqlite_pragmas.items():
+        cursor.execute("PRAGMA {}={}".format(k, v))
+    cursor.close()
+
+
+def use_profile(name: str):
+    """Switch to a profile from the sqlite config section.
+
+    Pragmas are set when a connection is opened, so this drops the pooled
+    connections. Unknown profiles use the pragmas common to all of them."""
+    global sqlite_pragmas
+    sqlite_pragmas = sqlite_profiles.get(name, sqlite_profiles.get("default", {}))
+    if engine is not None:
+        engine.dispose()
+
+
+def initialize(uri, sqlite=None, profile="default"):
+    """Set up the engine, create any missing tables and bring older
+    databases up to date.
+
+    Parameters:
+        sqlite: the sqlite config section. If given, connections to a
+            sqlite uri are pooled and get the pragmas of profile.
+    """
+    global engine, session_factory, sqlite_profiles
+    if sqlite and uri.startswith("sqlite"):
+        sqlite_profiles = _sqlite_profiles(sqlite)
+        engine = create_engine(uri, poolclass=sqlalchemy.pool.QueuePool,
+                connect_args={"check_same_thread": False})
+        sqlalchemy.event.listen(engine, "connect", _set_sqlite_pragmas)
+        use_profile(profile)
+    else:
+        sqlite_profiles = {}
+        engine = create_engine(uri)
     session_factory = sessionmaker(bind=engine, expire_on_commit=False, autocommit=False)
+    fresh = not sqlalchemy.inspect(engine).get_table_names()
     Base.metadata.create_all(engine)
+    _add_missing_columns(engine)
+    migrations.upgrade(engine, SchemaVersion, fresh)
+
+
+def analyze(*tables) -> None:
+    """Update sqlite's statistics of tables, so its query planner knows eg
+    how few of a game's milestones have a given verb. They are sampled, which
+    keeps this quick on big tables."""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        conn.execute("PRAGMA analysis_limit=1000")
+        for table in tables:
+            conn.execute("ANALYZE {}".format(
+                engine.dialect.identifier_preparer.quote(table)))
+
+
+def _add_missing_columns(engine):
+    """Add new nullable columns to tables created by an older version.
+
+    create_all only creates whole tables that are missing."""
+    inspector = sqlalchemy.inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    quote(table.name), quote(column.name),
+                    column.type.compile(dialect=engine.dialect)))
 
 @contextmanager
 def get_session():
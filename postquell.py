@@ -1,25 +1,24 @@
 import csdc
 import json
 import datetime
-import orm
 
 CRAWLDATE = "%Y%m%d%H%M%SS"
 
 def crawldate(dt):
     return dt.strftime("%Y{:02d}%d%H%M%SS".format(dt.month - 1))
 
-def gameline(g):
+def gameline(r):
     return { 
-        "name" : g.player.name,
-        "start" : crawldate(g.start)
+        "name" : r.name,
+        "start" : crawldate(r.start)
     }
 
 def playerline(r, wk):
-    if r.Game:
-        return gameline(r.Game)
+    if r.gid:
+        return gameline(r)
     else:
         return {
-            "name" : r.Player.name,
+            "name" : r.name,
             "char" : wk.char,
         }
 
@@ -29,12 +28,11 @@ def dumps(f, wk):
         json.dump({ "v" : { "$in" : [ "0.22.0", "0.22.1"  ] }, "$or" : [] }, f)
         return
 
-    with orm.get_session() as s:
-        return json.dump({ "v" : { "$in" : [ "0.22.0", "0.22.1" ] },
-           "$not" : {
-              "$or" : [
-                { "$not" : { "$or" : [ { "$not" : { "type" : { "$in" : [ "zig", "br.exit", "uniq" ] }}},
-                    { "type" : "zig", "lvl" : { "$in" : [ "7", "14", "21", "27"] } } ] }  },
-                { "$not" : { "$or" : [ playerline(r, wk) for r in wk.sortedscorecard().with_session(s).all() ] } }
-              ]
-          }}, f)
+    return json.dump({ "v" : { "$in" : [ "0.22.0", "0.22.1" ] },
+       "$not" : {
+          "$or" : [
+            { "$not" : { "$or" : [ { "$not" : { "type" : { "$in" : [ "zig", "br.exit", "uniq" ] }}},
+                { "type" : "zig", "lvl" : { "$in" : [ "7", "14", "21", "27"] } } ] }  },
+            { "$not" : { "$or" : [ playerline(r, wk) for r in wk.results() ] } }
+          ]
+      }}, f)
@@ -0,0 +1,146 @@
+"""Find the players registered for the tournament from their rcfiles.
+
+A player registers by adding a line like "# ccsdt" to their rcfile on any
+server. Each server's rcfile directory index is read, and an rcfile is only
+downloaded when its index entry (date and size) changed since the last scan,
+with If-None-Match/If-Modified-Since so a server can still answer 304. What
+was found is kept in a JSON state file. Whether a registered player is a
+contestant yet is read from the database, so a rebuilt database gets them
+all back.
+"""
+
+import asyncio
+import html
+import json
+import logging
+import os
+import re
+import urllib.parse
+from typing import Optional, Sequence
+
+import fetch
+import sources
+from orm import Player, CsdcContestant
+
+MARKER = re.compile(rb'^#.*ccsdt.*$', re.IGNORECASE | re.MULTILINE)
+PER_HOST = 4
+STATE_FILE = 'rcfiles.json'
+_LINK = re.compile(r'href="(?:\./)?([^"/?#]+\.rc)"', re.IGNORECASE)
+_TAG = re.compile(r'<[^>]*>')
+
+
+def index_entries(page: str) -> dict:
+    """{rcfile name: index stamp} from a directory index page.
+
+    The stamp is whatever text follows the link on its line, normally the
+    date and size, so a changed rcfile has a different stamp. It's empty
+    for indexes without that."""
+    entries = {}
+    for line in page.splitlines():
+        m = _LINK.search(line)
+        if m:
+            name = urllib.parse.unquote(html.unescape(m.group(1)))
+            rest = line[m.end():]
+            end = rest.lower().find("</a>")
+            stamp = html.unescape(_TAG.sub(" ", rest[end + 4:] if end >= 0 else ""))
+            entries[name] = " ".join(stamp.split())
+    return entries
+
+
+class Registrations:
+    """What the last scan found, kept in a JSON file:
+
+    {server: {rcfile: {"stamp", "etag", "last_modified", "registered"}}}
+
+    Who is a contestant already is the database's business, see new."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.servers = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.servers = data.get("servers", {})
+
+    def registered(self) -> set:
+        """Players with the marker in their rcfile on any server."""
+        return {os.path.splitext(rc)[0]
+                for files in self.servers.values()
+                for rc, entry in files.items() if entry.get("registered")}
+
+    def new(self, s) -> list:
+        """Registered players who aren't contestants in the database yet."""
+        contestants = {name.lower() for name, in s.query(Player.name).join(
+            CsdcContestant, CsdcContestant.player_id == Player.id)}
+        return sorted(p for p in self.registered()
+                if p.lower() not in contestants)
+
+    def save(self) -> None:
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump({"servers": self.servers}, f, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+
+async def _check(fetcher, url, entry, stamp):
+    """Download an rcfile if it changed and look for the marker."""
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    status, resp_headers, body = await fetcher.get(url, headers)
+    if status == 200:
+        entry["registered"] = MARKER.search(body) is not None
+        entry["etag"] = resp_headers.get("etag")
+        entry["last_modified"] = resp_headers.get("last-modified")
+    elif status != 304:
+        raise fetch.HTTPError("HTTP {}".format(status))
+    entry["stamp"] = stamp
+
+
+async def _scan_server(fetcher, name, url, files):
+    index_url = url if url.endswith('/') else url + '/'
+    status, _, page = await fetcher.get(index_url)
+    if status != 200:
+        raise fetch.HTTPError("HTTP {}".format(status))
+    entries = index_entries(page.decode('utf-8', 'replace'))
+    for rc in set(files) - set(entries):
+        del files[rc]
+    changed = [rc for rc, stamp in entries.items()
+            if not stamp or files.get(rc, {}).get("stamp") != stamp]
+    logging.info("{}: {} rcfiles, {} changed".format(name, len(entries), len(changed)))
+    limit = asyncio.Semaphore(PER_HOST)
+
+    async def check(rc):
+        async with limit:
+            entry = dict(files.get(rc, {}))
+            try:
+                await _check(fetcher, urllib.parse.urljoin(index_url,
+                    urllib.parse.quote(rc)), entry, entries[rc])
+            except (OSError, asyncio.TimeoutError, fetch.HTTPError, ValueError) as e:
+                logging.warning("Couldn't check {} on {}: {!r}".format(rc, name, e))
+                return
+            files[rc] = entry
+
+    await asyncio.gather(*[check(rc) for rc in changed])
+
+
+async def _scan(urls, state):
+    async with fetch.Fetcher(per_host=PER_HOST) as fetcher:
+        async def one(name, url):
+            try:
+                await _scan_server(fetcher, name, url,
+                        state.servers.setdefault(name, {}))
+            except (OSError, asyncio.TimeoutError, fetch.HTTPError, ValueError) as e:
+                logging.warning("Couldn't read the rcfiles of {}: {!r}".format(name, e))
+
+        await asyncio.gather(*[one(name, url) for name, url in urls.items()])
+
+
+def scan(sources_yaml_path: str, state: Registrations,
+        servers: Optional[Sequence[str]]=None) -> None:
+    """Bring state up to date with the servers' rcfiles."""
+    urls = {src: data["rcfiles"] for src, data in
+            sources.source_data(sources_yaml_path).items()
+            if servers is None or src in servers}
+    asyncio.run(_scan(urls, state))
@@ -4,61 +4,489 @@ import sources
 import os
 import logging
 import time
+import collections
+import datetime
+import concurrent.futures
+import queue
+import threading
+import zlib
 import modelutils
+import metrics
 from typing import Optional
 from model import (
-    get_logfile_progress, 
-    save_logfile_progress, 
-    add_event
+    get_logfile_progress,
+    save_logfile_progress,
+    get_stale_skipped_ranges,
+    get_server_health,
+    get_milestones_read_until,
+    add_skipped_ranges,
+    discard_source,
+    open_games,
+    EventBatch,
+    UnmatchedEnd
 )
 
-def _refresh_from_file(file, src, sess):
-    logging.debug(file)
-    logfile = get_logfile_progress(sess, file)
-    logging.info("Refreshing from: {}".format(file))
+BATCH_SIZE = 1000  # lines per executemany/commit
+CHUNK_SIZE = 1 << 20  # bytes of logfile handed to a parser process at a time
+FINGERPRINT_BYTES = 4096  # bytes before the offset checksummed to spot rewrites
+BACKOFF = 600  # seconds a server is skipped after a failed download
+MAX_BACKOFF = 24 * 60 * 60
+MAX_STALLS = 10  # refreshes a file waits for the begin of a game that ended
 
+
+def _parse_lines(lines, src_name, line_filter, m):
+    """Parse raw loglines into (length in bytes, event) records.
+
+    The event is None for lines that are skipped, so the writer can still
+    keep track of the offset. Runs of lines rejected by line_filter are not
+    parsed at all and come back as one (total length, False) record. The
+    number of lines of each kind is counted in m."""
+    records = []
+    filtered = 0
+    n_filtered = n_skipped = n_errors = 0
+    for line in lines:
+        if line_filter is not None and not line_filter(line):
+            filtered += len(line)
+            n_filtered += 1
+            continue
+        if filtered:
+            records.append((filtered, False))
+            filtered = 0
+        data = None
+        try:
+            data = modelutils.logline_to_dict(line.decode())
+            data["src_abbr"] = src_name
+            if 'type' in data and data['type'] == 'crash':
+                data = None
+                n_skipped += 1
+        except KeyError as e:
+            logging.error('key {} not found'.format(e))
+            data = None
+            n_errors += 1
+        except Exception as e:  # how scandalous! Don't want one broken line to break everything
+            logging.exception('Something unexpected happened, skipping this event')
+            data = None
+            n_errors += 1
+        records.append((len(line), data))
+    if filtered:
+        records.append((filtered, False))
+    m.count("lines", len(lines))
+    m.count("filtered", n_filtered)
+    m.count("skipped", n_skipped)
+    m.count("errors", n_errors)
+    return records
+
+
+def _parse_range(file, src_name, start, end, line_filter=None):
+    """Parse the lines between two byte offsets of a file. Runs in a worker.
+
+    Returns the records and the Metrics of reading and parsing them."""
+    m = metrics.Metrics()
+    with m.timer("read"), open(file, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).splitlines(keepends=True)
+    m.count("bytes", end - start)
+    with m.timer("parse"):
+        records = _parse_lines(lines, src_name, line_filter, m)
+    return records, m
+
+
+def _complete_size(f):
+    """The length of a file up to its last newline.
+
+    A download that was cut short can end part way through a line, the
+    rest of which comes with the next one."""
+    size = pos = os.fstat(f.fileno()).st_size
+    while pos > 0:
+        step = min(pos, FINGERPRINT_BYTES)
+        f.seek(pos - step)
+        i = f.read(step).rfind(b"\n")
+        if i >= 0:
+            return pos - step + i + 1
+        pos -= step
+    return 0
+
+
+def _chunk_ranges(file, start):
+    """Split a file from start to its last complete line into ranges ending
+    on line boundaries."""
+    with open(file, 'rb') as f:
+        size = _complete_size(f)
+        while start < size:
+            f.seek(min(start + CHUNK_SIZE, size))
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def _checksum(f, offset):
+    start = max(0, offset - FINGERPRINT_BYTES)
+    f.seek(start)
+    return zlib.crc32(f.read(offset - start))
+
+
+def _save_progress(logfile, offset):
+    """Move the logfile offset, along with the file's fingerprint there."""
     with open(logfile.source_url, 'rb') as f:
-        logging.debug('offset: {}'.format(logfile.current_key))
-        f.seek(logfile.current_key)
-        iter = 0
-        for line in f:
-            try:
-                data = modelutils.logline_to_dict(line.decode())
-                data["src_abbr"] = src.name
-                if not ('type' in data and data['type'] == 'crash'):
-                    add_event(sess, data)
-            except KeyError as e:
-                logging.error('key {} not found'.format(e))
-            except Exception as e:  # how scandalous! Don't want one broken line to break everything
-                logging.exception('Something unexpected happened, skipping this event')
-            iter += 1
-            logfile.current_key += len(line)
-            if iter % 1000 == 0:  # don't spam commits
+        st = os.fstat(f.fileno())
+        logfile.checksum = _checksum(f, offset)
+    logfile.current_key = offset
+    logfile.size, logfile.inode, logfile.mtime = st.st_size, st.st_ino, st.st_mtime_ns
+
+
+def _up_to_date(logfile):
+    """Check if a file is unchanged since it was read to the end."""
+    st = os.stat(logfile.source_url)
+    return (st.st_size, st.st_ino, st.st_mtime_ns) == (logfile.size,
+            logfile.inode, logfile.mtime) and logfile.current_key == st.st_size
+
+
+def _rewritten(logfile, replaced=False):
+    """Check if a file was truncated, replaced or rewritten since it was read.
+
+    That's if it's now shorter than the offset, or the bytes before the
+    offset changed. An unchanged stat skips reading anything. A file the
+    download had to fetch whole again (replaced) counts as rewritten unless
+    its fingerprint shows the bytes we read are still the same."""
+    if not logfile.current_key:
+        return False
+    st = os.stat(logfile.source_url)
+    if (st.st_size, st.st_ino, st.st_mtime_ns) == (logfile.size,
+            logfile.inode, logfile.mtime):
+        return False
+    if st.st_size == 0:
+        # a failed download leaves an empty file, don't throw away the source
+        logging.warning("{} is empty, leaving it alone".format(logfile.source_url))
+        return False
+    if st.st_size < logfile.current_key:
+        return True
+    if logfile.checksum is None:  # read before fingerprints were saved
+        return replaced
+    with open(logfile.source_url, 'rb') as f:
+        return _checksum(f, logfile.current_key) != logfile.checksum
+
+
+def _write(sess, batch, ranges, m):
+    """Write out a batch and skipped ranges. Doesn't commit."""
+    m.count("games", len(batch.games))
+    m.count("ends", len(batch.ends))
+    m.count("milestones", len(batch.milestones))
+    m.count("ranges", len(ranges))
+    with m.timer("insert"):
+        batch.flush(sess)
+        add_skipped_ranges(sess, ranges)
+
+
+def _waits(sess, data, stalls):
+    """Check if the end of a game that hasn't begun should wait for its
+    begin, given how many refreshes it already stopped its file.
+
+    Servers write their milestones in time order, so once the source's
+    milestones were read past the game's end its begin isn't coming."""
+    if stalls >= MAX_STALLS:
+        return False
+    read_until = get_milestones_read_until(sess, data["src_abbr"])
+    return read_until is None or read_until <= modelutils.crawl_date_to_datetime(
+            data["time"])
+
+
+def _ingest_records(sess, logfile, records, filter_key=None, skipped=None):
+    """Write parsed records to the DB, advancing the logfile offset.
+
+    This is the only place that writes events; records must arrive in file
+    order. Ranges the filter left out are recorded under filter_key.
+
+    If skipped is given the records are the contents of that SkippedRange.
+    They are written in a single transaction that replaces it, and the
+    logfile offset is left alone.
+
+    The end of a game that hasn't begun stops the file there: what came
+    before is written and the offset left at its line, or for a SkippedRange
+    nothing is written, so the next refresh tries again once the begin has
+    arrived. Returns False if that happened. The begin isn't waited for
+    forever: the line is skipped once the source's milestones have been read
+    past the game's end, or after the file stopped on it MAX_STALLS
+    refreshes in a row."""
+    m = metrics.for_file(logfile.source_url)
+    batch = EventBatch()
+    with m.timer("resolve"):
+        batch.resolve(sess, [data for _, data in records if data])
+    offset = logfile.current_key if skipped is None else skipped.start
+    start = offset
+    stalls = 0
+    if skipped is None:
+        stalls, logfile.stalls = logfile.stalls or 0, 0
+    ranges = []
+    stopped = False
+    for i in range(0, len(records), BATCH_SIZE):
+        with m.timer("add"):
+            for nbytes, data in records[i:i + BATCH_SIZE]:
+                if data is False:
+                    ranges.append({"source_url": logfile.source_url,
+                        "start": offset, "end": offset + nbytes,
+                        "filter_key": filter_key})
+                elif data is not None:
+                    try:
+                        batch.add(sess, data)
+                    except UnmatchedEnd as e:
+                        # the file stopped here last time too
+                        waited = stalls if offset == start else 0
+                        if not _waits(sess, data, waited):
+                            logging.warning("{}, skipping it in {}".format(
+                                e, logfile.source_url))
+                        else:
+                            logging.warning("{}, stopping {} there until it "
+                                    "begins".format(e, logfile.source_url))
+                            if skipped is None:
+                                logfile.stalls = waited + 1
+                            stopped = True
+                            break
+                    except KeyError as e:
+                        logging.error('key {} not found'.format(e))
+                    except Exception as e:
+                        logging.exception('Something unexpected happened, skipping this event')
+                offset += nbytes
+        if skipped is None:  # commit every BATCH_SIZE records
+            _write(sess, batch, ranges, m)
+            ranges = []
+            _save_progress(logfile, offset)
+            with m.timer("commit"):
                 sess.commit()
-        logfile.current_key = f.tell()
-        sess.commit()
+        if stopped:
+            break
+    if skipped is not None and stopped:
+        sess.rollback()
+        open_games.clear()  # it saw the range's begins and ends
+    elif skipped is not None:
+        _write(sess, batch, ranges, m)
+        sess.delete(skipped)
+        with m.timer("commit"):
+            sess.commit()
+    return not stopped
+
+
+def _ingest_tasks(sess, files, filter_key, replaced):
+    """List the (logfile, src_name, start, end, skipped) ranges to parse, in the
+    order they must be written.
+
+    For each file that is first any ranges skipped by another filter
+    (skipped is the SkippedRange), then the new data past its offset. Files
+    that haven't changed since they were read to the end are passed over.
+
+    A source with a file that was rewritten is discarded first, so both its
+    files are read again from the start. replaced is the files the download
+    fetched whole again."""
+    logfiles = [(get_logfile_progress(sess, file), src) for file, src in files]
+    for name in {src for logfile, src in logfiles
+            if _rewritten(logfile, logfile.source_url in replaced)}:
+        logging.warning("{} was rewritten, reading it again".format(name))
+        discard_source(sess, name,
+                [logfile for logfile, src in logfiles if src == name])
+    changed = [(logfile, src) for logfile, src in logfiles
+            if not _up_to_date(logfile)]
+    logging.debug("{}: {} of {} files changed".format(
+        ", ".join(sorted({src for _, src in logfiles})), len(changed), len(logfiles)))
+
+    tasks = []
+    for logfile, src in logfiles:
+        for r in get_stale_skipped_ranges(sess, logfile.source_url, filter_key):
+            tasks.append((logfile, src, r.start, r.end, r))
+        if (logfile, src) not in changed:
+            continue
+        logging.info("Refreshing from: {}".format(logfile.source_url))
+        logging.debug('offset: {}'.format(logfile.current_key))
+        tasks.extend((logfile, src, start, end, None) for start, end in
+                _chunk_ranges(logfile.source_url, logfile.current_key))
+    return tasks
+
+
+def _refresh_serial(groups, sess, line_filter, replaced):
+    filter_key = line_filter.key if line_filter is not None else None
+    for files in groups:
+        stopped = set()
+        for logfile, src, start, end, skipped in _ingest_tasks(sess, files, filter_key,
+                replaced):
+            if logfile.source_url in stopped:
+                continue
+            records, m = _parse_range(logfile.source_url, src, start, end,
+                    line_filter)
+            metrics.for_file(logfile.source_url).merge(m)
+            if not _ingest_records(sess, logfile, records, filter_key, skipped):
+                stopped.add(logfile.source_url)
+
+
+def _refresh_parallel(groups, sess, workers, line_filter, replaced):
+    """Parse files in a process pool, writing them in order from this process.
+
+    groups yields lists of (file, source name), each in the order they must be
+    written. Only a bounded number of chunks are parsed ahead of the writer."""
+    filter_key = line_filter.key if line_filter is not None else None
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        for files in groups:
+            tasks = iter(_ingest_tasks(sess, files, filter_key, replaced))
+            pending = collections.deque()
+
+            def submit():
+                task = next(tasks, None)
+                if task is not None:
+                    logfile, src, start, end, skipped = task
+                    pending.append((logfile, skipped, pool.submit(_parse_range,
+                        logfile.source_url, src, start, end, line_filter)))
+
+            for _ in range(workers * 2):
+                submit()
+            # files stopped at the end of a game that hasn't begun, the
+            # rest of them waits for the next refresh
+            stopped = set()
+            while pending:
+                logfile, skipped, job = pending.popleft()
+                submit()
+                file_metrics = metrics.for_file(logfile.source_url)
+                with file_metrics.timer("wait"):
+                    records, m = job.result()
+                file_metrics.merge(m)
+                if logfile.source_url in stopped:
+                    continue
+                if not _ingest_records(sess, logfile, records, filter_key, skipped):
+                    stopped.add(logfile.source_url)
+
+
+def _source_files(sources_dir, name, data):
+    """The (file, source name) of a source's files that exist, in the
+    order they're read."""
+    logging.debug('scanning {} files, expect [{}]'.format(name,
+        ','.join(sources.url_to_filename(x) for x in data.values())))
+    # it is important that this refresh first so we get begins
+    # before ends!
+    files = [os.path.join(sources_dir, name, sources.url_to_filename(data[x]))
+            for x in ("milestones", "logfile")]
+    return [(file, name) for file in files if os.path.exists(file)]
+
+
+def _downloaded(sources_file, sources_dir, source_data, servers, results,
+        replaced, budget):
+    """Download the servers' files in a thread, yielding each source's
+    files as soon as both of them are in, so ingest overlaps the slower
+    servers. Sources that aren't downloaded come first. The download
+    results are put in results once it's all done."""
+    done = queue.Queue()
+    failed = []
+
+    def download():
+        try:
+            results.update(sources.download_sources(sources_file, sources_dir,
+                servers, done=lambda dest, result: done.put(dest), budget=budget,
+                replaced=replaced))
+        except BaseException as e:
+            failed.append(e)
+        finally:
+            done.put(None)
+
+    thread = threading.Thread(target=download, name="download", daemon=True)
+    thread.start()
+    for name in source_data:
+        if name not in servers and os.path.isdir(os.path.join(sources_dir, name)):
+            yield _source_files(sources_dir, name, source_data[name])
+    waiting = {name: {os.path.join(sources_dir, name, sources.url_to_filename(data[x]))
+            for x in ("milestones", "logfile")}
+            for name, data in source_data.items() if name in servers}
+    while waiting:
+        dest = done.get()
+        if dest is None:
+            break
+        for name, left in list(waiting.items()):
+            left.discard(dest)
+            if not left:
+                del waiting[name]
+                yield _source_files(sources_dir, name, source_data[name])
+    thread.join()
+    if failed:
+        raise failed[0]
+
+
+def _due(sess, names, now):
+    """The servers to download from now, leaving out those backing off."""
+    health = get_server_health(sess, names)
+    due = []
+    for name in names:
+        h = health[name]
+        if h.next_attempt is not None and h.next_attempt > now:
+            logging.info("Skipping {} until {} after {} failed downloads".format(
+                name, h.next_attempt, h.failures))
+        else:
+            due.append(name)
+    return due
+
+
+def _record_downloads(sess, servers, results, now, backoff, max_backoff):
+    """Update the servers' health from their download results.
+
+    A server fails if any of its files couldn't be downloaded, not counting
+    files that are missing on the server (those are left empty). Each
+    failure in a row doubles the time it's skipped for."""
+    failed = {os.path.basename(os.path.dirname(dest))
+            for dest, result in results.items() if result is None
+            and not (os.path.exists(dest) and os.path.getsize(dest) == 0)}
+    for name, h in get_server_health(sess, servers).items():
+        if name in failed:
+            h.failures += 1
+            delay = min(backoff * 2 ** (h.failures - 1), max_backoff)
+            h.next_attempt = now + datetime.timedelta(seconds=delay)
+            logging.warning("Downloads from {} failed {} times in a row, "
+                    "skipping it for {}s".format(name, h.failures, delay))
+        else:
+            h.failures = 0
+            h.next_attempt = None
+            h.last_success = now
+    sess.commit()
+
 
 # fetch newest data into the DB
-def refresh(sources_file: str, sources_dir: str, fetch: Optional[bool]=True):
+def refresh(sources_file: str, sources_dir: str, fetch: Optional[bool]=True,
+        workers: Optional[int]=1,
+        line_filter: Optional[modelutils.LineFilter]=None,
+        pipeline: Optional[bool]=False, budget: Optional[float]=None,
+        backoff: float=BACKOFF, max_backoff: float=MAX_BACKOFF):
+    """Download and import new logfile/milestone lines.
+
+    Parameters:
+        workers: number of processes to parse with. Lines are still written
+            by this process alone, source by source, in file order.
+        line_filter: if given, lines it rejects are not parsed or stored,
+            only recorded as skipped ranges. Ranges skipped by an earlier,
+            different filter are parsed again with this one first.
+        pipeline: ingest each source as soon as its files are downloaded,
+            instead of after all downloads are done.
+        budget: seconds each server gets to download its files.
+        backoff, max_backoff: seconds a server whose download failed is
+            skipped for, doubling with each failure in a row up to the max.
+    """
     t_i = time.time()
     source_data = sources.source_data(sources_file)
-
-    if fetch:
-        sources.download_sources(sources_file, sources_dir)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
 
     with orm.get_session() as sess:
-        for src in os.scandir(sources_dir):
-            if not src.is_file() and src.name in source_data:
-                expected_files = [sources.url_to_filename(x) for _, x in
-                        source_data[src.name].items()]
-                logging.debug('scanning {} files, expect [{}]'.format(src.name, ','.join(expected_files)))
-                # it is important that this refresh first so we get begins
-                # before ends!
-                milestones = os.path.join(src.path,
-                    sources.url_to_filename(source_data[src.name]["milestones"]))
-                _refresh_from_file(milestones, src, sess)
-                logfile = os.path.join(src.path,
-                    sources.url_to_filename(source_data[src.name]["logfile"]))
-                _refresh_from_file(logfile, src, sess)
+        servers = _due(sess, list(source_data), now) if fetch else []
+        results = {}
+        replaced = set()
+        if fetch and pipeline:
+            groups = _downloaded(sources_file, sources_dir, source_data,
+                    servers, results, replaced, budget)
+        else:
+            if fetch:
+                results = sources.download_sources(sources_file, sources_dir,
+                        servers, budget=budget, replaced=replaced)
+            groups = [_source_files(sources_dir, src.name, source_data[src.name])
+                    for src in os.scandir(sources_dir)
+                    if not src.is_file() and src.name in source_data]
+
+        if workers and workers > 1:
+            _refresh_parallel(groups, sess, workers, line_filter, replaced)
+        else:
+            _refresh_serial(groups, sess, line_filter, replaced)
+        if fetch:
+            _record_downloads(sess, servers, results, now, backoff, max_backoff)
 
+    metrics.emit()
     logging.info('Refreshed in {} seconds'.format(time.time() - t_i))
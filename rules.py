@@ -0,0 +1,393 @@
+"""Score games as they are ingested.
+
+Each milestone of a game goes through the rules in RULES as EventBatch
+queues it. A rule tests a single milestone. It can also look at what the
+game did earlier: GameState remembers which branches were entered, and
+when, and when the game died. The first milestone that passes a rule is
+written to the achievements ledger. Scoring a week then only has to ask
+which ledger entries came before the week's end (see CsdcWeek).
+
+Nothing here depends on a week. Gods are recorded per god, and bonuses are
+recorded for every bonus rule. A week picks the ones it scores.
+"""
+
+import collections
+import json
+import logging
+from typing import Iterable, Sequence
+
+import sqlalchemy
+from sqlalchemy.orm import aliased
+
+import constants as const
+from orm import (
+    Achievement,
+    RuleState,
+    Branch,
+    Game,
+    God,
+    Ktyp,
+    Milestone,
+    Place,
+    Verb,
+)
+
+# bump when a rule changes; every game is then replayed from its milestones
+RULES_VERSION = 1
+CHUNK_SIZE = 500  # gids per IN (...)
+
+Event = collections.namedtuple("Event", ["verb", "place", "oplace", "god",
+    "xl", "turn", "runes", "gems", "potionsused", "scrollsused", "sklev",
+    "msg", "status", "ktyp", "time"])
+# category may have a {god} in it, verbs of None means any milestone
+Rule = collections.namedtuple("Rule", ["category", "verbs", "test"])
+
+
+class GameState:
+    """What the rules remember of a game between milestones.
+
+    done: the categories already met
+    enters: (place, turn) of every br.enter
+    deaths: turn of every death (felids)
+    """
+    __slots__ = ("done", "enters", "deaths")
+
+    def __init__(self, done=(), enters=(), deaths=()):
+        self.done = set(done)
+        self.enters = [tuple(e) for e in enters]
+        self.deaths = list(deaths)
+
+    def entered(self, places, turn: int) -> int:
+        """How many times one of places was entered before turn."""
+        return sum(1 for place, t in self.enters if t < turn and place in places)
+
+    def died(self, turn: int) -> int:
+        """How many times the game died before turn."""
+        return sum(1 for t in self.deaths if t < turn)
+
+    def dumps(self) -> str:
+        return json.dumps([sorted(self.done), self.enters, self.deaths])
+
+    @classmethod
+    def loads(cls, text: str) -> "GameState":
+        return cls(*json.loads(text))
+
+
+_NOT_MULTILEVEL = {b.short for b in const.BRANCHES if not b.multilevel}
+
+
+def _first_levels(branches) -> frozenset:
+    return frozenset("%s:1" % b for b in branches)
+
+
+def _branch(place: str) -> str:
+    return place.split(":")[0]
+
+
+def _multilevel(place: str) -> bool:
+    # branches we don't know of are added as multilevel, see model._new_branch
+    return _branch(place) not in _NOT_MULTILEVEL
+
+
+def _mentions(text: str, *names: str) -> bool:
+    """Like the SQL LIKE '%name%', which ignores case."""
+    text = text.lower()
+    return any(n.lower() in text for n in names)
+
+
+def _always(state, ev):
+    return True
+
+
+_RUNE_BRANCHES = _first_levels(const.RUNE_BRANCHES)
+_MULTI_LEVEL = _first_levels(const.MULTI_LEVEL_BRANCHES)
+_LAIR = _first_levels(("Lair",))
+_S_BRANCHES = _first_levels(("Shoals", "Snake", "Spider", "Swamp"))
+_HELL = _first_levels(("Coc", "Geh", "Dis", "Tar"))
+_ABYSS = _first_levels(("Abyss",))
+_PAN = _first_levels(("Pan",))
+_UNIQ = {"uniq", "uniq.ban", "uniq.pac", "uniq.slime"}
+
+RULES = [
+    Rule("xl5", None, lambda st, ev: ev.xl >= 5),
+    Rule("xl10", None, lambda st, ev: ev.xl >= 10),
+    Rule("uniq", _UNIQ, _always),
+    Rule("worship", {"god.worship"}, _always),
+    Rule("worship:{god}", {"god.worship"}, _always),
+    Rule("champion:{god}", {"god.maxpiety"}, _always),
+    Rule("renounce", {"god.renounce"}, _always),
+    Rule("brenter", {"br.enter"},
+        lambda st, ev: _multilevel(ev.place) and _branch(ev.place) != "D"),
+    Rule("brend", {"br.end"}, lambda st, ev: _multilevel(ev.place)),
+    Rule("gem", None, lambda st, ev: ev.gems >= 1),
+    Rule("rune", None, lambda st, ev: ev.runes >= 1),
+    Rule("tworune", None, lambda st, ev: ev.runes >= 2),
+    Rule("threerune", None, lambda st, ev: ev.runes >= 3),
+    Rule("rune15", None, lambda st, ev: ev.runes >= 15),
+    Rule("orb", {"orb"}, _always),
+    Rule("win", {"death.final"}, lambda st, ev: ev.ktyp == "winning"),
+    Rule("zig", {"zig.exit"}, lambda st, ev: ev.oplace == "Zig:27"),
+    Rule("lowxlzot", {"br.enter"},
+        lambda st, ev: ev.place == "Zot:1" and ev.xl <= 20),
+    Rule("lair", {"br.enter"}, lambda st, ev: ev.place == "Lair:1"),
+    Rule("asceticrune", {"rune"},
+        lambda st, ev: ev.potionsused == 0 and ev.scrollsused == 0),
+]
+
+
+def _bonus(name: str, verbs, test) -> Rule:
+    """The rule of the CsdcBonus called name."""
+    return Rule("bonus:" + name, verbs, test)
+
+
+BONUSES = [
+    _bonus("RuneBranchLowSkill", {"br.enter", "abyss.enter"},
+        lambda st, ev: ev.sklev < 11 and (ev.verb == "abyss.enter"
+            or ev.place in _RUNE_BRANCHES)),
+    _bonus("RuneLowSkill", {"rune"}, lambda st, ev: ev.sklev < 11),
+    _bonus("EnterSlime2nd", {"br.enter"},
+        lambda st, ev: ev.place == "Slime:1"
+            and st.entered(_MULTI_LEVEL, ev.turn) < 2),
+    _bonus("GetTheSlimyRune", {"rune"}, lambda st, ev: ev.place == "Slime:5"),
+    _bonus("GetTheSlimyGem", {"gem.found"},
+        lambda st, ev: ev.place == "Slime:5"),
+    _bonus("TempleIn4kTurn", {"br.enter"},
+        lambda st, ev: ev.place == "Temple:1" and ev.turn < 4000),
+    _bonus("ExitAbyssUnder27kTurn", {"abyss.exit"},
+        lambda st, ev: ev.turn < 27000),
+    _bonus("Floor10ofZig", None, lambda st, ev: ev.place == "Zig:10"),
+    _bonus("RuneIn15kTurn", {"rune"}, lambda st, ev: ev.turn < 15000),
+    _bonus("EnterElf3under12kTurn", {"br.end"},
+        lambda st, ev: ev.place == "Elf:3" and ev.turn < 12000),
+    _bonus("LairEndXL12", {"br.end"},
+        lambda st, ev: ev.place == "Lair:5" and ev.xl <= 12),
+    _bonus("OrcEndBeforeXL11", {"br.end"},
+        lambda st, ev: ev.place == "Orc:2" and ev.xl < 11),
+    _bonus("VaultEndXL18", {"br.end"},
+        lambda st, ev: ev.place == "Vaults:5" and ev.xl <= 18),
+    _bonus("Elf3BeforeRunes", {"br.end"},
+        lambda st, ev: ev.place == "Elf:3"
+            and not st.entered(_RUNE_BRANCHES, ev.turn)),
+    _bonus("Depths4BeforeRunes", {"br.end"},
+        lambda st, ev: ev.place == "Depths:4"
+            and not st.entered(_RUNE_BRANCHES, ev.turn)),
+    _bonus("Depths4BeforeLair", {"br.end"},
+        lambda st, ev: ev.place == "Depths:4"
+            and not st.entered(_LAIR, ev.turn)),
+    _bonus("GeryonBeforeRune", {"uniq", "uniq.slime"},
+        lambda st, ev: _mentions(ev.msg, "Geryon")
+            and not st.entered(_RUNE_BRANCHES - _ABYSS, ev.turn)),
+    _bonus("HellPanRuneFirst", {"rune"},
+        lambda st, ev: not _mentions(ev.msg, "byssal")
+            and not st.entered(_RUNE_BRANCHES - _ABYSS - _PAN, ev.turn)),
+    _bonus("HellRuneFirst", {"rune"},
+        lambda st, ev: not _mentions(ev.msg, "byssal")
+            and not st.entered(_RUNE_BRANCHES - _ABYSS - _HELL, ev.turn)),
+    _bonus("GoldenRune", {"rune"}, lambda st, ev: ev.place == "Tomb:3"),
+    _bonus("CryptGem", {"gem.found"}, lambda st, ev: ev.place == "Crypt:3"),
+    _bonus("VowOfCourage", {"rune"},
+        lambda st, ev: ev.runes >= 5
+            and not st.entered(_first_levels(("Depths",)), ev.turn)),
+    _bonus("Collect3Gems", None, lambda st, ev: ev.gems >= 3),
+    _bonus("RuneNoSBranch", {"rune"},
+        lambda st, ev: not st.entered(_S_BRANCHES, ev.turn)),
+    _bonus("RuneNoLair", {"rune"},
+        lambda st, ev: not st.entered(_LAIR, ev.turn)),
+    _bonus("RuneDontDie", {"rune"}, lambda st, ev: not st.died(ev.turn)),
+    _bonus("2RuneDont2Die", {"rune"},
+        lambda st, ev: ev.runes >= 2 and st.died(ev.turn) < 2),
+    _bonus("TreeFormUniq", {"uniq"},
+        lambda st, ev: _mentions(ev.status, "tree-form")),
+    _bonus("KillPanLord", {"uniq"},
+        lambda st, ev: _mentions(ev.msg, "Cerebov", "Mnoleg", "Lom Lobon",
+            "Gloorx Vloq")),
+    _bonus("KillHellLord", {"uniq"},
+        lambda st, ev: _mentions(ev.msg, "Asmodeus", "Antaeus", "Dispater",
+            "Ereshkigal")),
+    _bonus("RuneBeforeXL17", {"rune"}, lambda st, ev: ev.xl < 17),
+]
+
+BONUS_CATEGORIES = {r.category for r in BONUSES}
+
+
+def _by_verb(rules):
+    """{verb: the rules to try on its milestones}, and those for any other
+    verb."""
+    anyverb = [r for r in rules if r.verbs is None]
+    verbs = set().union(*[r.verbs for r in rules if r.verbs is not None])
+    return {v: [r for r in rules if r.verbs is None or v in r.verbs]
+            for v in verbs}, anyverb
+
+_RULES_BY_VERB, _RULES_ANY_VERB = _by_verb(RULES + BONUSES)
+
+
+def feed(state: GameState, ev: Event) -> list:
+    """Run the rules on a game's next milestone. Returns the categories it
+    met for the first time."""
+    met = []
+    for rule in _RULES_BY_VERB.get(ev.verb, _RULES_ANY_VERB):
+        category = rule.category
+        if "{" in category:
+            category = category.format(god=ev.god)
+        if category not in state.done and rule.test(state, ev):
+            state.done.add(category)
+            met.append(category)
+    if ev.verb == "br.enter":
+        state.enters.append((ev.place, ev.turn))
+    elif ev.verb == "death":
+        state.deaths.append(ev.turn)
+    return met
+
+
+def _int(v) -> int:
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _place(place: str) -> str:
+    """D:3 for D:3, Temple:1 for Temple, like model.get_place_from_string."""
+    code = place.split(":") + [1]
+    return "%s:%s" % (code[0], _int(code[1]))
+
+
+def event(data: dict, time) -> Event:
+    """The Event of a dict from modelutils.logline_to_dict."""
+    return Event(data["type"], "%s:%s" % (data["br"], _int(data["lvl"])),
+            _place(data["oplace"]), data["god"], _int(data["xl"]),
+            _int(data["turn"]), _int(data["runes"]), _int(data["gems"]),
+            _int(data["potionsused"]), _int(data["scrollsused"]),
+            _int(data["sklev"]), data["milestone"], data["status"],
+            data.get("ktyp"), time)
+
+
+def _chunks(items: list) -> Iterable[list]:
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i:i + CHUNK_SIZE]
+
+
+def _events(s: sqlalchemy.orm.session.Session, gids: Sequence[str]) -> Iterable:
+    """(milestone id, gid, Event) of every milestone of the games, in the
+    order they were written."""
+    place, oplace = aliased(Place), aliased(Place)
+    branch, obranch = aliased(Branch), aliased(Branch)
+    q = s.query(Milestone.id, Milestone.gid, Verb.name, branch.short,
+            place.level, obranch.short, oplace.level, God.name, Milestone.xl,
+            Milestone.turn, Milestone.runes, Milestone.gems,
+            Milestone.potionsused, Milestone.scrollsused, Milestone.sklev,
+            Milestone.msg, Milestone.status, Ktyp.name, Milestone.time
+        ).join(Verb, Milestone.verb_id == Verb.id
+        ).outerjoin(place, Milestone.place_id == place.id
+        ).outerjoin(branch, place.branch_id == branch.id
+        ).outerjoin(oplace, Milestone.oplace_id == oplace.id
+        ).outerjoin(obranch, oplace.branch_id == obranch.id
+        ).outerjoin(God, Milestone.god_id == God.id
+        ).join(Game, Game.gid == Milestone.gid
+        ).outerjoin(Ktyp, Game.ktyp_id == Ktyp.id
+        ).filter(Milestone.gid.in_(gids)).order_by(Milestone.gid, Milestone.id)
+    for (mid, gid, verb, br, lvl, obr, olvl, god, xl, turn, runes, gems,
+            potions, scrolls, sklev, msg, status, ktyp, time) in q:
+        yield mid, gid, Event(verb, "%s:%s" % (br, lvl), "%s:%s" % (obr, olvl),
+                god, _int(xl), _int(turn), _int(runes), _int(gems),
+                _int(potions), _int(scrolls), _int(sklev), msg or "",
+                status or "", ktyp if verb == "death.final" else None, time)
+
+
+def _save_states(s: sqlalchemy.orm.session.Session, states: dict) -> None:
+    for chunk in _chunks(sorted(states)):
+        s.query(RuleState).filter(RuleState.gid.in_(chunk)).delete(
+                synchronize_session=False)
+    _insert(s, RuleState, [{"gid": gid, "version": RULES_VERSION,
+        "state": state.dumps()} for gid, state in states.items()])
+
+
+def _insert(s: sqlalchemy.orm.session.Session, cls, rows: list) -> None:
+    """One executemany, without the ORM's per row bookkeeping."""
+    if rows:
+        s.execute(cls.__table__.insert(), rows)
+
+
+def replay(s: sqlalchemy.orm.session.Session, gids: Iterable[str]) -> dict:
+    """Rebuild the ledger entries and states of games from their milestones.
+
+    Returns {gid: GameState}. Doesn't commit."""
+    states = {}
+    for chunk in _chunks(sorted(set(gids))):
+        s.query(Achievement).filter(Achievement.gid.in_(chunk)).delete(
+                synchronize_session=False)
+        chunk_states = {gid: GameState() for gid in chunk}
+        met = []
+        for mid, gid, ev in _events(s, chunk):
+            for category in feed(chunk_states[gid], ev):
+                met.append({"gid": gid, "category": category,
+                    "milestone_id": mid, "time": ev.time})
+        _insert(s, Achievement, met)
+        _save_states(s, chunk_states)
+        states.update(chunk_states)
+    return states
+
+
+def catch_up(s: sqlalchemy.orm.session.Session) -> set:
+    """Replay the games with no state or one from older rules, eg every game
+    after RULES_VERSION changed. Returns their gids. Doesn't commit."""
+    current = s.query(RuleState.gid).filter(RuleState.version == RULES_VERSION)
+    gids = {gid for gid, in s.query(Game.gid).filter(~Game.gid.in_(current))}
+    if gids:
+        logging.info("Replaying the milestones of {} games".format(len(gids)))
+        replay(s, gids)
+    return gids
+
+
+class Ledger:
+    """The rule states of the games an EventBatch writes.
+
+    load() reads the states of a run of events at once. Events are fed to
+    the rules as they are queued, and write() adds what they met to the
+    ledger once their milestones are in. A game with no state, because it
+    began before there was a ledger, is replayed from its milestones
+    instead."""
+
+    def __init__(self):
+        self.states = {}  # type: dict  # gid: GameState, or None if it has none
+        self.changed = set()  # type: set
+        self.replays = set()  # type: set
+        self.met = []  # type: list  # (gid, category, index in batch, time)
+
+    def load(self, s: sqlalchemy.orm.session.Session, gids: Iterable[str]) -> None:
+        gids = sorted(set(gids) - set(self.states))
+        for chunk in _chunks(gids):
+            for gid, state in s.query(RuleState.gid, RuleState.state).filter(
+                    RuleState.gid.in_(chunk),
+                    RuleState.version == RULES_VERSION):
+                self.states[gid] = GameState.loads(state)
+        for gid in gids:
+            self.states.setdefault(gid, None)
+
+    def add(self, s: sqlalchemy.orm.session.Session, gid: str, ev: Event,
+            index: int) -> None:
+        """Feed the index-th milestone of the batch to the rules."""
+        if ev.verb == "begin":
+            self.states[gid] = GameState()
+        elif gid not in self.states:
+            self.load(s, [gid])
+        state = self.states[gid]
+        if state is None:
+            self.replays.add(gid)
+            return
+        for category in feed(state, ev):
+            self.met.append((gid, category, index, ev.time))
+        self.changed.add(gid)
+
+    def write(self, s: sqlalchemy.orm.session.Session, ids: Sequence[int]) -> None:
+        """Write what the batch's milestones met, given the ids they were
+        inserted with. Doesn't commit."""
+        _insert(s, Achievement, [{"gid": gid, "category": category,
+            "milestone_id": ids[index], "time": time}
+            for gid, category, index, time in self.met])
+        _save_states(s, {gid: self.states[gid] for gid in self.changed})
+        if self.replays:
+            self.states.update(replay(s, self.replays))
+        self.met = []
+        self.changed = set()
+        self.replays = set()
@@ -0,0 +1,199 @@
+"""Generate synthetic tournament data to benchmark the scoreboard with.
+
+generate() writes milestones and logfile files for the servers of a sources
+file, laid out like sources.download_sources leaves them, so that
+refresh.refresh(..., fetch=False) can ingest them. Games are a mix of the
+week's combos played during the week and random combos played any time, with
+milestones covering every verb in constants.VERBS and branch in
+constants.BRANCHES.
+"""
+
+import datetime
+import os
+import random
+from typing import Optional, Sequence
+
+import constants as const
+import sources
+
+VERSION = "0.34.0"
+# single-level branches are always level 1
+_DEPTHS = {"D": 15, "Lair": 5, "Orc": 2, "Vaults": 5, "Snake": 4, "Swamp": 4,
+        "Shoals": 4, "Spider": 4, "Elf": 3, "Zig": 27, "Depths": 4,
+        "Abyss": 7, "Crypt": 3, "Slime": 5, "Zot": 5, "Tomb": 3, "Dis": 7,
+        "Tar": 7, "Geh": 7, "Coc": 7}
+_BRANCHES = sorted(const.BRANCHES)
+_UNIQUES = sorted(u.name for u in const.UNIQUES) + [
+        "Cerebov", "Mnoleg", "Lom Lobon", "Gloorx Vloq"]
+_GODS = sorted(g.name for g in const.GODS if g.name != "GOD_NO_GOD")
+_VERBS = [v for v in const.VERBS if v not in ("begin", "death", "death.final")]
+_KTYPS = [k for k in const.KTYPS if k != "winning"]
+
+
+def crawl_date(dt: datetime.datetime) -> str:
+    """A crawl date string, 0-indexed month and all."""
+    return "%04d%02d%02d%02d%02d%02dS" % (dt.year, dt.month - 1, dt.day,
+            dt.hour, dt.minute, dt.second)
+
+
+def _logline(fields: dict) -> str:
+    return ":".join("%s=%s" % (k, str(v).replace(":", "::"))
+            for k, v in fields.items()) + "\n"
+
+
+class _Game:
+    """The state of one synthetic game as its milestones are generated."""
+
+    def __init__(self, rng, name, char, start):
+        self.rng = rng
+        self.base = {"v": VERSION, "vlong": VERSION + "-1-gdeadbeef",
+                "name": name, "race": char[:2], "cls": char[2:],
+                "char": char, "start": crawl_date(start)}
+        self.time = start
+        self.xl, self.turn, self.runes, self.gems = 1, 0, 0, 0
+        self.god = None
+        self.branch, self.level = "D", 1
+        self.potions, self.scrolls = 0, 0
+
+    def _fields(self):
+        fields = dict(self.base, xl=self.xl, sk=self.rng.choice(const.SKILLS),
+                sklev=min(27, self.xl + self.rng.randint(0, 3)),
+                place="%s:%d" % (self.branch, self.level), br=self.branch,
+                lvl=self.level, turn=self.turn, dur=self.turn // 3,
+                urune=self.runes, fgem=self.gems,
+                potionsused=self.potions, scrollsused=self.scrolls,
+                status="tree-form" if self.rng.random() < 0.02 else "")
+        if self.god:
+            fields["god"] = self.god
+        return fields
+
+    def _advance(self):
+        rng = self.rng
+        self.time += datetime.timedelta(seconds=rng.randint(60, 3600))
+        self.turn += rng.randint(50, 3000)
+        self.xl = min(27, self.xl + rng.choice((0, 0, 1, 1, 2)))
+        self.potions += int(rng.random() < 0.3)
+        self.scrolls += int(rng.random() < 0.3)
+
+    def _goto(self, branch, level=None):
+        self.branch = branch
+        depth = _DEPTHS.get(branch, 1)
+        self.level = level if level is not None else self.rng.randint(1, depth)
+
+    def milestone(self, verb):
+        """Apply verb to the game and return its milestones line."""
+        rng = self.rng
+        if verb != "begin":
+            self._advance()
+        if verb == "begin":
+            msg = "began the game."
+        elif verb == "br.enter":
+            branch = rng.choice(_BRANCHES)
+            self._goto(branch.short, 1)
+            msg = "entered %s." % branch.full
+        elif verb == "br.end":
+            branch = rng.choice(_BRANCHES)
+            self._goto(branch.short, _DEPTHS.get(branch.short, 1))
+            msg = "reached the bottom of %s." % branch.full
+        elif verb == "rune":
+            self._goto(rng.choice(const.RUNE_BRANCHES))
+            self.runes += 1
+            msg = "found a rune of Zot (%d runes)." % self.runes
+        elif verb == "gem.found":
+            self.gems += 1
+            msg = "found a gem."
+        elif verb == "orb":
+            self._goto("Zot", 5)
+            msg = "found the Orb of Zot!"
+        elif verb in ("zig", "zig.enter", "zig.exit"):
+            self._goto("Zig")
+            msg = "left a ziggurat." if verb == "zig.exit" else "entered a ziggurat."
+        elif verb.startswith("uniq"):
+            msg = "killed %s." % rng.choice(_UNIQUES)
+        elif verb == "god.worship":
+            self.god = rng.choice(_GODS)
+            msg = "became a worshipper of %s." % self.god
+        elif verb == "god.maxpiety":
+            msg = "became the Champion of %s." % (self.god or "Xom")
+        elif verb == "god.renounce":
+            msg = "abandoned %s." % (self.god or "Xom")
+            self.god = None
+        elif verb in ("abyss.enter", "abyss.exit"):
+            self._goto("Abyss")
+            msg = "entered the Abyss."
+        else:
+            msg = "did %s." % verb
+        return _logline(dict(self._fields(), time=crawl_date(self.time),
+            type=verb, milestone=msg))
+
+    def death(self, won):
+        """The logfile line ending the game."""
+        self._advance()
+        dam = self.rng.randint(0, 50)
+        ktyp = "winning" if won else self.rng.choice(_KTYPS)
+        return _logline(dict(self._fields(), end=crawl_date(self.time),
+            ktyp=ktyp, tmsg="escaped with the Orb" if won else "was slain",
+            sc=self.rng.randint(1, 10 ** 7 if won else 10 ** 5),
+            dam=dam, sdam=dam, tdam=dam))
+
+
+def generate(sources_file: str, dest: str, weeks: Sequence, players: int=100,
+        games: int=3, milestones: int=20, in_week: float=0.5,
+        finished: float=0.9, won: float=0.1, seed: int=0,
+        servers: Optional[Sequence[str]]=None) -> list:
+    """Write synthetic logfiles and milestones for a tournament.
+
+    Parameters:
+        weeks: (char, start, end) of each week, eg from csdc.weeks.
+        players: number of players, each playing on one server
+        games: games per player
+        milestones: average milestones per game
+        in_week: fraction of games that are the week's combo in the week
+        finished: fraction of games that end, won of those that are won
+        servers: the servers to write, default all in the sources file
+
+    Returns:
+        The player names.
+    """
+    rng = random.Random(seed)
+    data = sources.source_data(sources_file)
+    servers = sorted(servers or data)
+    combos = sorted(const.PLAYABLE_COMBOS)
+    first = min(w[1] for w in weeks)
+    span = (max(w[2] for w in weeks) - first).total_seconds()
+
+    events = {src: [] for src in servers}
+    names = []
+    for p in range(players):
+        name = "Player%d" % p
+        names.append(name)
+        src = rng.choice(servers)
+        for _ in range(games):
+            if rng.random() < in_week:
+                char, wkstart, wkend = rng.choice(weeks)
+                start = wkstart + datetime.timedelta(seconds=rng.uniform(0,
+                    (wkend - wkstart).total_seconds() - 1))
+            else:
+                char = rng.choice(combos)
+                start = first + datetime.timedelta(seconds=rng.uniform(0, span))
+            start = start.replace(microsecond=0)
+            game = _Game(rng, name, char, start)
+            events[src].append((game.time, 0, game.milestone("begin")))
+            for _ in range(rng.randint(milestones // 2, milestones * 3 // 2)):
+                line = game.milestone(rng.choice(_VERBS))
+                events[src].append((game.time, 0, line))
+            if rng.random() < finished:
+                events[src].append((game.time, 1, game.death(rng.random() < won)))
+
+    for src in servers:
+        destdir = os.path.join(dest, src)
+        os.makedirs(destdir, exist_ok=True)
+        files = [os.path.join(destdir, sources.url_to_filename(data[src][x]))
+                for x in ("milestones", "logfile")]
+        outs = [open(f, "w") for f in files]
+        # each file is in time order, like a server writes it
+        for _, kind, line in sorted(events[src], key=lambda e: e[0]):
+            outs[kind].write(line)
+        for f in outs:
+            f.close()
+    return names
@@ -0,0 +1,46 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import csdc
+import model
+import orm
+import refresh
+import synthetic
+
+SOURCES_FILE = "sources_csdc.yml"
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A new, empty scoreboard database, with the repo as the working
+    directory so the config and sources files are found."""
+    monkeypatch.chdir(ROOT)
+    orm.initialize("sqlite:///" + str(tmp_path / "scoreboard.db"))
+    model.setup_database()
+    yield
+    orm.engine.dispose()
+
+
+@pytest.fixture
+def sources_dir(db, tmp_path):
+    """Synthetic sources for the weeks, the same ones every time."""
+    del csdc.weeks[:]
+    csdc.initialize_weeks()
+    dest = str(tmp_path / "sources")
+    synthetic.generate(SOURCES_FILE, dest,
+            [(wk.char, wk.start, wk.end) for wk in csdc.weeks],
+            players=60, games=3, milestones=20, seed=0)
+    return dest
+
+
+@pytest.fixture
+def synthetic_db(sources_dir):
+    """The db fixture refreshed from the synthetic sources, scored."""
+    refresh.refresh(SOURCES_FILE, sources_dir, fetch=False)
+    csdc.update_scores()
+    return sources_dir
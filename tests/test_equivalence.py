@@ -0,0 +1,49 @@
+"""The fast paths against the reference implementations bench.py times
+them against, on synthetic sources."""
+import glob
+import os
+
+import bench
+import csdc
+import orm
+
+
+def test_parser_matches_reference(sources_dir):
+    lines = []
+    for file in glob.glob(os.path.join(sources_dir, "*", "*")):
+        with open(file, 'rb') as f:
+            lines.extend(line.decode() for line in f)
+    # escaped colons, no god, a logfile line
+    lines += [
+        "v=0.34.0:name=a:place=D::3:br=D:lvl=3:time=20240403120000S"
+            ":type=br.enter:milestone=entered::D:start=20240403110000S\n",
+        "v=0.34.0-a0:name=b:place=D::$:br=D:lvl=1:god=Jiyva:end=20240403120000S"
+            ":ktyp=mon:tmsg=slain:start=20240403110000S\n",
+    ]
+    assert len(lines) > 1000
+    assert bench.parse_mismatches(lines) == []
+
+
+def test_ledger_scores_match_reference(synthetic_db):
+    with orm.get_session() as s:
+        games = 0
+        for wk in csdc.weeks:
+            reference = bench.week_scores(s, wk, wk._reference_columns())
+            assert bench.week_scores(s, wk, wk.score_columns) == reference
+            games += len(reference)
+        assert games > 0
+
+
+def test_replay_rebuilds_ledger(synthetic_db):
+    with orm.get_session() as s:
+        streamed, replayed = bench.replayed_ledger(s)
+        s.rollback()
+    assert streamed and replayed == streamed
+
+
+def test_eligibility_methods_agree(synthetic_db):
+    with orm.get_session() as s:
+        for wk in csdc.weeks:
+            gids = bench.eligible_gids(s, wk)
+            assert len(gids) == len(csdc.ELIGIBILITY)
+            assert all(g == gids["subquery"] for g in gids.values())
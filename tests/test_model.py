@@ -0,0 +1,71 @@
+import datetime
+import random
+
+import orm
+import synthetic
+from model import EventBatch
+import modelutils
+
+START = datetime.datetime(2024, 5, 3, 12)
+
+
+def _events(lines):
+    events = []
+    for line in lines:
+        data = modelutils.logline_to_dict(line)
+        data["src_abbr"] = "cao"
+        events.append(data)
+    return events
+
+
+def _ingest(events):
+    with orm.get_session() as s:
+        batch = EventBatch()
+        for data in events:
+            batch.add(s, data)
+        batch.flush(s)
+        s.commit()
+
+
+def _game(start):
+    """The begin and two later milestones of a game, and the xl of the
+    last one."""
+    game = synthetic._Game(random.Random(0), "Player", "MiFi", start)
+    lines = [game.milestone(verb) for verb in ("begin", "br.enter", "br.enter")]
+    return lines + [int(modelutils.logline_to_dict(lines[-1])["xl"])]
+
+
+def _progress(start):
+    """The game's progress columns and those of its latest milestone."""
+    with orm.get_session() as s:
+        g = s.query(orm.Game).filter(orm.Game.start == start).one()
+        latest = s.query(orm.Milestone).filter(orm.Milestone.gid == g.gid
+                ).order_by(orm.Milestone.time.desc()).first()
+        return (g.last_milestone_time, g.last_place_id, g.xl), latest
+
+
+def test_progress_is_from_the_latest_milestone(db):
+    begin, early, late, xl = _game(START)
+    # a milestone from before the latest one turns up in a later batch
+    _ingest(_events([begin, late]))
+    _ingest(_events([early]))
+    progress, latest = _progress(START)
+    assert progress == (latest.time, latest.place_id, xl)
+
+
+def test_progress_is_from_the_latest_milestone_of_a_batch(db):
+    begin, early, late, xl = _game(START)
+    _ingest(_events([begin, late, early]))
+    progress, latest = _progress(START)
+    assert progress == (latest.time, latest.place_id, xl)
+
+
+def test_milestones_are_stored_like_the_other_rows(db):
+    begin, early, late, xl = _game(START)
+    _ingest(_events([begin, early, late]))
+    with orm.get_session() as s:
+        # games are written through SQLAlchemy, milestones straight through
+        # the driver
+        times = s.execute("SELECT m.time, g.start FROM milestones m "
+                "JOIN games g ON g.gid = m.gid").fetchall()
+    assert {len(time) for time, start in times} == {len(times[0][1])}
@@ -0,0 +1,86 @@
+import datetime
+import random
+
+import orm
+import refresh
+import sources
+import synthetic
+from model import get_logfile_progress
+
+SOURCES_FILE = "sources_csdc.yml"
+START = datetime.datetime(2024, 5, 3, 12)
+
+
+def _files(tmp_path):
+    """The milestones and logfile of a cao source under tmp_path."""
+    data = sources.source_data(SOURCES_FILE)["cao"]
+    dest = tmp_path / "sources" / "cao"
+    dest.mkdir(parents=True)
+    return [dest / sources.url_to_filename(data[x]) for x in ("milestones", "logfile")]
+
+
+def _orphan_end(tmp_path):
+    """A source whose logfile ends a game that never began, next to
+    another game that's still going. Returns its files, the other game, the
+    orphan and its missing begin line."""
+    rng = random.Random(0)
+    milestones, logfile = _files(tmp_path)
+    other = synthetic._Game(rng, "Other", "MiFi", START - datetime.timedelta(hours=1))
+    orphan = synthetic._Game(rng, "Orphan", "MiFi", START)
+    begin = orphan.milestone("begin")
+    milestones.write_text(other.milestone("begin"))
+    logfile.write_text(orphan.death(False))
+    return milestones, logfile, other, orphan, begin
+
+
+def _offset(logfile):
+    with orm.get_session() as s:
+        log = get_logfile_progress(s, str(logfile))
+        return log.current_key, log.stalls
+
+
+def _refresh(tmp_path):
+    refresh.refresh(SOURCES_FILE, str(tmp_path / "sources"), fetch=False)
+
+
+def test_unmatched_end_waits_until_milestones_pass_it(db, tmp_path):
+    milestones, logfile, other, orphan, _ = _orphan_end(tmp_path)
+    _refresh(tmp_path)
+    assert _offset(logfile) == (0, 1)
+    _refresh(tmp_path)
+    assert _offset(logfile) == (0, 2)
+
+    # the other game's milestones carry on past the orphan's end: its begin
+    # would have been read by now
+    with milestones.open("a") as f:
+        while other.time <= orphan.time:
+            f.write(other.milestone("br.enter"))
+    _refresh(tmp_path)
+    assert _offset(logfile) == (logfile.stat().st_size, 0)
+    with orm.get_session() as s:
+        assert s.query(orm.Game).count() == 1
+        assert s.query(orm.Game).filter(orm.Game.end != None).count() == 0
+
+
+def test_unmatched_end_is_skipped_after_max_stalls(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(refresh, "MAX_STALLS", 2)
+    milestones, logfile, _, _, _ = _orphan_end(tmp_path)
+    _refresh(tmp_path)
+    _refresh(tmp_path)
+    assert _offset(logfile) == (0, 2)
+    _refresh(tmp_path)
+    assert _offset(logfile) == (logfile.stat().st_size, 0)
+
+
+def test_unmatched_end_is_written_once_it_begins(db, tmp_path):
+    milestones, logfile, _, _, begin = _orphan_end(tmp_path)
+    _refresh(tmp_path)
+    assert _offset(logfile) == (0, 1)
+
+    # the begin turns up late, its milestones file was behind
+    with milestones.open("a") as f:
+        f.write(begin)
+    _refresh(tmp_path)
+    assert _offset(logfile) == (logfile.stat().st_size, 0)
+    with orm.get_session() as s:
+        assert s.query(orm.Game).filter(orm.Game.end != None).count() == 1
@@ -1,7 +1,6 @@
 import datetime
-from orm import get_session, Account
-from modelutils import morgue_url
-from model import get_game
+from orm import get_session, Account, Server, CsdcContestant
+from modelutils import game_morgue_url
 import csdc
 
 TIMEFMT = "%H:%M %Z"
@@ -113,94 +112,99 @@ def scoretable(wk, div):
     <th>Week's Total (max=15)</th>
     </tr>""")
 
-    with get_session() as s:
-        for g in wk.sortedscorecard().with_session(s).all():
-            if g.Game == None:
-                sp += """<tr class="{}"><td class="name">{}</td>
+    for g in wk.results():
+        if g.gid == None:
+            sp += """<tr class="{}"><td class="name">{}</td>
                 <td colspan="15"></td><td class="total">0</td></tr>""".format(
-                        "none", g.Player.name)
-                continue
-
-            sp += ('<tr class="{}">'.format(
-                "won" if g.Game.won and g.Game.end.replace(tzinfo=datetime.timezone.utc) <= wk.end else
-                "alive" if g.Game.alive else
-                "dead"))
-            namestr = '<td class="name">{flag}<a href="{url}">{name}</a></td>' if not g.Game.alive else '<td class="name">{flag}{name}</td>'
-            sp += (namestr.format(
-                url = morgue_url(g.Game), name = g.Game.player.name,
-                flag = serverflag(g.Game.account.server.name)))
-            sp += ( (('<td class="pt">{}</td>' * 15) 
-                + '<td class="total">{}</td>').format(
-                g.xl5,
-                g.uniq,
-                g.worship,
-                g.xl10,
-                g.brenter,
-                g.brend,
-                g.god,
-                g.gem,
-                g.rune,
-                g.tworune,
-                g.threerune,
-                g.orb,
-                g.win,
-                g.bonusone,
-                g.bonustwo,
-                g.total))
-            sp += ('</tr>\n')
+                    "none", g.name)
+            continue
+
+        sp += ('<tr class="{}">'.format(
+            "won" if g.ktyp == "winning" and g.end.replace(tzinfo=datetime.timezone.utc) <= wk.end else
+            "alive" if g.end == None else
+            "dead"))
+        namestr = '<td class="name">{flag}<a href="{url}">{name}</a></td>' if g.end != None else '<td class="name">{flag}{name}</td>'
+        sp += (namestr.format(
+            url = game_morgue_url(g.server, g.version, g.account, g.end),
+            name = g.name, flag = serverflag(g.server)))
+        sp += ( (('<td class="pt">{}</td>' * 15) 
+            + '<td class="total">{}</td>').format(
+            g.xl5,
+            g.uniq,
+            g.worship,
+            g.xl10,
+            g.brenter,
+            g.brend,
+            g.god,
+            g.gem,
+            g.rune,
+            g.tworune,
+            g.threerune,
+            g.orb,
+            g.win,
+            g.bonusone,
+            g.bonustwo,
+            g.total))
+        sp += ('</tr>\n')
 
     sp += '</table></div>'
 
     return sp
 
-def game_status(gid):
-    with get_session() as s:
-        game = get_game(s,gid=gid)
-        if game == None:
-            return "none"
-        elif game.alive:
-            return "alive"
-        elif game.won:
-            return "won"
-        else:
-            return "dead"
+def _status(gid, end, ktyp):
+    if gid == None:
+        return "none"
+    elif end == None:
+        return "alive"
+    elif ktyp == "winning":
+        return "won"
+    else:
+        return "dead"
 
 def _ifnone(x, d):
     """this should be a language builtin like it is in sql"""
     return x if x is not None else d
 
 
+def _contestant_servers(s):
+    """{account id: server name} for the contestants' accounts"""
+    return dict(s.query(Account.id, Server.name).join(Server).join(
+        CsdcContestant, CsdcContestant.player_id == Account.player_id))
+
 def standingstable():
+    # the games of the standings are the weeks' best, already loaded
+    statuses = {g.gid: _status(g.gid, g.end, g.ktyp) for wk in csdc.weeks
+            for g in wk.results() if g.gid != None}
     with get_session() as s:
-        sp = '<pre>LEGEND<br>------<br>Green = Won<br>Red   = Died<br>White = ongoing or did not finish <br>        before the end of the week</right></pre>'
-        sp += '<pre>SPECIAL NOTE<br>------------<br>None</pre>'
-        sp += '<div class="card"><table>'
-        sp += '<tr class="head"><th></th><th>Player</th>'
-        sp += ''.join(['<th>' + description(wk, True) +'</th>' for wk in csdc.weeks
-            ])
-#       sp +='<th>Win &lt;40k Turns</th>'
-        sp +='<th>15 Rune Win</th><th>Full Zig</th><th>Zot <= XL20</th>'
-        sp +='<th>No Lair Win</th><th><abbr title="Get a rune without using potions or scrolls">Ascetic Rune</abbr></th>'
-        sp += '<th>Total Score</th><th>Weekly Bonuses</th><th>Game High Score</th></tr>'
-        place = 1
-        for p in csdc.overview().with_session(s).all():
-            acct = s.query(Account).filter_by(id = p.account_id).first();
-            sp += '<tr>'
-            sp += '<td class="total">{}.</td>'.format(place)
-            place += 1
-            sp += '<td class="name">{}{}</td>'.format(
-            serverflag(acct.server.name) if acct else "", p.CsdcContestant.player.name)
-            for wk in csdc.weeks:
-                sp += '<td class="pt{}">{}</td>'.format(game_status(getattr(p,"wk" + wk.number + "gid")),
-                                                        _ifnone(getattr(p, "wk" + wk.number), ""))
-            for c in ("fifteenrune", "zig", "lowxlzot", "nolairwin", "asceticrune"):
-                sp += ('<td class="pt">{}</td>').format(_ifnone(getattr(p, c), ""))
-            sp += '<td class="total">{}</td>'.format(p.grandtotal)
-            sp += '<td class="pt">{}</td><td class="hs">{}</td>'.format(p.tiebreak, _ifnone(p.hiscore, ""))
-            sp += '</tr>'
-        sp += '</table></div>'
-
-        return sp
+        servers = _contestant_servers(s)
+    sp = '<pre>LEGEND<br>------<br>Green = Won<br>Red   = Died<br>White = ongoing or did not finish <br>        before the end of the week</right></pre>'
+    sp += '<pre>SPECIAL NOTE<br>------------<br>None</pre>'
+    sp += '<div class="card"><table>'
+    sp += '<tr class="head"><th></th><th>Player</th>'
+    sp += ''.join(['<th>' + description(wk, True) +'</th>' for wk in csdc.weeks
+        ])
+#   sp +='<th>Win &lt;40k Turns</th>'
+    sp +='<th>15 Rune Win</th><th>Full Zig</th><th>Zot <= XL20</th>'
+    sp +='<th>No Lair Win</th><th><abbr title="Get a rune without using potions or scrolls">Ascetic Rune</abbr></th>'
+    sp += '<th>Total Score</th><th>Weekly Bonuses</th><th>Game High Score</th></tr>'
+    place = 1
+    for p in csdc.overview():
+        sp += '<tr>'
+        sp += '<td class="total">{}.</td>'.format(place)
+        place += 1
+        sp += '<td class="name">{}{}</td>'.format(
+        serverflag(servers[p.account_id]) if p.account_id in servers else "", p.name)
+        for w in p.weeks:
+            sp += '<td class="pt{}">{}</td>'.format(statuses.get(w.gid, "none"),
+                                                    _ifnone(w.total, ""))
+        for c in csdc.ONETIMES:
+            sp += ('<td class="pt">{}</td>').format(_ifnone(getattr(p, c), ""))
+        sp += '<td class="total">{}</td>'.format(p.grandtotal)
+        sp += '<td class="pt">{}</td><td class="hs">{}</td>'.format(p.tiebreak, _ifnone(p.hiscore, ""))
+        sp += '</tr>'
+    sp += '</table></div>'
+
+    return sp
 
 
 def scorepage(wk):